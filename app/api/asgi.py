@@ -0,0 +1,650 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import re
+import shlex
+import uuid
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+import pytz
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import asyncpg
+import jinja2
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+from app.db import DB_POOL_SIZE, DB_POOL_TIMEOUT, PoolTimeout, get_db_params
+from app.api.endpoints import APP_ROOT, GZIP_MIN_BYTES, REPORT_GZIP, REPORTS_DIR, gzip_chunks
+from app.ingest import (INGEST_BLOCK_SECONDS, INGEST_MAX_BODY_BYTES, get_poll_buffer, parse_wait, poll_buffer_stats,
+                        poll_parser)
+from app.instrument import PROFILERS, render_metrics
+from app.log import get_logger
+from app.report.bulk import MENU_HOURS_QUERY, TIMEZONES_QUERY
+from app.report.cache import CACHED_REPORT_QUERY, DATA_WATERMARK_QUERY
+from app.report.delta import BASE_REPORT_QUERY, base_report_problem, parse_delta
+from app.report.engines import ENGINES
+from app.report.formats import parse_output, report_content_type
+from app.report.jobs import ENQUEUE_QUERY, PENDING_DUPLICATE_QUERY, QUEUE_CHANNEL, report_variant
+from app.report.progress import REPORT_STATUS_QUERY, progress_summary
+from app.report.shards import REPORT_SHARD_WORKERS
+from app.report.stores import (ANY_STORE_QUERY, STORE_REGISTERED_QUERY, parse_selection, selection_key,
+                               selection_query, unknown_store_ids)
+from app.report.uptime import (VALIDATORS_QUERY, VERSION_TABLES, WEEK_POLLS_QUERY, build_inputs, compute_rows,
+                               parse_store_ids, read_validators, uptime_cache, uptime_json)
+from app.report.windows import WindowSpec, parse_window_spec, spec_params
+
+logger = get_logger(__name__)
+
+# Async variant of the report API, served by an ASGI server (run_asgi.py) with asyncpg instead of blocking psycopg2
+# calls. /trigger_report and /get_report behave like the Flask endpoints in endpoints.py. /report_status adds a
+# status endpoint that answers the moment a report finishes: waiting clients hold an idle coroutine each instead of a
+# thread, and are woken by a notification sent by a trigger on the reports table (see create_table.py), so a
+# finished report costs a single notification however many clients wait for it.
+
+# Channel the reports_status_notify trigger announces status changes on, as '<report_id>:<status>'
+REPORT_STATUS_CHANNEL = 'report_status'
+
+# Statuses a report does not leave, except a completed report that is evicted from the cache
+FINAL_STATUSES = ('Complete', 'Error', 'Expired')
+
+# Longest a long-poll request waits, in seconds. Clients ask for less with ?wait=.
+STATUS_MAX_WAIT = float(os.environ.get('REPORT_STATUS_MAX_WAIT', '60'))
+
+# Server-sent event streams send a comment this often, so proxies do not drop idle streams
+SSE_HEARTBEAT_INTERVAL = 15.0
+
+# Seconds between attempts to reconnect the notification listener
+LISTENER_RETRY_INTERVAL = 2.0
+
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(APP_ROOT, 'templates')), autoescape=True)
+
+# asyncpg takes the same settings as psycopg2 under other names; the '-c name=value' options become server settings
+def asyncpg_params() -> Dict[str, object]:
+    db_params = get_db_params()
+    server_settings = {}
+    for option in shlex.split(db_params.get('options') or ''):
+        if option != '-c':
+            name, _, value = option.partition('=')
+            server_settings[name] = value
+    return {
+        'database': db_params['dbname'],
+        'user': db_params['user'],
+        'password': db_params['password'] or None,
+        'host': db_params['host'],
+        'port': int(db_params['port']),
+        'server_settings': server_settings,
+    }
+
+# The SQL of the psycopg2 paths with its %s placeholders numbered for asyncpg, so both servers run the same queries
+def numbered(query: str) -> str:
+    counter = itertools.count(1)
+    return re.sub(r'%s', lambda match: f"${next(counter)}", query)
+
+# Wakes the clients waiting for a report when its status changes. One connection per process LISTENs on the status
+# channel; clients waiting for the same report share a future that is resolved with the new status. Notifications
+# sent while the listener is reconnecting are lost, so every waiter is woken with None when it reconnects, and reads
+# the status again.
+class ReportStatusHub:
+    def __init__(self):
+        self.waiters: Dict[str, Tuple[asyncio.Future, int]] = {}
+        self.notifications = 0
+        self.reconnects = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _listen(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(**asyncpg_params())
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(REPORT_STATUS_CHANNEL, self._notify)
+                if self.reconnects:
+                    self._wake_all()
+                self.reconnects += 1
+                await lost.wait()
+                logger.warning("Report status listener lost its connection, reconnecting")
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.error("Report status listener: database error: %s", e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            self._wake_all()
+            await asyncio.sleep(LISTENER_RETRY_INTERVAL)
+
+    def _notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        self.notifications += 1
+        report_id, _, status = payload.rpartition(':')
+        waiter = self.waiters.pop(report_id, None)
+        if waiter is not None and not waiter[0].done():
+            waiter[0].set_result(status)
+
+    def _wake_all(self) -> None:
+        waiters, self.waiters = self.waiters, {}
+        for future, _ in waiters.values():
+            if not future.done():
+                future.set_result(None)
+
+    # Future resolved with the next status of the report. Subscribe before reading the current status, so a change in
+    # between is not missed, and unsubscribe when done waiting.
+    def subscribe(self, report_id: str) -> asyncio.Future:
+        future, count = self.waiters.get(report_id, (None, 0))
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+        self.waiters[report_id] = (future, count + 1)
+        return future
+
+    def unsubscribe(self, report_id: str, future: asyncio.Future) -> None:
+        current, count = self.waiters.get(report_id, (None, 0))
+        if current is future:
+            if count <= 1:
+                del self.waiters[report_id]
+            else:
+                self.waiters[report_id] = (future, count - 1)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'reports_watched': len(self.waiters),
+            'waiting_clients': sum(count for _, count in self.waiters.values()),
+            'notifications_total': self.notifications,
+            'listener_connects_total': self.reconnects,
+        }
+
+pool: Optional[asyncpg.Pool] = None
+hub = ReportStatusHub()
+
+# A pooled connection, waiting up to DB_POOL_TIMEOUT seconds like the psycopg2 pool of the Flask server
+@contextlib.asynccontextmanager
+async def acquire() -> AsyncIterator[asyncpg.Connection]:
+    try:
+        conn = await pool.acquire(timeout=DB_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PoolTimeout(f"No database connection available within {DB_POOL_TIMEOUT:g}s "
+                          f"({pool.get_max_size()} in use)") from None
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+def error_response(error: str, status_code: int, details: Optional[str] = None) -> JSONResponse:
+    body = {"error": error}
+    if details is not None:
+        body["details"] = details
+    return JSONResponse(body, status_code=status_code)
+
+async def read_status(conn, report_id: str) -> Optional[Tuple[str, Optional[str]]]:
+    row = await conn.fetchrow("SELECT status, report_path FROM reports WHERE report_id = $1", report_id)
+    return (row['status'], row['report_path']) if row else None
+
+async def touch_report(conn, report_id: str) -> None:
+    await conn.execute("UPDATE reports SET last_used_at = $1 WHERE report_id = $2", datetime.now(pytz.utc), report_id)
+
+# Same key as app.report.jobs.dedup_key, so both servers share queued and cached reports
+async def dedup_key(conn, stores: str, source: str) -> str:
+    max_timestamp, versions = await conn.fetchrow(DATA_WATERMARK_QUERY)
+    return '|'.join([stores, source, f"{max_timestamp}|{versions or ''}"])
+
+# Async twin of app.report.cache.find_cached_report
+async def find_cached_report(conn, key: str) -> Optional[str]:
+    row = await conn.fetchrow(numbered(CACHED_REPORT_QUERY), key)
+    if not row:
+        return None
+    report_id, report_path = row
+    if not os.path.exists(report_path):
+        await conn.execute("UPDATE reports SET status = 'Expired', report_path = NULL WHERE report_id = $1", report_id)
+        return None
+    await touch_report(conn, report_id)
+    return report_id
+
+# Async twin of app.report.jobs.enqueue_report
+async def enqueue_report(conn, store_id: Optional[str], engine: Optional[str], bulk: bool, source: str,
+                         shards: int = 1, profile: Optional[str] = None,
+                         selection: Optional[Dict[str, List[str]]] = None,
+                         windows: Optional[WindowSpec] = None,
+                         output: Optional[Dict[str, str]] = None,
+                         delta: Optional[Dict[str, str]] = None) -> Tuple[str, str]:
+    params = {'engine': engine, 'bulk': bulk, 'source': source, 'shards': shards, 'profile': profile,
+              'stores': selection, 'windows': spec_params(windows), 'output': output, 'delta': delta}
+    async with conn.transaction():
+        key = await dedup_key(conn, store_id or selection_key(selection),
+                              report_variant(source, windows, output, delta))
+        cached_report_id = await find_cached_report(conn, key)
+        if cached_report_id:
+            return cached_report_id, 'cached'
+    while True:
+        async with conn.transaction():
+            report_id = uuid.uuid4().hex
+            inserted = await conn.fetchval(numbered(ENQUEUE_QUERY), report_id, store_id, datetime.now(pytz.utc),
+                                           json.dumps(params), key)
+            if inserted:
+                await conn.execute(f"NOTIFY {QUEUE_CHANNEL}")
+                return report_id, 'queued'
+            pending_report_id = await conn.fetchval(numbered(PENDING_DUPLICATE_QUERY), key)
+        # The duplicate may have finished in between, in which case the report is queued after all
+        if pending_report_id:
+            return pending_report_id, 'pending'
+
+# Async twin of app.report.stores.resolve_store_ids
+async def resolve_store_ids(conn, selection: Optional[Dict[str, List[str]]]) -> List[str]:
+    query, params = selection_query(selection)
+    return [row[0] for row in await conn.fetch(numbered(query), *params)]
+
+async def index(request: Request) -> Response:
+    template = templates.get_template('index.html')
+    return HTMLResponse(template.render(url_for=lambda endpoint, filename: f"/static/{filename}"))
+
+async def trigger_report_endpoint(request: Request) -> Response:
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if data is not None and not isinstance(data, dict):
+        return error_response("Invalid request body", 400, "The body must be a JSON object")
+    engine = data.get('engine') if data else None
+    if engine and (not isinstance(engine, str) or engine not in ENGINES):
+        return error_response(f"Unknown engine {engine}", 400, f"Available engines: {', '.join(ENGINES)}")
+    source = data.get('source', 'raw') if data else 'raw'
+    if not isinstance(source, str) or source not in ('raw', 'rollup'):
+        return error_response(f"Unknown source {source}", 400, "Available sources: raw, rollup")
+    shards = data.get('shards', REPORT_SHARD_WORKERS) if data else REPORT_SHARD_WORKERS
+    if not isinstance(shards, int) or isinstance(shards, bool) or shards < 1:
+        return error_response(f"Invalid shards {shards}", 400, "shards must be a positive integer")
+    profile = data.get('profile') if data else None
+    profile = 'cprofile' if profile is True else profile or None
+    if profile and (not isinstance(profile, str) or profile not in PROFILERS):
+        return error_response(f"Unknown profiler {profile}", 400, f"Available profilers: {', '.join(PROFILERS)}")
+    try:
+        selection = parse_selection(data)
+    except ValueError as e:
+        return error_response("Invalid store selection", 400, str(e))
+    try:
+        windows = parse_window_spec(data)
+    except ValueError as e:
+        return error_response("Invalid report windows", 400, str(e))
+    if windows and source == 'rollup':
+        return error_response("Custom windows are computed from the raw polls", 400, "Use source raw with windows")
+    try:
+        output = parse_output(data)
+    except ValueError as e:
+        return error_response("Invalid report format", 400, str(e))
+    try:
+        delta = parse_delta(data, windows, output)
+    except ValueError as e:
+        return error_response("Invalid delta report", 400, str(e))
+    try:
+        async with acquire() as conn:
+            report_store_id = None
+            selected = {}
+            if data and 'store_id' in data and data['store_id']:
+                store_id = data['store_id']
+                if not await conn.fetchval(numbered(STORE_REGISTERED_QUERY), store_id):
+                    return error_response(f"Store {store_id} not found", 404)
+                report_store_id = store_id
+                selection = None
+            elif selection:
+                store_ids = await resolve_store_ids(conn, selection)
+                registered = store_ids
+                if 'store_ids' in selection and 'timezones' in selection:
+                    registered = await resolve_store_ids(conn, {'store_ids': selection['store_ids']})
+                unknown = unknown_store_ids(selection, registered)
+                if unknown:
+                    return error_response(f"{len(unknown)} stores not found", 404, ', '.join(unknown[:20]))
+                if not store_ids:
+                    return error_response("No stores match the selection", 404)
+                selected = {"stores": len(store_ids)}
+            elif not await conn.fetchval(ANY_STORE_QUERY):
+                return error_response("No stores found in store_status", 404)
+
+            if delta:
+                base = await conn.fetchrow(numbered(BASE_REPORT_QUERY), delta['base_report_id'])
+                if not base:
+                    return error_response(f"Base report {delta['base_report_id']} not found", 404)
+                problem = base_report_problem(tuple(base), source)
+                if problem:
+                    return error_response("Base report cannot be used", 409, problem)
+
+            bulk = bool(data.get('bulk', report_store_id is None)) if data else report_store_id is None
+            report_id, outcome = await enqueue_report(conn, report_store_id, engine, bulk, source, shards, profile,
+                                                      selection, windows, output, delta)
+        if outcome == 'cached':
+            return JSONResponse({"report_id": report_id, "cached": True, **selected}, status_code=200)
+        return JSONResponse({"report_id": report_id, **selected}, status_code=202)
+    except PoolTimeout as e:
+        return error_response("Database busy, try again", 503, str(e))
+    except Exception as e:
+        logger.error("Endpoint /trigger_report: Error: %s", e)
+        return error_response("Failed to trigger report", 500, str(e))
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# Same representations as report_file_response in endpoints.py: the file with Range support, or a gzip stream for
+# clients that accept it, each with its own ETag and answering conditional requests with 304
+def report_file_response(request: Request, report_path: str) -> Response:
+    filename = os.path.basename(report_path)
+    file_stat = os.stat(report_path)
+    etag = f"{filename}-{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"
+    content_type = report_content_type(report_path)
+    gzipped = (REPORT_GZIP and content_type == 'text/csv' and file_stat.st_size >= GZIP_MIN_BYTES
+               and 'range' not in request.headers and 'gzip' in request.headers.get('accept-encoding', ''))
+    etag = f'"{etag}-gzip"' if gzipped else f'"{etag}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(int(file_stat.st_mtime), usegmt=True),
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding',
+        'X-Report-Status': 'Complete',
+    }
+    if _not_modified(request, etag, file_stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Content-Disposition'] = f'attachment; filename={filename}'
+        return StreamingResponse(gzip_chunks(report_path), media_type=content_type, headers=headers)
+    return FileResponse(report_path, media_type=content_type, filename=filename, headers=headers,
+                        content_disposition_type='attachment')
+
+async def get_report_endpoint(request: Request) -> Response:
+    report_id = request.path_params['report_id']
+    try:
+        async with acquire() as conn:
+            result = await conn.fetchrow(numbered(REPORT_STATUS_QUERY), report_id)
+            if not result:
+                return error_response("Report not found", 404)
+            status, report_path = result[0], result[1]
+
+            if status in ('Queued', 'Running'):
+                progress = progress_summary(*result[2:])
+                if progress is None:
+                    return JSONResponse({"status": status}, status_code=200)
+                return JSONResponse({"status": status, "progress": progress}, status_code=200)
+            if status == 'Error':
+                return JSONResponse({"status": status}, status_code=200)
+            if status == 'Expired':
+                return JSONResponse({"status": "Expired", "error": "Report was evicted from the cache, trigger it again"},
+                                    status_code=410)
+            if status != 'Complete':
+                return JSONResponse({"status": status, "error": "Unexpected status"}, status_code=500)
+            if not report_path:
+                return JSONResponse({"status": "Complete", "error": "Report file path missing"}, status_code=200)
+            if not os.path.exists(report_path):
+                return JSONResponse({"status": "Complete", "error": "Report file not found"}, status_code=200)
+            if os.path.abspath(os.path.dirname(report_path)) != os.path.abspath(REPORTS_DIR):
+                return JSONResponse({"status": "Complete", "error": "Report file path does not match expected directory"},
+                                    status_code=200)
+            await touch_report(conn, report_id)
+        return report_file_response(request, report_path)
+    except PoolTimeout as e:
+        return error_response("Database busy, try again", 503, str(e))
+    except Exception as e:
+        logger.error("Endpoint /get_report: Error: %s", e)
+        return error_response("Failed to retrieve report status", 500, str(e))
+
+async def current_status(report_id: str) -> Optional[str]:
+    async with acquire() as conn:
+        result = await read_status(conn, report_id)
+    return result[0] if result else None
+
+# Yields the status of the report, then every change, until the report reaches a final status or the deadline
+# passes. A waiting client holds one pooled connection only while its status is read.
+async def watch_status(report_id: str, deadline: Optional[float] = None,
+                       heartbeat: Optional[float] = None) -> AsyncIterator[Optional[str]]:
+    loop = asyncio.get_running_loop()
+    last_status = None
+    while True:
+        future = hub.subscribe(report_id)
+        try:
+            status = await current_status(report_id)
+            if status != last_status or status is None:
+                yield status
+                last_status = status
+            if status is None or status in FINAL_STATUSES:
+                return
+            while True:
+                timeout = heartbeat
+                if deadline is not None:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        return
+                    timeout = remaining if heartbeat is None else min(heartbeat, remaining)
+                try:
+                    notified = await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    if deadline is not None and loop.time() >= deadline:
+                        return
+                    # Heartbeat: the stream stays open
+                    yield last_status
+                    continue
+                break
+        finally:
+            hub.unsubscribe(report_id, future)
+        if notified is not None and notified != last_status:
+            # The notification carries the new status, so a finished report is announced without a query
+            yield notified
+            last_status = notified
+            if notified in FINAL_STATUSES:
+                return
+
+# Status of a report without downloading it. A plain request is a long-poll: it returns as soon as the report reaches
+# a final status (Complete, Error or Expired), or after ?wait= seconds (default and cap REPORT_STATUS_MAX_WAIT) with
+# the status at that time. With 'Accept: text/event-stream' the status and every change are sent as server-sent
+# events until the report reaches a final status; the report is then downloaded from /get_report.
+async def report_status_endpoint(request: Request) -> Response:
+    report_id = request.path_params['report_id']
+    try:
+        if 'text/event-stream' in request.headers.get('accept', ''):
+            if await current_status(report_id) is None:
+                return error_response("Report not found", 404)
+            return StreamingResponse(status_events(report_id), media_type='text/event-stream',
+                                     headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        try:
+            wait = min(float(request.query_params.get('wait', STATUS_MAX_WAIT)), STATUS_MAX_WAIT)
+        except ValueError:
+            return error_response("Invalid wait", 400, "wait must be a number of seconds")
+        deadline = asyncio.get_running_loop().time() + max(wait, 0.0)
+        status = None
+        async for status in watch_status(report_id, deadline):
+            if status is None:
+                return error_response("Report not found", 404)
+        return JSONResponse({"report_id": report_id, "status": status}, status_code=200)
+    except PoolTimeout as e:
+        return error_response("Database busy, try again", 503, str(e))
+
+async def status_events(report_id: str) -> AsyncIterator[str]:
+    last_status = None
+    async for status in watch_status(report_id, heartbeat=SSE_HEARTBEAT_INTERVAL):
+        if status == last_status:
+            yield ": keep-alive\n\n"
+            continue
+        last_status = status
+        yield f"event: status\ndata: {json.dumps({'report_id': report_id, 'status': status})}\n\n"
+
+async def db_pool_endpoint(request: Request) -> Response:
+    return JSONResponse({
+        'max_size': pool.get_max_size(),
+        'size': pool.get_size(),
+        'idle': pool.get_idle_size(),
+        'in_use': pool.get_size() - pool.get_idle_size(),
+        **hub.stats(),
+    })
+
+# Same metrics as /metrics on the Flask server, with the asyncpg pool and the status waiters of this server
+async def metrics_endpoint(request: Request) -> Response:
+    try:
+        async with acquire() as conn:
+            workers = [(row['worker'], json.loads(row['metrics']))
+                       for row in await conn.fetch("SELECT worker, metrics FROM report_worker_metrics ORDER BY worker")]
+            report_counts = dict(await conn.fetch("SELECT status, count(*) FROM reports GROUP BY status"))
+        pool_stats = {
+            'max_size': pool.get_max_size(),
+            'size': pool.get_size(),
+            'in_use': pool.get_size() - pool.get_idle_size(),
+            'idle': pool.get_idle_size(),
+        }
+        server_stats = {'db_pool': pool_stats, 'report_status': hub.stats(), 'uptime_cache': uptime_cache.stats()}
+        if poll_buffer_stats() is not None:
+            server_stats['poll_ingest'] = poll_buffer_stats()
+        body = render_metrics(workers, report_counts, server_stats, 'asgi')
+    except PoolTimeout as e:
+        return error_response("Database busy, try again", 503, str(e))
+    except Exception as e:
+        logger.exception("Endpoint /metrics: Error: %s", e)
+        return error_response("Failed to collect metrics", 500, str(e))
+    return Response(body, media_type='text/plain; version=0.0.4')
+
+# Async twin of app.report.uptime.store_uptimes: the same queries and memo, with the rows computed in a thread so
+# the event loop keeps serving other requests
+async def store_uptimes(conn, store_ids: List[str]) -> List[Dict[str, object]]:
+    validators, max_times = read_validators(await conn.fetch(numbered(VALIDATORS_QUERY), VERSION_TABLES, store_ids))
+    cached = uptime_cache.lookup(validators)
+    missing = {store_id: max_ts for store_id, max_ts in max_times.items() if store_id not in cached}
+    computed: Dict[str, List] = {}
+    if missing:
+        missing_ids = list(missing)
+        timezone_rows = await conn.fetch(numbered(TIMEZONES_QUERY), missing_ids)
+        hours_rows = await conn.fetch(numbered(MENU_HOURS_QUERY), missing_ids)
+        poll_rows = await conn.fetch(numbered(WEEK_POLLS_QUERY), missing_ids, list(missing.values()))
+        inputs = build_inputs(missing, timezone_rows, hours_rows, poll_rows)
+        computed = {row[0]: row for row in await asyncio.to_thread(compute_rows, inputs)}
+        uptime_cache.store(computed.values(), validators)
+    return [uptime_json(cached.get(store_id) or computed[store_id], max_times[store_id], store_id in cached)
+            for store_id in store_ids if store_id in max_times]
+
+async def uptime_response(store_ids: List[str], single: bool) -> Response:
+    try:
+        async with acquire() as conn:
+            uptimes = await store_uptimes(conn, store_ids)
+    except PoolTimeout as e:
+        return error_response("Database busy, try again", 503, str(e))
+    except Exception as e:
+        logger.exception("Endpoint /stores/uptime: Error: %s", e)
+        return error_response("Failed to compute uptime", 500, str(e))
+    if single:
+        if not uptimes:
+            return error_response("Store not found", 404)
+        return JSONResponse(uptimes[0])
+    found = {uptime['store_id'] for uptime in uptimes}
+    return JSONResponse({"stores": uptimes, "not_found": [store_id for store_id in store_ids if store_id not in found]})
+
+# Same as /stores/<store_id>/uptime and /stores/uptime on the Flask server
+async def store_uptime_endpoint(request: Request) -> Response:
+    return await uptime_response([request.path_params['store_id']], single=True)
+
+async def stores_uptime_endpoint(request: Request) -> Response:
+    try:
+        store_ids = parse_store_ids(request.query_params.getlist('store_id') +
+                                    request.query_params.getlist('store_ids'))
+    except ValueError as e:
+        return error_response("Invalid stores", 400, str(e))
+    return await uptime_response(store_ids, single=False)
+
+# Seconds between checks for room in a full poll buffer, and for the polls of a ?wait= request to be written
+INGEST_CHECK_INTERVAL = 0.01
+
+# Same as /polls on the Flask server. The polls go to the same kind of buffer, flushed by a thread; a request that
+# finds it full or waits for its polls to be written checks again every INGEST_CHECK_INTERVAL instead of blocking
+# the event loop.
+async def ingest_polls_endpoint(request: Request) -> Response:
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > INGEST_MAX_BODY_BYTES:
+        return error_response("Batch too large", 413, f"Send at most {INGEST_MAX_BODY_BYTES} bytes per request")
+    parser = poll_parser(request.headers.get('content-type'))
+    if parser is None:
+        return error_response("Unsupported content type", 415, "Send application/x-ndjson or text/csv")
+    try:
+        wait = parse_wait(request.query_params.get('wait'))
+    except ValueError as e:
+        return error_response("Invalid wait", 400, str(e))
+    try:
+        rows = parser(await request.body())
+    except ValueError as e:
+        return error_response("Invalid polls", 400, str(e))
+    poll_buffer = get_poll_buffer()
+    if len(rows) > poll_buffer.max_rows:
+        return error_response("Batch too large", 413, f"Send at most {poll_buffer.max_rows} polls per request")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + INGEST_BLOCK_SECONDS
+    while (sequence := poll_buffer.offer(rows)) is None:
+        if loop.time() >= deadline:
+            poll_buffer.rejected()
+            response = error_response("Too many polls buffered, try again", 503,
+                                      f"The poll buffer is full ({poll_buffer.max_rows} polls)")
+            response.headers['Retry-After'] = '1'
+            return response
+        await asyncio.sleep(INGEST_CHECK_INTERVAL)
+    if wait > 0:
+        deadline = loop.time() + wait
+        while not poll_buffer.written(sequence) and loop.time() < deadline:
+            await asyncio.sleep(INGEST_CHECK_INTERVAL)
+        return JSONResponse({"accepted": len(rows), "written": poll_buffer.written(sequence)}, status_code=200)
+    return JSONResponse({"accepted": len(rows)}, status_code=202)
+
+# The endpoints leave no session state behind (no SET, LISTEN or locks, and transactions are always ended), so the
+# RESET ALL round-trip asyncpg runs whenever a connection is released is skipped
+async def keep_session(conn) -> None:
+    pass
+
+async def startup() -> None:
+    global pool
+    pool = await asyncpg.create_pool(min_size=1, max_size=max(DB_POOL_SIZE, 1), reset=keep_session,
+                                     **asyncpg_params())
+    await hub.start()
+
+async def shutdown() -> None:
+    await hub.stop()
+    if poll_buffer_stats() is not None:
+        # Write the buffered polls before the server exits
+        await asyncio.to_thread(get_poll_buffer().close)
+    if pool is not None:
+        await pool.close()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette) -> AsyncIterator[None]:
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/trigger_report', trigger_report_endpoint, methods=['POST']),
+        Route('/get_report/{report_id}', get_report_endpoint),
+        Route('/report_status/{report_id}', report_status_endpoint),
+        Route('/polls', ingest_polls_endpoint, methods=['POST']),
+        Route('/stores/uptime', stores_uptime_endpoint),
+        Route('/stores/{store_id}/uptime', store_uptime_endpoint),
+        Route('/admin/db_pool', db_pool_endpoint),
+        Route('/metrics', metrics_endpoint),
+        Mount('/static', StaticFiles(directory=os.path.join(APP_ROOT, 'static')), name='static'),
+    ],
+    lifespan=lifespan,
+)
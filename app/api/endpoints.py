@@ -1,13 +1,34 @@
-from flask import Flask, jsonify, request, send_from_directory, render_template, make_response
-import uuid
-import threading
+from flask import Flask, Response, jsonify, request, send_file, render_template, stream_with_context
 import os
-import time
-import psycopg2
+import glob
 import csv
-from datetime import datetime, timedelta, time as time_obj
+from datetime import datetime, timedelta
 import pytz
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterator, List, Optional
+import zlib
+
+from app.db import PoolTimeout, connect, connect_replica, get_db_params, get_pool, read_position
+from app.instrument import (COMPUTE, CSV_WRITE, DB_FETCH, PROFILERS, ROLLUP_CATCH_UP, ReportTimer, profile_path,
+                            render_metrics)
+from app.log import get_logger
+from app.report.metrics import REPORT_HEADER, BusinessHours, resolve_timezone, add_business_hours
+from app.report.engines import ENGINES, StoreInputs, get_engine
+from app.report.cache import evict_reports, touch_report
+from app.report.delta import (BASE_REPORT_QUERY, base_report_problem, parse_delta, read_input_versions, record_inputs,
+                              records_inputs, write_delta_report)
+from app.report.bulk import iter_bulk_report_rows
+from app.report.jobs import enqueue_report
+from app.report.shards import REPORT_SHARD_WORKERS, write_sharded_report
+from app.report.rollup import catch_up, iter_rollup_report_rows
+from app.report.progress import REPORT_STATUS_QUERY, ReportProgress, load_checkpoint, progress_summary
+from app.report.stores import (ANY_STORE_QUERY, STORE_REGISTERED_QUERY, parse_selection, resolve_store_ids,
+                               unknown_store_ids)
+from app.report.windows import WindowSpec, iter_window_report_rows, parse_window_spec, report_header
+from app.report.formats import parse_output, report_content_type, report_extension, write_columnar
+from app.report.uptime import parse_store_ids, store_uptimes, uptime_cache
+from app.ingest import INGEST_MAX_BODY_BYTES, BufferFull, get_poll_buffer, parse_wait, poll_buffer_stats, poll_parser
+
+logger = get_logger(__name__)
 
 APP_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..')) 
 PROJECT_ROOT = os.path.abspath(os.path.join(APP_ROOT, '..'))
@@ -21,304 +42,226 @@ app = Flask(__name__,
             template_folder=os.path.join(APP_ROOT, 'templates'),
             static_folder=os.path.join(APP_ROOT, 'static'))
 
-# Connection to postgresql. The database I have created is named 'loop'
-def get_db_params() -> Dict[str, str]:
-    return {
-        'dbname': os.environ.get('POSTGRES_DB', 'loop'),
-        'user': os.environ.get('POSTGRES_USER', 'postgres'),
-        'password': os.environ.get('POSTGRES_PASSWORD', 'password'),
-        'host': os.environ.get('POSTGRES_HOST', 'localhost'),
-        'port': os.environ.get('POSTGRES_PORT', '5432')
-    }
-
-# We use the pytz library to get the time based on utc timezone
-def parse_timestamp(timestamp: Optional[str]) -> Optional[datetime]:
-    if not(timestamp):
-        return None
-    if isinstance(timestamp, datetime):
-        return timestamp.astimezone(pytz.utc) if timestamp.tzinfo else pytz.utc.localize(timestamp)
-    try:
-        if timestamp.endswith(' UTC'):
-            timestamp = timestamp[:-4]
-        dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-        return pytz.utc.localize(dt)
-    except ValueError:
-        try:
-            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-            return dt.astimezone(pytz.utc) if dt.tzinfo else pytz.utc.localize(dt)
-        except ValueError:
-            print(f"Failed to parse timestamp: {timestamp}. Using current UTC time.")
-            return datetime.now(pytz.utc)
+# Queries of the per-store path. timestamp_utc is compared without a cast so that the polls of a store are read
+# with a range scan of the (store_id, timestamp_utc) index, already in timestamp order.
+STORE_EXISTS_QUERY = "SELECT store_id FROM store_status WHERE store_id = %s LIMIT 1"
+
+STORE_MAX_TIMESTAMP_QUERY = "SELECT MAX(timestamp_utc) FROM store_status WHERE store_id = %s"
+
+STORE_WEEK_POLLS_QUERY = """
+    SELECT timestamp_utc, status
+    FROM store_status
+    WHERE store_id = %s AND timestamp_utc >= %s
+    ORDER BY timestamp_utc
+"""
+
+# Per-store path: queries the inputs of a single store and computes its report row
+def store_report_row(cursor, store_id: str, engine: Optional[str] = None) -> Optional[List]:
+    logger.debug("Generating report for store_id: %s", store_id)
 
-def generate_report_logic(report_id: str, conn, store_ids: List[str]) -> None:
+    with DB_FETCH:
+        cursor.execute(STORE_EXISTS_QUERY, (store_id,))
+        if not cursor.fetchone():
+            logger.warning("Store %s not found in store_status.", store_id)
+            return None
+
+        # Use the max timestamp as the current timestamp
+        cursor.execute(STORE_MAX_TIMESTAMP_QUERY, (store_id,))
+        max_timestamp_result = cursor.fetchone()[0]
+        max_utc_from_data = max_timestamp_result or datetime.now(pytz.utc)
+
+        cursor.execute("SELECT timezone_str FROM timezones WHERE store_id = %s", (store_id,))
+        tz_result = cursor.fetchone()
+        pytz_timezone = resolve_timezone(store_id, tz_result[0] if tz_result else None)
+
+        cursor.execute(
+            'SELECT "dayOfWeek", start_time_local, end_time_local FROM menu_hours WHERE store_id = %s',
+            (store_id,)
+        )
+
+        # Create a dictionary to store the business_hours every day
+        store_business_hours: BusinessHours = {}
+        for day_of_week, start_local, end_local in cursor.fetchall():
+            add_business_hours(store_business_hours, day_of_week, start_local, end_local)
+
+        # Retrieves the status of the store that is present within the last 7 days
+        one_week_ago_utc = max_utc_from_data - timedelta(days=7)
+        cursor.execute(STORE_WEEK_POLLS_QUERY, (store_id, one_week_ago_utc))
+        store_polls = cursor.fetchall()
+
+    compute_rows = get_engine(engine)
+    with COMPUTE:
+        return compute_rows([StoreInputs(store_id, store_polls, store_business_hours, pytz_timezone, max_utc_from_data)])[0]
+
+# Rows of the given stores from the selected path, yielded as they are computed so a report can be written without
+# holding every row. The rollup path expects the rollups to be up to date. A report with custom windows has its own
+# path, whatever the other options.
+def iter_report_rows(conn, store_ids: List[str], bulk: bool = False, engine: Optional[str] = None,
+                     rollup: bool = False, windows: Optional[WindowSpec] = None) -> Iterator[List]:
+    if windows is not None:
+        yield from iter_window_report_rows(conn, store_ids, windows)
+        return
+    if rollup:
+        yield from iter_rollup_report_rows(conn, store_ids)
+        return
+    if bulk:
+        # Load every store's inputs with a few set-based queries instead of querying store by store
+        yield from iter_bulk_report_rows(conn, store_ids, engine)
+        return
+    with conn.cursor() as cursor:
+        for store_id in store_ids:
+            store_row = store_report_row(cursor, store_id, engine)
+            if store_row:
+                yield store_row
+
+def compute_report_rows(conn, store_ids: List[str], bulk: bool = False, engine: Optional[str] = None,
+                        rollup: bool = False, windows: Optional[WindowSpec] = None) -> List[List]:
+    return list(iter_report_rows(conn, store_ids, bulk, engine, rollup, windows))
+
+# Writes the rows to disk as they are computed. The file is written under a temporary name and renamed when it
+# is complete, so a download never sees a partial report. Returns the number of rows written.
+# With a progress tracker, each row is reported to it and the partial file is kept if writing fails, so that a
+# later run can resume it: resume_bytes truncates the partial file to its last checkpoint and appends after it.
+# With an output (see app/report/formats.py) the rows are written as a Parquet or Arrow file instead, in batches,
+# and a failed run cannot be resumed.
+def write_report_csv(report_filepath: str, rows: Iterator[List], header: bool = True,
+                     progress: Optional[ReportProgress] = None, resume_bytes: Optional[int] = None,
+                     columns: List[str] = REPORT_HEADER, output: Optional[Dict[str, str]] = None) -> int:
+    partial_filepath = f"{report_filepath}.tmp"
+    row_count = 0
+    try:
+        if output is not None:
+            row_count = write_columnar(partial_filepath, rows, columns, output, progress)
+            os.replace(partial_filepath, report_filepath)
+            return row_count
+        if resume_bytes is not None:
+            csvfile = open(partial_filepath, 'r+', newline='')
+            csvfile.truncate(resume_bytes)
+            csvfile.seek(resume_bytes)
+        else:
+            csvfile = open(partial_filepath, 'w', newline='')
+        with csvfile:
+            writer = csv.writer(csvfile)
+            if header and resume_bytes is None:
+                writer.writerow(columns)
+            for row in rows:
+                with CSV_WRITE:
+                    writer.writerow(row)
+                    row_count += 1
+                    if progress is not None:
+                        progress.row_written(row[0], csvfile)
+        os.replace(partial_filepath, report_filepath)
+    finally:
+        if progress is None and os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+    return row_count
+
+# Removes the partial files of a report that failed for good, which no later run will resume
+def discard_partial_files(report_filepath: str) -> None:
+    for path in glob.glob(f"{glob.escape(report_filepath)}.*"):
+        os.remove(path)
+
+# Unsharded mode: writes the rows of store_ids to report_filepath, recording progress and checkpoints in the
+# reports row. A run that finds a checkpoint of an earlier run of the same report, and its partial file, skips the
+# stores written before it. The rows are read through read_conn (a replica, see app/db.py) when given.
+def write_checkpointed_report(conn, report_id: str, report_filepath: str, store_ids: List[str], bulk: bool,
+                              engine: Optional[str], rollup: bool, windows: Optional[WindowSpec] = None,
+                              output: Optional[Dict[str, str]] = None, read_conn=None) -> int:
+    resume = ReportProgress.resume_point(load_checkpoint(conn, report_id), f"{report_filepath}.tmp", store_ids)
+    stores_done = resume['stores_done'] if resume else 0
+    if resume:
+        logger.info("Resuming report %s after store %s (%d of %d stores done)", report_id, resume['store_id'],
+                    stores_done, len(store_ids))
+    progress = ReportProgress(report_id, store_ids, stores_done)
+    try:
+        rows = iter_report_rows(read_conn or conn, store_ids[stores_done:], bulk, engine, rollup, windows)
+        return write_report_csv(report_filepath, rows, progress=progress,
+                                resume_bytes=resume['bytes'] if resume else None,
+                                columns=report_header(windows) if windows else REPORT_HEADER, output=output)
+    finally:
+        progress.close()
+
+# A delta report (see app/report/delta.py) recomputes only the stores whose inputs changed since its base report and
+# copies the rest of the rows from the base, in this process whatever the number of shards.
+# With replicas configured (see app/db.py) the rows of the stores are computed from a replica that has caught up with
+# the primary as of the start of the report; the reports row, the rollup catch-up and the inputs a delta report is
+# compared on stay on conn, the primary.
+def generate_report_logic(report_id: str, conn, store_ids: List[str], bulk: bool = False,
+                          engine: Optional[str] = None, rollup: bool = False, shard_workers: int = 1,
+                          windows: Optional[WindowSpec] = None, output: Optional[Dict[str, str]] = None,
+                          delta: Optional[Dict[str, str]] = None) -> None:
     cursor = None
+    report_filepath = os.path.join(REPORTS_DIR, f"{report_id}.{report_extension(output)}")
+    timer = ReportTimer(report_id)
+    replica = None
     try:
         cursor = conn.cursor()
-        report_output_list = []
-        for store_id in store_ids:
-            print(f"Generating report for store_id: {store_id}")
-
-            cursor.execute("SELECT store_id FROM store_status WHERE store_id = %s", (store_id,))
-            if not cursor.fetchone():
-                print(f"Store {store_id} not found in store_status.")
-                continue
-
-            # Use the max timestamp as the current timestamp
-            cursor.execute("SELECT MAX(timestamp_utc::timestamp) FROM store_status WHERE store_id = %s;", (store_id,))
-            max_timestamp_result = cursor.fetchone()[0]
-            max_utc_from_data = parse_timestamp(str(max_timestamp_result)) or datetime.now(pytz.utc)
-
-            cursor.execute("SELECT timezone_str FROM timezones WHERE store_id = %s", (store_id,))
-            tz_result = cursor.fetchone()
-            # Set default timezones as America/Chicago
-            tz_str = tz_result[0] if tz_result else 'America/Chicago'
-            try:
-                pytz_timezone = pytz.timezone(tz_str)
-            except pytz.exceptions.UnknownTimeZoneError:
-                print(f"Unknown timezone '{tz_str}' for store {store_id}. Defaulting to America/Chicago.")
-                pytz_timezone = pytz.timezone('America/Chicago')
-
-            cursor.execute(
-                'SELECT "dayOfWeek", start_time_local, end_time_local FROM menu_hours WHERE store_id = %s',
-                (store_id,)
-            )
-
-            # Create a dictionary to store the business_hours every day
-            store_business_hours: Dict[int, Tuple[time_obj, time_obj]] = {}
-            for day_of_week, start_local, end_local in cursor.fetchall():
-                # datetime.time doesn't read the time properly if the store closes at midnight so we address this edge case
-                end_local = time_obj(23, 59, 59, 999999) if end_local == time_obj(0, 0) else end_local
-                store_business_hours[day_of_week] = (start_local, end_local)
-
-            # The target time in this case is the max timestamp
-            target_ref_time_utc = max_utc_from_data
-            # Time taken 7 days before reference time
-            one_week_ago_utc = target_ref_time_utc - timedelta(days=7)
-            last_hour_start_utc = target_ref_time_utc - timedelta(hours=1)
-
-            print(f"Processing store {store_id}")
-
-            # output parameters
-            total_uptime_last_hour_s = 0
-            total_active_time_in_business_last_hour_s = 0
-            total_uptime_last_day_s = 0
-            total_active_time_in_business_last_day_s = 0
-            total_uptime_last_week_s = 0
-            total_active_time_in_business_last_week_s = 0
-
-            # Retrieves the status of the store that is present within the last 7 days
-            cursor.execute(
-                "SELECT timestamp_utc, status FROM store_status WHERE store_id = %s AND timestamp_utc::timestamp >= %s ORDER BY timestamp_utc::timestamp",
-                (store_id, one_week_ago_utc)
-            )
-            store_polls = [(parse_timestamp(row[0]), row[1]) for row in cursor.fetchall()]
-
-            # Calculate uptime for the last hour
-            # Converts time to local timezone
-            last_hour_local_dt = last_hour_start_utc.astimezone(pytz_timezone)
-            target_local_dt = target_ref_time_utc.astimezone(pytz_timezone)
-            local_date = last_hour_local_dt.date()
-            day_of_week_local = last_hour_local_dt.weekday()
-
-            biz_hours = store_business_hours.get(day_of_week_local, (time_obj(0, 0), time_obj(23, 59, 59, 999999)))
-            start_time_local, end_time_local = biz_hours
-
-            business_periods = []
-            naive_start_local = datetime.combine(local_date, start_time_local)
-            naive_end_local = datetime.combine(local_date, end_time_local)
-            if end_time_local <= start_time_local:
-                naive_end_local += timedelta(days=1)
-
-            try:
-                start_utc = pytz_timezone.localize(naive_start_local, is_dst=None).astimezone(pytz.utc)
-                end_utc = pytz_timezone.localize(naive_end_local, is_dst=None).astimezone(pytz.utc)
-                business_periods.append((start_utc, end_utc))
-            except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e:
-                print(f"DST issue for store {store_id} on {local_date}: {e}. Using fallback.")
-                try:
-                    start_utc = pytz_timezone.localize(naive_start_local, is_dst=False).astimezone(pytz.utc)
-                    end_utc = pytz_timezone.localize(naive_end_local, is_dst=False).astimezone(pytz.utc)
-                    business_periods.append((start_utc, end_utc))
-                except:
-                    start_utc = pytz_timezone.localize(naive_start_local + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
-                    end_utc = pytz_timezone.localize(naive_end_local + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
-                    business_periods.append((start_utc, end_utc))
-
-            # Set the end_time to next day in case this situation takes place (edge case)
-            if end_time_local <= start_time_local:
-                prev_local_date = local_date - timedelta(days=1)
-                prev_day_of_week = prev_local_date.weekday()
-                prev_biz_hours = store_business_hours.get(prev_day_of_week, (time_obj(0, 0), time_obj(23, 59, 59, 999999)))
-                prev_start_local, prev_end_local = prev_biz_hours
-                if prev_end_local <= prev_start_local:
-                    naive_prev_end = datetime.combine(local_date, prev_end_local)
-                    try:
-                        prev_end_utc = pytz_timezone.localize(naive_prev_end, is_dst=None).astimezone(pytz.utc)
-                        business_periods.append((last_hour_start_utc, prev_end_utc))
-                    except:
-                        prev_end_utc = pytz_timezone.localize(naive_prev_end + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
-                        business_periods.append((last_hour_start_utc, prev_end_utc))
-
-            # For each poll we calculate the duration of the poll to find the total uptime
-            for business_opens_utc, business_closes_utc in business_periods:
-                if business_closes_utc < last_hour_start_utc or business_opens_utc > target_ref_time_utc:
-                    continue
-                store_hour_polls = [
-                    (ts, status) for ts, status in store_polls
-                    if last_hour_start_utc - timedelta(hours=1) <= ts <= target_ref_time_utc + timedelta(hours=1)
-                ]
-                events = [(last_hour_start_utc, 'SYSTEM_OPEN')] + store_hour_polls + [(target_ref_time_utc, 'SYSTEM_CLOSE')]
-                events.sort(key=lambda x: x[0])
-
-                current_status = 'inactive'
-                last_poll_before = next((p for p in store_polls if p[0] < last_hour_start_utc), None)
-                if last_poll_before:
-                    current_status = last_poll_before[1]
-
-                prev_event_time = last_hour_start_utc
-                for event_time, event_type in events:
-                    actual_event_time = max(last_hour_start_utc, min(event_time, target_ref_time_utc))
-                    actual_event_time = max(actual_event_time, business_opens_utc)
-                    actual_event_time = min(actual_event_time, business_closes_utc)
-                    if actual_event_time > prev_event_time:
-                        duration_s = (actual_event_time - prev_event_time).total_seconds()
-                        if current_status == 'active':
-                            total_uptime_last_hour_s += duration_s
-                        total_active_time_in_business_last_hour_s += duration_s
-                    if event_type not in ['SYSTEM_OPEN', 'SYSTEM_CLOSE']:
-                        current_status = event_type
-                    elif event_type == 'SYSTEM_CLOSE':
-                        current_status = 'inactive'
-                    prev_event_time = actual_event_time
-
-            # Calculate uptime for the last day and the last week
-            current_utc_date = one_week_ago_utc.date()
-            while current_utc_date <= target_ref_time_utc.date():
-                iter_utc_dt = pytz.utc.localize(datetime.combine(current_utc_date, time_obj.min))
-                iter_local_dt = iter_utc_dt.astimezone(pytz_timezone)
-                local_date = iter_local_dt.date()
-                day_of_week_local = iter_local_dt.weekday()
-
-                biz_hours = store_business_hours.get(day_of_week_local, (time_obj(0, 0), time_obj(23, 59, 59, 999999)))
-                start_time_local, end_time_local = biz_hours
-
-                business_periods = []
-                naive_start_local = datetime.combine(local_date, start_time_local)
-                naive_end_local = datetime.combine(local_date, end_time_local)
-                if end_time_local <= start_time_local:
-                    naive_end_local += timedelta(days=1)
-
-                try:
-                    start_utc = pytz_timezone.localize(naive_start_local, is_dst=None).astimezone(pytz.utc)
-                    end_utc = pytz_timezone.localize(naive_end_local, is_dst=None).astimezone(pytz.utc)
-                    business_periods.append((start_utc, end_utc))
-                except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e:
-                    print(f"DST issue for store {store_id} on {local_date}: {e}. Using fallback.")
-                    try:
-                        start_utc = pytz_timezone.localize(naive_start_local, is_dst=False).astimezone(pytz.utc)
-                        end_utc = pytz_timezone.localize(naive_end_local, is_dst=False).astimezone(pytz.utc)
-                        business_periods.append((start_utc, end_utc))
-                    except:
-                        start_utc = pytz_timezone.localize(naive_start_local + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
-                        end_utc = pytz_timezone.localize(naive_end_local + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
-                        business_periods.append((start_utc, end_utc))
-
-                if end_time_local <= start_time_local:
-                    prev_local_date = local_date - timedelta(days=1)
-                    prev_day_of_week = prev_local_date.weekday()
-                    prev_biz_hours = store_business_hours.get(prev_day_of_week, (time_obj(0, 0), time_obj(23, 59, 59, 999999)))
-                    prev_start_local, prev_end_local = prev_biz_hours
-                    if prev_end_local <= prev_start_local:
-                        naive_prev_end = datetime.combine(local_date, prev_end_local)
-                        try:
-                            prev_end_utc = pytz_timezone.localize(naive_prev_end, is_dst=None).astimezone(pytz.utc)
-                            business_periods.append((iter_utc_dt, prev_end_utc))
-                        except:
-                            prev_end_utc = pytz_timezone.localize(naive_prev_end + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
-                            business_periods.append((iter_utc_dt, prev_end_utc))
-
-                daily_uptime_s = 0
-                total_business_seconds_for_day = 0
-                for business_opens_utc, business_closes_utc in business_periods:
-                    store_day_polls = [
-                        (ts, status) for ts, status in store_polls
-                        if business_opens_utc - timedelta(hours=1) <= ts <= business_closes_utc + timedelta(hours=1)
-                    ]
-
-                    events = [(business_opens_utc, 'SYSTEM_OPEN')] + store_day_polls + [(business_closes_utc, 'SYSTEM_CLOSE')]
-                    events.sort(key=lambda x: x[0])
-
-                    current_status = 'inactive'
-                    last_poll_before = next((p for p in store_polls if p[0] < business_opens_utc), None)
-                    if last_poll_before:
-                        current_status = last_poll_before[1]
-
-                    prev_event_time = business_opens_utc
-                    for event_time, event_type in events:
-                        actual_event_time = max(business_opens_utc, min(event_time, business_closes_utc))
-                        if actual_event_time > prev_event_time:
-                            duration_s = (actual_event_time - prev_event_time).total_seconds()
-                            if current_status == 'active':
-                                daily_uptime_s += duration_s
-                        if event_type not in ['SYSTEM_OPEN', 'SYSTEM_CLOSE']:
-                            current_status = event_type
-                        elif event_type == 'SYSTEM_CLOSE':
-                            current_status = 'inactive'
-                        prev_event_time = actual_event_time
-
-                    total_business_seconds_for_day += max(0, (business_closes_utc - business_opens_utc).total_seconds())
-
-                if iter_utc_dt >= target_ref_time_utc - timedelta(days=1):
-                    total_uptime_last_day_s += daily_uptime_s
-                    total_active_time_in_business_last_day_s += total_business_seconds_for_day
-
-                total_uptime_last_week_s += daily_uptime_s
-                total_active_time_in_business_last_week_s += total_business_seconds_for_day
-
-                current_utc_date += timedelta(days=1)
-
-            # Final output parameters
-            uptime_last_hour_min = round(total_uptime_last_hour_s / 60)
-            downtime_last_hour_min = round(max(0, total_active_time_in_business_last_hour_s - total_uptime_last_hour_s) / 60)
-            uptime_last_day_hours = round(total_uptime_last_day_s / 3600)
-            downtime_last_day_hours = round(max(0, total_active_time_in_business_last_day_s - total_uptime_last_day_s) / 3600)
-            uptime_last_week_hours = round(total_uptime_last_week_s / 3600)
-            downtime_last_week_hours = round(max(0, total_active_time_in_business_last_week_s - total_uptime_last_week_s) / 3600)
-
-            report_output_list.append([
-                store_id, uptime_last_hour_min, uptime_last_day_hours, uptime_last_week_hours,
-                downtime_last_hour_min, downtime_last_day_hours, downtime_last_week_hours
-            ])
-
-        # Convert the final list into a csv
-        report_filename = f"{report_id}.csv"
-        report_filepath = os.path.join(REPORTS_DIR, report_filename)
-        header = ['store_id', 'uptime_last_hour(minutes)', 'uptime_last_day(hours)', 'uptime_last_week(hours)',
-                  'downtime_last_hour(minutes)', 'downtime_last_day(hours)', 'downtime_last_week(hours)']
-        with open(report_filepath, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(header)
-            writer.writerows(report_output_list)
-        print(f"Report CSV created at {report_filepath}")
+        if rollup and windows is None:
+            # Bring the hourly rollups up to date, then read the day and week totals from them
+            with ROLLUP_CATCH_UP:
+                catch_up(conn)
+
+        # Read from a replica once it has replayed the primary up to here, rollups included, or else from the primary
+        position = read_position(conn)
+        replica = connect_replica(position)
+
+        # The inputs of the stores are read before their rows are computed, so a poll written in between makes the
+        # next delta report recompute the store rather than keep a row computed without it
+        record = records_inputs(windows, output, delta)
+        versions = None
+        if record or delta is not None:
+            with DB_FETCH:
+                versions = read_input_versions(conn, store_ids)
+
+        if delta is not None:
+            delta_stats = write_delta_report(conn, report_filepath, store_ids, delta, versions, bulk, engine, rollup,
+                                             replica)
+            logger.info("Delta report %s: %d rows, %d of %d stores recomputed", report_id, delta_stats['rows'],
+                        delta_stats['recomputed'], len(store_ids))
+        elif shard_workers > 1 and len(store_ids) > 1:
+            # Split the stores into shards computed by separate processes and merge their partial CSVs
+            write_sharded_report(conn, report_id, report_filepath, store_ids, shard_workers, bulk, engine, rollup,
+                                 windows, output, position)
+        else:
+            # Stream the rows into the file as each store or batch of stores is computed
+            write_checkpointed_report(conn, report_id, report_filepath, store_ids, bulk, engine, rollup, windows,
+                                      output, replica)
+        logger.info("Report %s created at %s", report_extension(output).upper(), report_filepath)
 
         # Set the status to completed once the report is generated
         cursor.execute(
-            "UPDATE reports SET status = 'Complete', completed_at = %s, report_path = %s WHERE report_id = %s",
+            """UPDATE reports SET status = 'Complete', completed_at = %s, report_path = %s, stores_done = stores_total,
+                checkpoint = NULL WHERE report_id = %s""",
             (datetime.now(pytz.utc), report_filepath, report_id)
         )
+        if record:
+            record_inputs(cursor, report_id, versions)
         conn.commit()
+        timer.finish('Complete', len(store_ids))
+
+        # Keep the cached reports within the disk quota
+        try:
+            evict_reports(conn)
+        except Exception as e:
+            logger.error("Error evicting cached reports: %s", e)
+            conn.rollback()
     except Exception as e:
-        print(f"Error during report generation: {e}")
+        logger.exception("Error during report generation: %s", e)
+        timer.finish('Error', len(store_ids))
         if conn:
             try:
                 cursor.execute(
-                    "UPDATE reports SET status = 'Error', completed_at = %s WHERE report_id = %s",
+                    "UPDATE reports SET status = 'Error', completed_at = %s, checkpoint = NULL WHERE report_id = %s",
                     (datetime.now(pytz.utc), report_id)
                 )
                 conn.commit()
+                discard_partial_files(report_filepath)
             except:
+                # Left running with its checkpoint, so the report resumes when it is queued again
                 conn.rollback()
     finally:
+        if replica is not None:
+            replica.close()
         if cursor:
             cursor.close()
         if conn:
@@ -332,70 +275,181 @@ def index():
 @app.route('/trigger_report', methods=['POST'])
 def trigger_report_endpoint():
     data = request.get_json()
-    db_connection_params = get_db_params()
+    if data is not None and not isinstance(data, dict):
+        return jsonify({"error": "Invalid request body", "details": "The body must be a JSON object"}), 400
+    engine = data.get('engine') if data else None
+    if engine and (not isinstance(engine, str) or engine not in ENGINES):
+        return jsonify({"error": f"Unknown engine {engine}", "details": f"Available engines: {', '.join(ENGINES)}"}), 400
+    source = data.get('source', 'raw') if data else 'raw'
+    if not isinstance(source, str) or source not in ('raw', 'rollup'):
+        return jsonify({"error": f"Unknown source {source}", "details": "Available sources: raw, rollup"}), 400
+    shards = data.get('shards', REPORT_SHARD_WORKERS) if data else REPORT_SHARD_WORKERS
+    if not isinstance(shards, int) or isinstance(shards, bool) or shards < 1:
+        return jsonify({"error": f"Invalid shards {shards}", "details": "shards must be a positive integer"}), 400
+    # Opt-in profiling of the report run: true for cProfile, or the name of the profiler
+    profile = data.get('profile') if data else None
+    profile = 'cprofile' if profile is True else profile or None
+    if profile and (not isinstance(profile, str) or profile not in PROFILERS):
+        return jsonify({"error": f"Unknown profiler {profile}", "details": f"Available profilers: {', '.join(PROFILERS)}"}), 400
+    try:
+        selection = parse_selection(data)
+    except ValueError as e:
+        return jsonify({"error": "Invalid store selection", "details": str(e)}), 400
+    # Windows other than the last hour, day and week, and/or a report as of a past time
+    try:
+        windows = parse_window_spec(data)
+    except ValueError as e:
+        return jsonify({"error": "Invalid report windows", "details": str(e)}), 400
+    if windows and source == 'rollup':
+        return jsonify({"error": "Custom windows are computed from the raw polls", "details": "Use source raw with windows"}), 400
+    # CSV by default, or a Parquet or Arrow file
+    try:
+        output = parse_output(data)
+    except ValueError as e:
+        return jsonify({"error": "Invalid report format", "details": str(e)}), 400
+    # A delta of an earlier report: the whole CSV or only the rows that changed
+    try:
+        delta = parse_delta(data, windows, output)
+    except ValueError as e:
+        return jsonify({"error": "Invalid delta report", "details": str(e)}), 400
     conn = None
     try:
-        conn = psycopg2.connect(**db_connection_params)
+        # Pooled connection; closing it below gives it back to the pool
+        conn = connect()
+        selected = {}
         with conn.cursor() as cur:
-            # Determine which stores to process
-            store_ids = []
+            # Determine which stores to process, from the store registry
             report_store_id = None
             if data and 'store_id' in data and data['store_id']:
                 store_id = data['store_id']
-                cur.execute("SELECT store_id FROM store_status WHERE store_id = %s", (store_id,))
+                cur.execute(STORE_REGISTERED_QUERY, (store_id,))
                 if not cur.fetchone():
                     return jsonify({"error": f"Store {store_id} not found"}), 404
-                store_ids = [store_id]
                 report_store_id = store_id
-            else:
-                # If no store_id is provided, process all stores
-                cur.execute("SELECT DISTINCT store_id FROM store_status")
-                store_ids = [row[0] for row in cur.fetchall()]
+                selection = None
+            elif selection:
+                # A list of stores and/or the stores in some timezones, run as one batched report. The selection is
+                # resolved again when the report runs.
+                store_ids = resolve_store_ids(cur, selection)
+                registered = store_ids
+                if 'store_ids' in selection and 'timezones' in selection:
+                    registered = resolve_store_ids(cur, {'store_ids': selection['store_ids']})
+                unknown = unknown_store_ids(selection, registered)
+                if unknown:
+                    return jsonify({"error": f"{len(unknown)} stores not found", "details": ', '.join(unknown[:20])}), 404
                 if not store_ids:
+                    return jsonify({"error": "No stores match the selection"}), 404
+                selected = {"stores": len(store_ids)}
+            else:
+                # If no store_id is provided, process all stores. The store list is read when the report runs.
+                cur.execute(ANY_STORE_QUERY)
+                if not cur.fetchone():
                     return jsonify({"error": "No stores found in store_status"}), 404
                 # Set store_id to NULL for multi-store reports
                 report_store_id = None
 
-            # Generate a single report for the selected stores
-            report_id = uuid.uuid4().hex
-            cur.execute(
-                "INSERT INTO reports (report_id, store_id, status, created_at) VALUES (%s, %s, 'Running', %s)",
-                (report_id, report_store_id, datetime.now(pytz.utc))
-            )
-            conn.commit()
-
-            # Run report generation in a background thread
-            thread = threading.Thread(target=generate_report_logic, args=(report_id, conn, store_ids))
-            thread.start()
-
-            return jsonify({"report_id": report_id}), 202
+            if delta:
+                cur.execute(BASE_REPORT_QUERY, (delta['base_report_id'],))
+                base = cur.fetchone()
+                if not base:
+                    return jsonify({"error": f"Base report {delta['base_report_id']} not found"}), 404
+                problem = base_report_problem(base, source)
+                if problem:
+                    return jsonify({"error": "Base report cannot be used", "details": problem}), 409
+
+        # Multi-store reports load their inputs in bulk unless the request asks for the per-store path
+        bulk = bool(data.get('bulk', report_store_id is None)) if data else report_store_id is None
+
+        # Queue the report for the worker pool. A completed report of the same data is returned from the cache right
+        # away, and an identical pending request returns the report already queued.
+        report_id, outcome = enqueue_report(conn, report_store_id, engine, bulk, source, shards, profile, selection,
+                                             windows, output, delta)
+        if outcome == 'cached':
+            logger.info("Endpoint /trigger_report: serving cached report %s", report_id)
+            return jsonify({"report_id": report_id, "cached": True, **selected}), 200
+        if outcome == 'pending':
+            logger.info("Endpoint /trigger_report: identical report %s is already pending", report_id)
+        return jsonify({"report_id": report_id, **selected}), 202
+    except PoolTimeout as e:
+        logger.error("Endpoint /trigger_report: Error: %s", e)
+        return jsonify({"error": "Database busy, try again", "details": str(e)}), 503
     except Exception as e:
-        print(f"Endpoint /trigger_report: Error: {e}")
+        logger.error("Endpoint /trigger_report: Error: %s", e)
         return jsonify({"error": "Failed to trigger report", "details": str(e)}), 500
     finally:
-        pass
+        if conn:
+            conn.close()
+
+# Reports are compressed on the fly for clients that accept gzip. Set REPORT_GZIP=0 to always send them as is.
+REPORT_GZIP = os.environ.get('REPORT_GZIP', '1') == '1'
+
+# Smaller reports are not worth compressing
+GZIP_MIN_BYTES = 64 * 1024
+
+# Size of the chunks a report file is read and compressed in
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+def gzip_chunks(report_path: str) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(report_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b''):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+    yield compressor.flush()
+
+# Serves a finished report without reading it into memory. The plain file supports Range requests, so an
+# interrupted download can resume, and answers If-None-Match/If-Modified-Since with 304. A client that accepts
+# gzip and does not ask for a range gets a compressed stream instead; its length is not known up front, so that
+# representation has its own ETag and no ranges. Parquet and Arrow reports are served as they are.
+def report_file_response(report_path: str) -> Response:
+    filename = os.path.basename(report_path)
+    file_stat = os.stat(report_path)
+    etag = f"{filename}-{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"
+    content_type = report_content_type(report_path)
+    if (REPORT_GZIP and content_type == 'text/csv' and file_stat.st_size >= GZIP_MIN_BYTES
+            and 'Range' not in request.headers and request.accept_encodings['gzip']):
+        response = Response(stream_with_context(gzip_chunks(report_path)), mimetype=content_type)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        response.set_etag(f"{etag}-gzip")
+        response.last_modified = int(file_stat.st_mtime)
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+    else:
+        response = send_file(report_path, mimetype=content_type, as_attachment=True, download_name=filename,
+                             conditional=True, etag=etag, max_age=0)
+    response.vary.add('Accept-Encoding')
+    return response
 
 # This is the second API call which is used to download the report.
 @app.route('/get_report/<report_id>', methods=['GET'])
 def get_report_endpoint(report_id: str):
-    db_connection_params = get_db_params()
     conn = None
     try:
-        conn = psycopg2.connect(**db_connection_params)
+        # Pooled connection; closing it below gives it back to the pool
+        conn = connect()
         with conn.cursor() as cur:
-            cur.execute("SELECT status, report_path FROM reports WHERE report_id = %s", (report_id,))
+            cur.execute(REPORT_STATUS_QUERY, (report_id,))
             result = cur.fetchone()
         if not result:
             return jsonify({"error": "Report not found"}), 404
 
-        status, report_path = result
+        status, report_path = result[:2]
 
-        if status == 'Running':
-            return jsonify({"status": "Running"}), 200
+        if status in ('Queued', 'Running'):
+            # Stores done, rate and ETA once the report has started; a requeued report keeps those of its last run
+            progress = progress_summary(*result[2:])
+            if progress is None:
+                return jsonify({"status": status}), 200
+            return jsonify({"status": status, "progress": progress}), 200
 
         if status == 'Error':
             return jsonify({"status": "Error"}), 200
 
+        if status == 'Expired':
+            return jsonify({"status": "Expired", "error": "Report was evicted from the cache, trigger it again"}), 410
+
         if status == 'Complete':
             if not report_path:
                 return jsonify({"status": "Complete", "error": "Report file path missing"}), 200
@@ -408,22 +462,156 @@ def get_report_endpoint(report_id: str):
             if report_dir != expected_dir:
                 return jsonify({"status": "Complete", "error": "Report file path does not match expected directory"}), 200
 
-            filename = os.path.basename(report_path)
-            with open(report_path, 'rb') as f:
-                response = make_response(f.read())
-            response.headers['Content-Type'] = 'text/csv'
-            response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+            # Downloads count as uses for the least recently used eviction
+            with conn.cursor() as cur:
+                touch_report(cur, report_id)
+            conn.commit()
+            response = report_file_response(report_path)
             response.headers['X-Report-Status'] = 'Complete'
             return response
 
         return jsonify({"status": status, "error": "Unexpected status"}), 500
 
+    except PoolTimeout as e:
+        logger.error("Endpoint /get_report: Error: %s", e)
+        return jsonify({"error": "Database busy, try again", "details": str(e)}), 503
     except Exception as e:
-        print(f"Endpoint /get_report: Error: {e}")
+        logger.error("Endpoint /get_report: Error: %s", e)
         return jsonify({"error": "Failed to retrieve report status", "details": str(e)}), 500
     finally:
         if conn:
             conn.close()
 
+# Saturation of the connection pool of this process: connections in use, callers waiting, waits and timeouts
+@app.route('/admin/db_pool', methods=['GET'])
+def db_pool_endpoint():
+    return jsonify(get_pool().stats()), 200
+
+# Poll ingestion: a batch of polls as newline-delimited JSON objects or CSV with a header, each with store_id,
+# timestamp_utc and status. The batch is buffered and written to store_status shortly after (see app/ingest.py);
+# with ?wait=<seconds> the response waits until it is written. A full buffer answers 503 with Retry-After.
+@app.route('/polls', methods=['POST'])
+def ingest_polls_endpoint():
+    if request.content_length is not None and request.content_length > INGEST_MAX_BODY_BYTES:
+        return jsonify({"error": "Batch too large", "details": f"Send at most {INGEST_MAX_BODY_BYTES} bytes per request"}), 413
+    parser = poll_parser(request.content_type)
+    if parser is None:
+        return jsonify({"error": "Unsupported content type", "details": "Send application/x-ndjson or text/csv"}), 415
+    try:
+        wait = parse_wait(request.args.get('wait'))
+    except ValueError as e:
+        return jsonify({"error": "Invalid wait", "details": str(e)}), 400
+    try:
+        rows = parser(request.get_data())
+    except ValueError as e:
+        return jsonify({"error": "Invalid polls", "details": str(e)}), 400
+    poll_buffer = get_poll_buffer()
+    if len(rows) > poll_buffer.max_rows:
+        return jsonify({"error": "Batch too large", "details": f"Send at most {poll_buffer.max_rows} polls per request"}), 413
+    try:
+        sequence = poll_buffer.add(rows)
+    except BufferFull as e:
+        response = jsonify({"error": "Too many polls buffered, try again", "details": str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    if wait > 0:
+        return jsonify({"accepted": len(rows), "written": poll_buffer.wait_written(sequence, wait)}), 200
+    return jsonify({"accepted": len(rows)}), 202
+
+# Uptime of stores computed on the request, for tools that need a few stores' numbers without a report file (see
+# app/report/uptime.py): /stores/<store_id>/uptime for one store, /stores/uptime?store_id=a&store_id=b for several
+def uptime_response(store_ids: List[str], single: bool):
+    conn = None
+    try:
+        conn = connect()
+        uptimes = store_uptimes(conn, store_ids)
+    except PoolTimeout as e:
+        return jsonify({"error": "Database busy, try again", "details": str(e)}), 503
+    except Exception as e:
+        logger.exception("Endpoint /stores/uptime: Error: %s", e)
+        return jsonify({"error": "Failed to compute uptime", "details": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+    if single:
+        if not uptimes:
+            return jsonify({"error": "Store not found"}), 404
+        return jsonify(uptimes[0]), 200
+    found = {uptime['store_id'] for uptime in uptimes}
+    return jsonify({"stores": uptimes, "not_found": [store_id for store_id in store_ids if store_id not in found]}), 200
+
+@app.route('/stores/<store_id>/uptime', methods=['GET'])
+def store_uptime_endpoint(store_id: str):
+    return uptime_response([store_id], single=True)
+
+@app.route('/stores/uptime', methods=['GET'])
+def stores_uptime_endpoint():
+    try:
+        store_ids = parse_store_ids(request.args.getlist('store_id') + request.args.getlist('store_ids'))
+    except ValueError as e:
+        return jsonify({"error": "Invalid stores", "details": str(e)}), 400
+    return uptime_response(store_ids, single=False)
+
+# Memory footprint and refresh latency of the resident poll store of every report worker (POLL_STORE=1)
+@app.route('/admin/poll_store', methods=['GET'])
+def poll_store_endpoint():
+    conn = None
+    try:
+        conn = connect()
+        with conn.cursor() as cur:
+            cur.execute("SELECT worker, stats, updated_at FROM poll_store_stats ORDER BY worker")
+            workers = [{'worker': worker, 'updated_at': updated_at.isoformat(), **stats}
+                       for worker, stats, updated_at in cur.fetchall()]
+        return jsonify({"workers": workers}), 200
+    except PoolTimeout as e:
+        return jsonify({"error": "Database busy, try again", "details": str(e)}), 503
+    except Exception as e:
+        logger.exception("Endpoint /admin/poll_store: Error: %s", e)
+        return jsonify({"error": "Failed to read poll store stats", "details": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
+# Prometheus metrics: the phase timers, per-store cost and report histograms published by the report workers, the
+# number of reports in each status, and the connection pool of this process
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    conn = None
+    try:
+        conn = connect()
+        with conn.cursor() as cur:
+            cur.execute("SELECT worker, metrics FROM report_worker_metrics ORDER BY worker")
+            workers = cur.fetchall()
+            cur.execute("SELECT status, count(*) FROM reports GROUP BY status")
+            report_counts = dict(cur.fetchall())
+        conn.commit()
+        server_stats = {'db_pool': get_pool().stats(), 'uptime_cache': uptime_cache.stats()}
+        if poll_buffer_stats() is not None:
+            server_stats['poll_ingest'] = poll_buffer_stats()
+        body = render_metrics(workers, report_counts, server_stats, 'flask')
+        return Response(body, mimetype='text/plain; version=0.0.4')
+    except PoolTimeout as e:
+        return jsonify({"error": "Database busy, try again", "details": str(e)}), 503
+    except Exception as e:
+        logger.exception("Endpoint /metrics: Error: %s", e)
+        return jsonify({"error": "Failed to collect metrics", "details": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
+# Profile of a report triggered with "profile": the summary as text, or with ?format=prof (cProfile) or
+# ?format=html (pyinstrument) the file the profiler saved
+@app.route('/admin/profile/<report_id>', methods=['GET'])
+def profile_endpoint(report_id: str):
+    extension = request.args.get('format', 'txt')
+    if extension not in ('txt', 'prof', 'html') or not report_id.isalnum():
+        return jsonify({"error": "Invalid profile request"}), 400
+    path = profile_path(report_id, extension)
+    if not os.path.exists(path):
+        return jsonify({"error": "Profile not found"}), 404
+    if extension == 'prof':
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True)
+    return send_file(path, mimetype='text/html' if extension == 'html' else 'text/plain')
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,361 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+# Connection to postgresql. The database I have created is named 'loop'. Sessions use UTC, so timestamptz values
+# arrive with a +00 offset (the fast path of the timestamp decoding), timestamps without an offset in loaded files
+# are read as UTC, and hours are truncated on UTC boundaries whatever the server's default time zone.
+def get_db_params() -> Dict[str, str]:
+    return {
+        'dbname': os.environ.get('POSTGRES_DB', 'loop'),
+        'user': os.environ.get('POSTGRES_USER', 'postgres'),
+        'password': os.environ.get('POSTGRES_PASSWORD', 'password'),
+        'host': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'port': os.environ.get('POSTGRES_PORT', '5432'),
+        'options': os.environ.get('POSTGRES_OPTIONS', '-c TimeZone=UTC')
+    }
+
+# Maximum number of connections each process keeps open. 0 disables pooling: every connect() opens a new connection.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+
+# Seconds connect() waits for a connection when all of them are in use
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+
+# Connections idle for longer than this many seconds are checked with a round-trip before they are handed out
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+# Connections handed out by the pool go back to it when they are closed, so code that closes the connection it
+# was given does not need to know whether it came from the pool.
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool: Optional['ConnectionPool'] = None
+        self.idle_since: Optional[float] = None
+
+    def close(self) -> None:
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.putconn(self)
+        elif not self.in_pool:
+            super().close()
+
+    @property
+    def in_pool(self) -> bool:
+        return self.pool is None and self.idle_since is not None
+
+# Size-bounded, thread-safe connection pool. Idle connections are reused most recently used first; a caller waits
+# up to `timeout` seconds for one when all `max_size` connections are in use.
+class ConnectionPool:
+    def __init__(self, db_params: Dict[str, str], max_size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT,
+                 check_after: float = DB_POOL_CHECK_AFTER):
+        self.db_params = db_params
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self._idle: List[PooledConnection] = []
+        self._size = 0
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._peak_in_use = 0
+        self._counters = {'acquired': 0, 'created': 0, 'discarded': 0, 'timeouts': 0, 'health_checks': 0}
+        self._wait_seconds = 0.0
+
+    def _open(self) -> PooledConnection:
+        conn = psycopg2.connect(**self.db_params, connection_factory=PooledConnection)
+        self._counters['created'] += 1
+        return conn
+
+    def _close(self, conn: PooledConnection) -> None:
+        conn.idle_since = None
+        if not conn.closed:
+            psycopg2.extensions.connection.close(conn)
+
+    # A connection that has been idle for a while may have been dropped by the server or a proxy
+    def _healthy(self, conn: PooledConnection) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.idle_since < self.check_after:
+            return True
+        self._counters['health_checks'] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    # Takes an idle connection, or reserves a slot for a new one, waiting while the pool is exhausted
+    def _reserve(self, timeout: float) -> Optional[PooledConnection]:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            started = time.monotonic()
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    self._wait_seconds += time.monotonic() - started
+                    raise PoolTimeout(f"No database connection available within {timeout:g}s "
+                                      f"({self.max_size} in use)")
+                self._waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._wait_seconds += time.monotonic() - started
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+            return None
+
+    def getconn(self, timeout: Optional[float] = None) -> PooledConnection:
+        timeout = self.timeout if timeout is None else timeout
+        while True:
+            conn = self._reserve(timeout)
+            if conn is not None and not self._healthy(conn):
+                self._discard(conn)
+                continue
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            with self._condition:
+                self._counters['acquired'] += 1
+                self._peak_in_use = max(self._peak_in_use, self._size - len(self._idle))
+            conn.pool = self
+            conn.idle_since = None
+            return conn
+
+    def _discard(self, conn: PooledConnection) -> None:
+        self._close(conn)
+        with self._condition:
+            self._size -= 1
+            self._counters['discarded'] += 1
+            self._condition.notify()
+
+    # Returns a connection, ending any transaction it left open. Broken connections are replaced by new ones later.
+    def putconn(self, conn: PooledConnection) -> None:
+        conn.pool = None
+        reusable = not conn.closed
+        try:
+            if reusable:
+                conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+        except psycopg2.Error:
+            reusable = False
+        if not reusable:
+            self._discard(conn)
+            return
+        conn.idle_since = time.monotonic()
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def closeall(self) -> None:
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn in idle:
+            self._close(conn)
+
+    # Saturation metrics: connections in use out of max_size, callers waiting, and how often callers had to wait
+    # or gave up
+    def stats(self) -> Dict[str, float]:
+        with self._condition:
+            in_use = self._size - len(self._idle)
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'peak_in_use': self._peak_in_use,
+                'utilization': in_use / self.max_size if self.max_size else 0.0,
+                'wait_seconds_total': round(self._wait_seconds, 6),
+                **{f"{name}_total": count for name, count in self._counters.items()},
+            }
+
+_pool: Optional[ConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+# The pool of the current process. Connections cannot be shared with forked or spawned processes, so each
+# process creates its own.
+def get_pool() -> ConnectionPool:
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(get_db_params())
+            _pool_pid = os.getpid()
+        return _pool
+
+# A connection from the pool of this process; close() gives it back
+def connect(timeout: Optional[float] = None):
+    if DB_POOL_SIZE <= 0:
+        return psycopg2.connect(**get_db_params())
+    return get_pool().getconn(timeout)
+
+# Read replicas. The bulk reads of report generation (the polls, business hours, timezones and rollups of the
+# stores) can go to streaming replicas, so that long scans do not compete with ingestion and the lookups on the
+# primary. The reports bookkeeping, the job queue, rollup catch-ups and every request of the web servers stay on the
+# primary. POSTGRES_REPLICAS lists the replicas as libpq connection strings or URIs separated by ';', each
+# overriding the settings of get_db_params (e.g. "host=replica1;host=replica2 port=5433"). Without it every read
+# goes to the primary.
+POSTGRES_REPLICAS = [dsn.strip() for dsn in os.environ.get('POSTGRES_REPLICAS', '').split(';') if dsn.strip()]
+
+# A report reads from a replica only once the replica has replayed the primary's WAL up to the point the report
+# started at, so it sees every poll the primary had and matches the data its cache key names. A report waits up to
+# REPLICA_MAX_WAIT seconds for a replica to catch up, then reads from the primary instead.
+REPLICA_MAX_WAIT = float(os.environ.get('REPLICA_MAX_WAIT', '5'))
+
+# Seconds a replica that could not be reached is left out before it is tried again
+REPLICA_RETRY_AFTER = float(os.environ.get('REPLICA_RETRY_AFTER', '30'))
+
+# Seconds between checks of the replicas while waiting for one to catch up
+REPLICA_POLL_INTERVAL = 0.1
+
+# On the primary: the end of the WAL inserted so far, which includes the commit record of every transaction committed,
+# also of those committed with synchronous_commit off whose WAL is not written yet
+WAL_POSITION_QUERY = "SELECT pg_current_wal_insert_lsn()::text"
+
+# On a replica: whether it is one, and how many bytes of WAL it still has to replay to reach a position
+REPLICA_LAG_QUERY = "SELECT pg_is_in_recovery(), pg_wal_lsn_diff(%s::pg_lsn, pg_last_wal_replay_lsn())"
+
+class Replica:
+    def __init__(self, dsn: str):
+        self.db_params = {**get_db_params(), **psycopg2.extensions.parse_dsn(dsn)}
+        self.name = f"{self.db_params['host']}:{self.db_params['port']}"
+        self.pool = ConnectionPool(self.db_params) if DB_POOL_SIZE > 0 else None
+        self.down_until = 0.0
+        # Bytes of WAL it was behind the position asked for at its last check
+        self.lag_bytes: Optional[int] = None
+
+    def _getconn(self):
+        if self.pool is None:
+            return psycopg2.connect(**self.db_params)
+        return self.pool.getconn()
+
+    def _mark_down(self, reason: str) -> None:
+        self.down_until = time.monotonic() + REPLICA_RETRY_AFTER
+        logger.warning("Replica %s left out for %gs: %s", self.name, REPLICA_RETRY_AFTER, reason)
+
+    # A connection to the replica if it has replayed the WAL up to position, else None
+    def connect_at(self, position: str):
+        try:
+            conn = self._getconn()
+        except PoolTimeout:
+            return None
+        except psycopg2.Error as e:
+            self._mark_down(str(e).strip().splitlines()[0])
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_QUERY, (position,))
+                in_recovery, lag_bytes = cur.fetchone()
+            conn.rollback()
+        except psycopg2.Error as e:
+            conn.close()
+            self._mark_down(str(e).strip().splitlines()[0])
+            return None
+        if not in_recovery:
+            conn.close()
+            self._mark_down("not a replica, it is not in recovery")
+            return None
+        self.lag_bytes = max(0, int(lag_bytes)) if lag_bytes is not None else None
+        if lag_bytes is None or lag_bytes > 0:
+            conn.close()
+            return None
+        return conn
+
+# Picks the replica a report reads from. The replicas are tried in turn, starting one further for every report, so
+# concurrent reports spread over them. Counts the reports read from each replica and from the primary.
+class ReplicaRouter:
+    def __init__(self, dsns: List[str]):
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self._next = 0
+        self._lock = threading.Lock()
+        self.reads: Dict[str, int] = {'primary': 0}
+
+    def _candidates(self) -> List[Replica]:
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        now = time.monotonic()
+        return [replica for replica in self.replicas[start:] + self.replicas[:start] if replica.down_until <= now]
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.reads[name] = self.reads.get(name, 0) + 1
+
+    # A connection to a replica that has replayed the WAL up to position, waiting up to max_wait seconds for one to
+    # catch up; None when none does in time or none can be reached
+    def connect(self, position: str, max_wait: float = REPLICA_MAX_WAIT):
+        deadline = time.monotonic() + max_wait
+        while True:
+            candidates = self._candidates()
+            for replica in candidates:
+                conn = replica.connect_at(position)
+                if conn is not None:
+                    self._count(replica.name)
+                    return conn
+            if not candidates or time.monotonic() >= deadline:
+                self._count('primary')
+                lags = ', '.join(f"{replica.name} {replica.lag_bytes} bytes behind" for replica in candidates)
+                logger.warning("No replica has replayed up to %s, reading from the primary (%s)", position,
+                               lags or "no replica reachable")
+                return None
+            time.sleep(REPLICA_POLL_INTERVAL)
+
+_router: Optional[ReplicaRouter] = None
+_router_pid: Optional[int] = None
+
+# The replica router of the current process, None without replicas
+def get_router() -> Optional[ReplicaRouter]:
+    global _router, _router_pid
+    if not POSTGRES_REPLICAS:
+        return None
+    with _pool_lock:
+        if _router is None or _router_pid != os.getpid():
+            _router = ReplicaRouter(POSTGRES_REPLICAS)
+            _router_pid = os.getpid()
+        return _router
+
+# Position of the primary a report's reads have to see, read on a primary connection; None without replicas
+def read_position(conn) -> Optional[str]:
+    if get_router() is None:
+        return None
+    with conn.cursor() as cur:
+        cur.execute(WAL_POSITION_QUERY)
+        position = cur.fetchone()[0]
+    conn.commit()
+    return position
+
+# A connection to a replica that has replayed the primary up to position, to read from; None to read from the
+# primary. close() gives it back to the replica's pool.
+def connect_replica(position: Optional[str]):
+    router = get_router()
+    if router is None or position is None:
+        return None
+    return router.connect(position)
+
+# Reports read from each replica and from the primary by this process
+def report_read_counts() -> Dict[str, int]:
+    router = get_router()
+    return dict(router.reads) if router is not None else {}
@@ -0,0 +1,348 @@
+import atexit
+import csv
+import io
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+
+from app.db import get_db_params
+from app.log import get_logger
+from app.report.rollup import invalidate
+from app.timestamps import parse_timestamp
+
+logger = get_logger(__name__)
+
+# Poll ingestion for POST /polls. Accepted polls are held in an in-memory buffer of the web server process, and a
+# flusher thread writes them to store_status with COPY once FLUSH_ROWS are buffered or the oldest has waited
+# FLUSH_SECONDS. A poll is identified by (store_id, timestamp_utc): a poll sent again, within a batch or later, is
+# written once, so clients can retry a batch they are unsure about. When the buffer holds INGEST_BUFFER_ROWS polls
+# new batches wait for room for up to INGEST_BLOCK_SECONDS and are then refused, which tells clients to slow down.
+
+INGEST_BUFFER_ROWS = int(os.environ.get('INGEST_BUFFER_ROWS', '200000'))
+INGEST_FLUSH_ROWS = int(os.environ.get('INGEST_FLUSH_ROWS', '20000'))
+INGEST_FLUSH_SECONDS = float(os.environ.get('INGEST_FLUSH_SECONDS', '1'))
+INGEST_BLOCK_SECONDS = float(os.environ.get('INGEST_BLOCK_SECONDS', '2'))
+
+# Largest request body /polls accepts
+INGEST_MAX_BODY_BYTES = int(os.environ.get('INGEST_MAX_BODY_BYTES', str(16 * 1024 * 1024)))
+
+# Longest a request with ?wait= waits for its polls to be written, in seconds
+INGEST_MAX_WAIT = float(os.environ.get('INGEST_MAX_WAIT', '30'))
+
+# Seconds the flusher waits before retrying a batch it could not write for lack of a connection. A batch the
+# database refuses for its data is split in halves until the polls it refuses are found; those are dropped, since
+# they would be refused again and hold up the polls after them.
+FLUSH_RETRY_INTERVAL = 1.0
+
+STATUSES = ('active', 'inactive')
+
+# A poll as buffered: store id, timestamp in ISO 8601 and status
+PollRow = Tuple[str, str, str]
+
+class BufferFull(Exception):
+    pass
+
+def _poll_row(record: Dict, where: str) -> PollRow:
+    store_id = record.get('store_id')
+    status = record.get('status')
+    if not isinstance(store_id, str) or not store_id or len(store_id) > 50:
+        raise ValueError(f"{where}: store_id must be a string of 1 to 50 characters")
+    # NUL cannot be stored in a text column, and no store id has control characters
+    if any(ord(char) < 32 or ord(char) == 127 for char in store_id):
+        raise ValueError(f"{where}: store_id must not contain control characters")
+    if status not in STATUSES:
+        raise ValueError(f"{where}: status must be active or inactive")
+    try:
+        timestamp = parse_timestamp(record.get('timestamp_utc'))
+    except ValueError as e:
+        raise ValueError(f"{where}: {e}")
+    if timestamp is None:
+        raise ValueError(f"{where}: timestamp_utc is missing")
+    return store_id, timestamp.isoformat(), status
+
+# Newline-delimited JSON, one {"store_id", "timestamp_utc", "status"} object per line. The lines are decoded with a
+# single json.loads; a batch that fails to decode is decoded line by line to tell which line is wrong.
+def parse_ndjson(body: bytes) -> List[PollRow]:
+    lines = [line for line in body.split(b'\n') if line.strip()]
+    try:
+        records = json.loads(b'[' + b','.join(lines) + b']')
+    except ValueError:
+        records = []
+        for number, line in enumerate(lines, start=1):
+            try:
+                records.append(json.loads(line))
+            except ValueError as e:
+                raise ValueError(f"line {number}: {e}")
+    rows = []
+    for number, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            raise ValueError(f"line {number}: expected an object")
+        rows.append(_poll_row(record, f"line {number}"))
+    return rows
+
+# CSV with a header naming the store_id, timestamp_utc and status columns, in any order, like store_status.csv
+def parse_csv(body: bytes) -> List[PollRow]:
+    reader = csv.reader(io.StringIO(body.decode('utf-8-sig')))
+    header = [column.strip() for column in next(reader, [])]
+    missing = {'store_id', 'timestamp_utc', 'status'} - set(header)
+    if missing:
+        raise ValueError(f"the header must name the columns store_id, timestamp_utc and status (missing {', '.join(sorted(missing))})")
+    rows = []
+    for number, values in enumerate(reader, start=2):
+        if not values:
+            continue
+        if len(values) != len(header):
+            raise ValueError(f"line {number}: expected {len(header)} fields, got {len(values)}")
+        rows.append(_poll_row(dict(zip(header, values)), f"line {number}"))
+    return rows
+
+POLL_PARSERS = {
+    'application/x-ndjson': parse_ndjson,
+    'application/jsonl': parse_ndjson,
+    'application/json': parse_ndjson,
+    'text/csv': parse_csv,
+}
+
+# Parser of a request body by its content type, or None for a content type that is not supported. A parser raises
+# ValueError for a malformed batch, which is refused as a whole.
+def poll_parser(content_type: Optional[str]):
+    return POLL_PARSERS.get((content_type or '').split(';')[0].strip().lower())
+
+# Seconds a request waits for its polls to be written, from ?wait= (0, not waiting, when absent), capped at
+# INGEST_MAX_WAIT. Raises ValueError for a value that is not a finite, non-negative number.
+def parse_wait(value: Optional[str]) -> float:
+    if value is None:
+        return 0.0
+    try:
+        wait = float(value)
+    except ValueError:
+        raise ValueError(f"wait must be a number of seconds, got {value!r}")
+    if not math.isfinite(wait) or wait < 0:
+        raise ValueError(f"wait must be a finite number of seconds of at least 0, got {value!r}")
+    return min(wait, INGEST_MAX_WAIT)
+
+STAGING_TABLE_QUERY = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS polls_ingest (
+        store_id VARCHAR(50),
+        timestamp_utc TIMESTAMP WITH TIME ZONE,
+        status VARCHAR(10)
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Adds the staged polls that are not in store_status yet, in index order, and returns how many were added and the
+# stores that got a poll older than their rolled up polls, whose rollups are then rebuilt
+INSERT_STAGED_QUERY = """
+    WITH inserted AS (
+        INSERT INTO store_status (store_id, timestamp_utc, status)
+        SELECT DISTINCT ON (store_id, timestamp_utc) store_id, timestamp_utc, status
+        FROM polls_ingest
+        ORDER BY store_id, timestamp_utc
+        ON CONFLICT (store_id, timestamp_utc) DO NOTHING
+        RETURNING store_id, timestamp_utc
+    )
+    SELECT
+        (SELECT COUNT(*) FROM inserted),
+        ARRAY(
+            SELECT DISTINCT i.store_id FROM inserted i
+            JOIN store_rollup_state r ON r.store_id = i.store_id
+            WHERE i.timestamp_utc <= r.last_poll_utc
+        )
+"""
+
+# Buffer of accepted polls and the thread that flushes it. Polls are numbered in the order they are accepted, so a
+# client can wait until the polls it sent are written.
+class PollBuffer:
+    def __init__(self, max_rows: int = INGEST_BUFFER_ROWS, flush_rows: int = INGEST_FLUSH_ROWS,
+                 flush_seconds: float = INGEST_FLUSH_SECONDS):
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.rows: List[PollRow] = []
+        # Polls taken by the flusher and not written yet, which still count against max_rows
+        self.in_flight = 0
+        self.first_buffered_at: Optional[float] = None
+        self.accepted = 0
+        self.written_sequence = 0
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.conn = None
+        self.stats_totals = {'batches_total': 0, 'rejected_total': 0, 'written_total': 0, 'duplicates_total': 0,
+                             'flushes_total': 0, 'flush_errors_total': 0, 'flush_seconds_total': 0.0,
+                             'rollups_invalidated_total': 0, 'dropped_total': 0}
+
+    def _start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='poll-ingest-flusher', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    # Buffers the polls if there is room and returns the number of the last one, or None when the buffer is full
+    def offer(self, rows: List[PollRow]) -> Optional[int]:
+        with self.condition:
+            self._start()
+            if len(self.rows) + self.in_flight + len(rows) > self.max_rows:
+                return None
+            if not self.rows:
+                self.first_buffered_at = time.monotonic()
+            self.rows.extend(rows)
+            self.accepted += len(rows)
+            self.stats_totals['batches_total'] += 1
+            self.condition.notify_all()
+            return self.accepted
+
+    # Buffers the polls, waiting up to timeout seconds for room. Raises BufferFull if there is none by then.
+    def add(self, rows: List[PollRow], timeout: float = INGEST_BLOCK_SECONDS) -> int:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                sequence = self.offer(rows)
+                if sequence is not None:
+                    return sequence
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected()
+                    raise BufferFull(f"The poll buffer is full ({self.max_rows} polls)")
+                self.condition.wait(remaining)
+
+    def rejected(self) -> None:
+        with self.condition:
+            self.stats_totals['rejected_total'] += 1
+
+    # Waits until the polls up to sequence are written; False on timeout
+    def wait_written(self, sequence: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.written_sequence < sequence:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def written(self, sequence: int) -> bool:
+        return self.written_sequence >= sequence
+
+    def _flush_due(self) -> bool:
+        if not self.rows:
+            return False
+        return (self.closing or len(self.rows) >= self.flush_rows
+                or time.monotonic() - self.first_buffered_at >= self.flush_seconds)
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self._flush_due():
+                    if self.closing and not self.rows:
+                        return
+                    timeout = None
+                    if self.rows:
+                        timeout = max(0.0, self.first_buffered_at + self.flush_seconds - time.monotonic())
+                    self.condition.wait(timeout)
+                rows, self.rows = self.rows, []
+                self.in_flight = len(rows)
+                sequence = self.accepted
+            while True:
+                try:
+                    self._write_or_drop(rows)
+                    break
+                except psycopg2.OperationalError as e:
+                    # Halves written before the connection failed are written again, as duplicates of themselves
+                    logger.error("Writing %d polls failed, retrying: %s", len(rows), e)
+                    with self.condition:
+                        self.stats_totals['flush_errors_total'] += 1
+                    self._reset_conn()
+                    time.sleep(FLUSH_RETRY_INTERVAL)
+            with self.condition:
+                self.in_flight = 0
+                self.written_sequence = sequence
+                self.condition.notify_all()
+
+    def _reset_conn(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    # Writes the polls, dropping those the database refuses (DataError, IntegrityError and the like) and counting them
+    # as written, so that waiting clients and later batches move on. Raises OperationalError, which is retried.
+    def _write_or_drop(self, rows: List[PollRow]) -> None:
+        try:
+            self._write(rows)
+        except psycopg2.OperationalError:
+            raise
+        except Exception as e:
+            with self.condition:
+                self.stats_totals['flush_errors_total'] += 1
+            self._reset_conn()
+            if len(rows) == 1:
+                logger.error("Dropping poll %r: %s", rows[0], e)
+                with self.condition:
+                    self.stats_totals['dropped_total'] += 1
+                return
+            self._write_or_drop(rows[:len(rows) // 2])
+            self._write_or_drop(rows[len(rows) // 2:])
+
+    # Copies the polls into a temporary table and adds the new ones to store_status in one transaction. The
+    # connection is the flusher's own, since the temporary table lives as long as it does.
+    def _write(self, rows: List[PollRow]) -> None:
+        started = time.perf_counter()
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**get_db_params())
+            with self.conn.cursor() as cur:
+                cur.execute(STAGING_TABLE_QUERY)
+            self.conn.commit()
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        try:
+            with self.conn.cursor() as cur:
+                cur.copy_expert("COPY polls_ingest (store_id, timestamp_utc, status) FROM STDIN WITH (FORMAT csv)", data)
+                cur.execute(INSERT_STAGED_QUERY)
+                inserted, late_store_ids = cur.fetchone()
+                if late_store_ids:
+                    invalidate(cur, late_store_ids)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        seconds = time.perf_counter() - started
+        with self.condition:
+            self.stats_totals['flushes_total'] += 1
+            self.stats_totals['written_total'] += inserted
+            self.stats_totals['duplicates_total'] += len(rows) - inserted
+            self.stats_totals['flush_seconds_total'] += seconds
+            self.stats_totals['rollups_invalidated_total'] += len(late_store_ids)
+        logger.debug("Wrote %d of %d polls in %.3fs", inserted, len(rows), seconds)
+
+    # Writes what is buffered and stops the flusher
+    def close(self, timeout: float = 30.0) -> None:
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def stats(self) -> Dict[str, float]:
+        with self.condition:
+            return {'buffered': len(self.rows) + self.in_flight, 'capacity': self.max_rows,
+                    'accepted_total': self.accepted, **self.stats_totals}
+
+_poll_buffer: Optional[PollBuffer] = None
+_poll_buffer_lock = threading.Lock()
+
+# The poll buffer of this process, created on first use
+def get_poll_buffer() -> PollBuffer:
+    global _poll_buffer
+    with _poll_buffer_lock:
+        if _poll_buffer is None:
+            _poll_buffer = PollBuffer()
+        return _poll_buffer
+
+# Stats of the poll buffer of this process for /metrics, without starting one
+def poll_buffer_stats() -> Optional[Dict[str, float]]:
+    return _poll_buffer.stats() if _poll_buffer is not None else None
@@ -0,0 +1,268 @@
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from collections import defaultdict
+from datetime import datetime
+import pytz
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from app.db import report_read_counts
+from app.log import get_logger, suppressed_messages
+
+logger = get_logger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Profiles of reports run with a profiler, named after the report_id
+PROFILES_DIR = os.path.join(PROJECT_ROOT, 'profiles')
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+# Profiler every report is run with ('cprofile' or 'pyinstrument'); by default only the reports triggered with
+# "profile" are profiled
+REPORT_PROFILE = os.environ.get('REPORT_PROFILE', '')
+
+# Upper bounds, in seconds, of the buckets of the per-store cost and report duration histograms
+STORE_SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+REPORT_SECONDS_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    # Records `count` observations of `value`, for engines that only time a whole batch of stores
+    def observe(self, value: float, count: int = 1) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    def to_dict(self) -> Dict:
+        return {'buckets': list(self.buckets), 'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    def merge(self, data: Dict) -> None:
+        for index, count in enumerate(data['counts']):
+            self.counts[index] += count
+        self.sum += data['sum']
+        self.count += data['count']
+
+# Metrics of this process. Reports run one at a time per worker process, and the shard processes send theirs back
+# to the worker with the shard's result.
+_phase_seconds: Dict[str, float] = defaultdict(float)
+_store_seconds: Dict[str, Histogram] = {}
+_report_seconds = Histogram(REPORT_SECONDS_BUCKETS)
+_reports_total: Dict[str, int] = defaultdict(int)
+_stores_total = 0
+
+# Phases of report generation entered and not exited yet, innermost last, as [name, time it was last resumed]
+_phase_stack: List[list] = []
+
+# Times a phase of report generation. The time is exclusive: a phase entered inside another pauses the outer one,
+# so the phases add up to the time spent in them. Instances are reused (`with DB_FETCH:`); a phase must not be held
+# across a yield.
+class Phase:
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> None:
+        now = time.perf_counter()
+        if _phase_stack:
+            outer = _phase_stack[-1]
+            _phase_seconds[outer[0]] += now - outer[1]
+        _phase_stack.append([self.name, now])
+
+    def __exit__(self, *exc_info) -> None:
+        now = time.perf_counter()
+        name, resumed = _phase_stack.pop()
+        _phase_seconds[name] += now - resumed
+        if _phase_stack:
+            _phase_stack[-1][1] = now
+
+DB_FETCH = Phase('db_fetch')
+BUSINESS_HOURS = Phase('business_hours')
+COMPUTE = Phase('compute')
+CSV_WRITE = Phase('csv_write')
+ROLLUP_CATCH_UP = Phase('rollup_catch_up')
+SHARD_MERGE = Phase('shard_merge')
+
+# Charges the time spent producing each item (for example rows of a server-side cursor) to the phase
+def timed_iter(iterable: Iterable, phase: Phase) -> Iterator:
+    iterator = iter(iterable)
+    while True:
+        with phase:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def observe_store_seconds(engine: str, seconds: float, count: int = 1) -> None:
+    histogram = _store_seconds.get(engine)
+    if histogram is None:
+        histogram = _store_seconds[engine] = Histogram(STORE_SECONDS_BUCKETS)
+    histogram.observe(seconds, count)
+
+# Times one report: records its duration and outcome, and logs how its time split into phases
+class ReportTimer:
+    def __init__(self, report_id: str):
+        self.report_id = report_id
+        self.started = time.perf_counter()
+        self.phases_before = dict(_phase_seconds)
+
+    def finish(self, status: str, stores: int) -> None:
+        global _stores_total
+        seconds = time.perf_counter() - self.started
+        _report_seconds.observe(seconds)
+        _reports_total[status] += 1
+        _stores_total += stores
+        phases = {name: total - self.phases_before.get(name, 0.0) for name, total in _phase_seconds.items()}
+        breakdown = ', '.join(f"{name} {spent:.2f}s" for name, spent in sorted(phases.items()) if spent > 0.0005)
+        logger.info("Report %s: %s, %d stores in %.2fs (%s)", self.report_id, status, stores, seconds,
+                    breakdown or 'no phases')
+
+# Resets the metrics of this process; a shard process does so before each shard and returns only that shard's
+def reset() -> None:
+    global _report_seconds, _stores_total
+    _phase_seconds.clear()
+    _store_seconds.clear()
+    _report_seconds = Histogram(REPORT_SECONDS_BUCKETS)
+    _reports_total.clear()
+    _stores_total = 0
+
+def snapshot() -> Dict:
+    return {
+        'phase_seconds': dict(_phase_seconds),
+        'store_seconds': {engine: histogram.to_dict() for engine, histogram in _store_seconds.items()},
+        'report_seconds': _report_seconds.to_dict(),
+        'reports_total': dict(_reports_total),
+        'stores_total': _stores_total,
+        'log_messages_suppressed_total': suppressed_messages(),
+        'report_reads_total': report_read_counts(),
+    }
+
+# Adds the metrics of a shard process to this process's
+def merge(data: Dict) -> None:
+    for name, seconds in data['phase_seconds'].items():
+        _phase_seconds[name] += seconds
+    for engine, histogram in data['store_seconds'].items():
+        if engine not in _store_seconds:
+            _store_seconds[engine] = Histogram(histogram['buckets'])
+        _store_seconds[engine].merge(histogram)
+
+# Report workers publish their metrics to report_worker_metrics after every report, for /metrics on the web servers
+def publish_metrics(conn, worker: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute(
+            """INSERT INTO report_worker_metrics (worker, metrics, updated_at) VALUES (%s, %s, %s)
+               ON CONFLICT (worker) DO UPDATE SET metrics = EXCLUDED.metrics, updated_at = EXCLUDED.updated_at""",
+            (worker, json.dumps(snapshot()), datetime.now(pytz.utc))
+        )
+    conn.commit()
+
+def _labels(**labels: object) -> str:
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def _histogram_lines(name: str, data: Dict, **labels: object) -> List[str]:
+    lines, cumulative = [], 0
+    for bound, count in zip(data['buckets'] + ['+Inf'], data['counts']):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_sum{_labels(**labels)} {data['sum']}")
+    lines.append(f"{name}_count{_labels(**labels)} {data['count']}")
+    return lines
+
+# Prometheus text exposition of the metrics published by the report workers, the number of reports in each status
+# and the stats of the serving process (its connection pool and so on), given by metric name prefix
+def render_metrics(workers: List[Tuple[str, Dict]], report_counts: Dict[str, int],
+                   server_stats: Dict[str, Dict[str, float]], server: str) -> str:
+    families: List[Tuple[str, str, str, List[str]]] = [
+        ('report_phase_seconds_total', 'counter', 'Seconds spent in each phase of report generation',
+         [f"report_phase_seconds_total{_labels(worker=worker, phase=phase)} {seconds}"
+          for worker, data in workers for phase, seconds in sorted(data['phase_seconds'].items())]),
+        ('report_store_seconds', 'histogram', 'Seconds to compute the report row of one store',
+         [line for worker, data in workers for engine, histogram in sorted(data['store_seconds'].items())
+          for line in _histogram_lines('report_store_seconds', histogram, worker=worker, engine=engine)]),
+        ('report_duration_seconds', 'histogram', 'Seconds to generate a report',
+         [line for worker, data in workers
+          for line in _histogram_lines('report_duration_seconds', data['report_seconds'], worker=worker)]),
+        ('reports_generated_total', 'counter', 'Reports generated, by final status',
+         [f"reports_generated_total{_labels(worker=worker, status=status)} {count}"
+          for worker, data in workers for status, count in sorted(data['reports_total'].items())]),
+        ('report_stores_total', 'counter', 'Stores of the reports generated',
+         [f"report_stores_total{_labels(worker=worker)} {data['stores_total']}" for worker, data in workers]),
+        ('log_messages_suppressed_total', 'counter', 'Log records dropped by the rate limit',
+         [f"log_messages_suppressed_total{_labels(worker=worker)} {data['log_messages_suppressed_total']}"
+          for worker, data in workers]),
+        ('report_reads_total', 'counter', 'Reports whose inputs were read from each replica or from the primary',
+         [f"report_reads_total{_labels(worker=worker, database=database)} {count}"
+          for worker, data in workers for database, count in sorted(data.get('report_reads_total', {}).items())]),
+        ('reports', 'gauge', 'Reports in each status',
+         [f"reports{_labels(status=status)} {count}" for status, count in sorted(report_counts.items())]),
+    ]
+    for prefix, stats in server_stats.items():
+        for key, value in sorted(stats.items()):
+            metric = f"{prefix}_{key}"
+            families.append((metric, 'counter' if key.endswith('_total') else 'gauge', f"{prefix}: {key}",
+                             [f"{metric}{_labels(server=server)} {value}"]))
+
+    lines = []
+    for name, metric_type, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+def profile_path(report_id: str, extension: str) -> str:
+    return os.path.join(PROFILES_DIR, f"{report_id}.{extension}")
+
+# Runs the body under a profiler and saves the profile to profiles/<report_id>: with cProfile the stats (.prof,
+# for pstats or snakeviz) and the top functions by cumulative time (.txt); with pyinstrument, if it is installed,
+# its call tree as text and html. Does nothing without a profiler.
+@contextlib.contextmanager
+def profiled(report_id: str, profiler: Optional[str]) -> Iterator[None]:
+    if not profiler:
+        yield
+        return
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument is not installed, profiling report %s with cProfile", report_id)
+        else:
+            sampler = Profiler()
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                with open(profile_path(report_id, 'txt'), 'w') as f:
+                    f.write(sampler.output_text())
+                with open(profile_path(report_id, 'html'), 'w') as f:
+                    f.write(sampler.output_html())
+                logger.info("Saved the profile of report %s to %s", report_id, profile_path(report_id, 'html'))
+            return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(profile_path(report_id, 'prof'))
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(50)
+        with open(profile_path(report_id, 'txt'), 'w') as f:
+            f.write(summary.getvalue())
+        logger.info("Saved the profile of report %s to %s", report_id, profile_path(report_id, 'prof'))
@@ -0,0 +1,251 @@
+import csv
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from app.report.rollup import invalidate
+
+# Tables the CSV files are loaded into, with the columns that identify a row. An upsert replaces the rows with the
+# same key: a poll by store and time, a timezone by store, and the business hours of a store as a whole.
+LOAD_KEYS = {
+    'store_status': ['store_id', 'timestamp_utc'],
+    'menu_hours': ['store_id'],
+    'timezones': ['store_id'],
+}
+
+# Keys that identify a single row. Rows repeated within the loaded files are kept once.
+UNIQUE_KEYS = {'store_status', 'timezones'}
+
+# replace: the table holds exactly the loaded rows. upsert: the loaded rows replace the rows with the same key.
+# append: only polls newer than their store's latest poll are added (store_status only).
+LOAD_MODES = ('replace', 'upsert', 'append')
+
+# Files are split into chunks of about this size, each copied on its own connection
+CHUNK_BYTES = int(os.environ.get('LOAD_CHUNK_BYTES', 64 * 1024 * 1024))
+
+# Number of processes copying chunks at the same time
+LOAD_WORKERS = int(os.environ.get('LOAD_WORKERS', os.cpu_count() or 1))
+
+# Size of the blocks files are scanned and sent to COPY in
+SCAN_BLOCK_BYTES = 1024 * 1024
+
+# Offset just past the first record ending at or after target, scanning from start, which must be the start of a
+# record. A newline ends a record only outside quotes, that is after an even number of quote characters ("" inside
+# a quoted field counts twice), so quoted fields containing newlines are never split.
+def _record_end(f, start: int, target: int) -> int:
+    f.seek(start)
+    quotes, position = 0, start
+    while position < target:
+        block = f.read(min(SCAN_BLOCK_BYTES, target - position))
+        if not block:
+            return position
+        quotes += block.count(b'"')
+        position += len(block)
+    while True:
+        block = f.read(SCAN_BLOCK_BYTES)
+        if not block:
+            return position
+        index = 0
+        while True:
+            newline = block.find(b'\n', index)
+            if newline < 0:
+                quotes += block.count(b'"', index)
+                position += len(block)
+                break
+            quotes += block.count(b'"', index, newline)
+            if quotes % 2 == 0:
+                return position + newline + 1
+            index = newline + 1
+
+# Reads the header of a CSV file and splits the rows after it into (start, end) byte ranges of whole records
+def split_chunks(csv_path: str, chunk_bytes: int = CHUNK_BYTES) -> Tuple[List[str], List[Tuple[int, int]]]:
+    file_size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as f:
+        header_end = _record_end(f, 0, 0)
+        f.seek(0)
+        header = next(csv.reader([f.read(header_end).decode('utf-8-sig')]))
+        chunks, start = [], header_end
+        while start < file_size:
+            end = _record_end(f, start, min(start + chunk_bytes, file_size))
+            chunks.append((start, end))
+            start = end
+    return [column.strip() for column in header], chunks
+
+# File-like view of a byte range, read by COPY
+class _ByteRange:
+    def __init__(self, f, start: int, end: int):
+        self.f = f
+        self.remaining = end - start
+        f.seek(start)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+# Runs in a loader process: copies one chunk of a file into the staging table and returns (rows, seconds)
+def copy_chunk(db_params: Dict[str, str], csv_path: str, staging_table: str, columns: List[str], start: int,
+               end: int) -> Tuple[int, float]:
+    started = time.perf_counter()
+    conn = psycopg2.connect(**db_params)
+    try:
+        column_list = ', '.join(psycopg2.extensions.quote_ident(column, conn) for column in columns)
+        with open(csv_path, 'rb') as f, conn.cursor() as cur:
+            cur.copy_expert(f"COPY {staging_table} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+                            _ByteRange(f, start, end), size=SCAN_BLOCK_BYTES)
+            rows = cur.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return rows, time.perf_counter() - started
+
+def _table_columns(cur, table_name: str) -> List[str]:
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND table_name = %s",
+        (table_name,)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+# Moves the staged rows into the table in one transaction, so readers see either the old or the new rows.
+# Returns (rows deleted, rows inserted).
+def apply_staged(cur, table_name: str, staging_table: str, columns: List[str], mode: str) -> Tuple[int, int]:
+    quote = lambda name: psycopg2.extensions.quote_ident(name, cur)
+    keys = LOAD_KEYS[table_name]
+    column_list = ', '.join(quote(column) for column in columns)
+    key_list = ', '.join(quote(key) for key in keys)
+    # Inserting in key order also fills the (store_id, timestamp_utc) index sequentially
+    if table_name in UNIQUE_KEYS:
+        staged_rows = f"SELECT DISTINCT ON ({key_list}) {column_list} FROM {staging_table} s"
+    else:
+        staged_rows = f"SELECT DISTINCT {column_list} FROM {staging_table} s"
+    order = f" ORDER BY {key_list}"
+
+    deleted = 0
+    if mode == 'replace':
+        if table_name == 'store_status':
+            invalidate(cur)
+        cur.execute(f"DELETE FROM {table_name}")
+        deleted = cur.rowcount
+        cur.execute(f"INSERT INTO {table_name} ({column_list}) {staged_rows}{order}")
+    elif mode == 'upsert':
+        if table_name == 'store_status':
+            cur.execute(f"SELECT DISTINCT store_id FROM {staging_table}")
+            invalidate(cur, [row[0] for row in cur.fetchall()])
+        key_match = ' AND '.join(f"t.{quote(key)} = s.{quote(key)}" for key in keys)
+        cur.execute(f"DELETE FROM {table_name} t USING (SELECT DISTINCT {key_list} FROM {staging_table}) s WHERE {key_match}")
+        deleted = cur.rowcount
+        cur.execute(f"INSERT INTO {table_name} ({column_list}) {staged_rows}{order}")
+    else:
+        # Polls at or before the store's latest poll are already loaded (or would be out of order for the rollups)
+        cur.execute(f"""
+            INSERT INTO {table_name} ({column_list}) {staged_rows}
+            WHERE NOT EXISTS (
+                SELECT 1 FROM store_status t WHERE t.store_id = s.store_id AND t.timestamp_utc >= s.timestamp_utc
+            ){order}
+        """)
+    return deleted, cur.rowcount
+
+# Bulk loader. Every file is split into chunks that are copied in parallel into an unlogged staging table per
+# target table; the staged rows are then applied to the target tables in a single transaction, so the tables,
+# their indexes and the queries running against them are never left half loaded. files are (table, csv path)
+# pairs, and several files may be loaded into the same table. Returns the row counts per table.
+def load_csv_files(db_params: Dict[str, str], files: List[Tuple[str, str]], mode: str = 'replace',
+                   workers: int = LOAD_WORKERS, chunk_bytes: int = CHUNK_BYTES) -> Dict[str, Dict[str, int]]:
+    from create_table import create_schema
+
+    if mode not in LOAD_MODES:
+        raise ValueError(f"Unknown load mode {mode}, expected one of {', '.join(LOAD_MODES)}")
+    for table_name, _ in files:
+        if table_name not in LOAD_KEYS:
+            raise ValueError(f"Unknown table {table_name}, expected one of {', '.join(LOAD_KEYS)}")
+        if mode == 'append' and table_name != 'store_status':
+            raise ValueError("Append loads only add store_status polls")
+
+    load_started = time.perf_counter()
+    conn = psycopg2.connect(**db_params)
+    staging_tables: Dict[str, str] = {}
+    try:
+        create_schema(conn)
+
+        # Every file of a table must have the same columns, all of them columns of the table
+        table_columns: Dict[str, List[str]] = {}
+        tasks = []
+        with conn.cursor() as cur:
+            for table_name, csv_path in files:
+                header, chunks = split_chunks(csv_path, chunk_bytes)
+                unknown = set(header) - set(_table_columns(cur, table_name))
+                if unknown:
+                    raise ValueError(f"{csv_path}: columns {', '.join(sorted(unknown))} are not columns of {table_name}")
+                if table_columns.setdefault(table_name, header) != header:
+                    raise ValueError(f"{csv_path}: columns differ from the other files loaded into {table_name}")
+                if table_name not in staging_tables:
+                    staging_tables[table_name] = f"{table_name}_load_{uuid.uuid4().hex[:8]}"
+                    column_list = ', '.join(psycopg2.extensions.quote_ident(column, cur) for column in header)
+                    cur.execute(f"CREATE UNLOGGED TABLE {staging_tables[table_name]} AS "
+                                f"SELECT {column_list} FROM {table_name} WITH NO DATA")
+                tasks.extend((table_name, csv_path, start, end) for start, end in chunks)
+        conn.commit()
+
+        print(f"Copying {len(files)} files in {len(tasks)} chunks with {min(workers, len(tasks)) or 1} processes")
+        copy_started = time.perf_counter()
+        staged_rows: Dict[str, int] = {table_name: 0 for table_name in staging_tables}
+        copy_args = [(db_params, csv_path, staging_tables[table_name], table_columns[table_name], start, end)
+                     for table_name, csv_path, start, end in tasks]
+        if workers <= 1 or len(tasks) <= 1:
+            results = [copy_chunk(*args) for args in copy_args]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(copy_chunk, *args): index for index, args in enumerate(copy_args)}
+                results = [None] * len(tasks)
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+        for (table_name, csv_path, start, end), (rows, seconds) in zip(tasks, results):
+            staged_rows[table_name] += rows
+        copy_seconds = time.perf_counter() - copy_started
+        total_staged = sum(staged_rows.values())
+        print(f"Copied {total_staged} rows in {copy_seconds:.1f}s ({total_staged / max(copy_seconds, 1e-9):,.0f} rows/s)")
+
+        apply_started = time.perf_counter()
+        counts: Dict[str, Dict[str, int]] = {}
+        with conn.cursor() as cur:
+            for table_name, staging_table in staging_tables.items():
+                deleted, inserted = apply_staged(cur, table_name, staging_table, table_columns[table_name], mode)
+                counts[table_name] = {'staged': staged_rows[table_name], 'deleted': deleted, 'inserted': inserted}
+                print(f"{table_name}: {mode} staged {staged_rows[table_name]} rows, deleted {deleted}, inserted {inserted}")
+        conn.commit()
+        apply_seconds = time.perf_counter() - apply_started
+        total_inserted = sum(table_counts['inserted'] for table_counts in counts.values())
+        print(f"Applied {total_inserted} rows in {apply_seconds:.1f}s ({total_inserted / max(apply_seconds, 1e-9):,.0f} rows/s)")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            with conn.cursor() as cur:
+                for staging_table in staging_tables.values():
+                    cur.execute(f"DROP TABLE IF EXISTS {staging_table}")
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Fresh statistics, and a visibility map so the report queries keep using index-only scans
+    conn = psycopg2.connect(**db_params)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for table_name in counts:
+                cur.execute(f"VACUUM ANALYZE {table_name}")
+    finally:
+        conn.close()
+    total_seconds = time.perf_counter() - load_started
+    total_inserted = sum(table_counts['inserted'] for table_counts in counts.values())
+    print(f"Loaded {total_inserted} rows in {total_seconds:.1f}s ({total_inserted / max(total_seconds, 1e-9):,.0f} rows/s overall)")
+    return counts
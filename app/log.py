@@ -0,0 +1,71 @@
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, Tuple
+
+# Level of the app's loggers. At DEBUG every store is logged as it is processed, which costs more than computing
+# some of them; the default logs once per report and batch.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Records a single logging call (one line of the source) may emit per second, after a burst of LOG_RATE_BURST.
+# The records over the limit are dropped, and the next one let through says how many were.
+LOG_RATE_LIMIT = float(os.environ.get('LOG_RATE_LIMIT', '5'))
+LOG_RATE_BURST = int(os.environ.get('LOG_RATE_BURST', '20'))
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s'
+
+# Token bucket per logging call site, so a warning repeated for every store cannot flood the output while
+# different messages still get through
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate: float = LOG_RATE_LIMIT, burst: int = LOG_RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[Tuple[str, int], Tuple[float, float, int]] = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, dropped = self.buckets.get(key, (float(self.burst), now, 0))
+            tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+            if tokens < 1.0:
+                self.buckets[key] = (tokens, now, dropped + 1)
+                self.suppressed += 1
+                return False
+            self.buckets[key] = (tokens - 1.0, now, 0)
+        if dropped:
+            record.msg = f"{record.getMessage()} ({dropped} similar messages suppressed)"
+            record.args = None
+        return True
+
+_rate_limit = RateLimitFilter()
+_configured = False
+_configure_lock = threading.Lock()
+
+# Logger of a module of the app (pass __name__). The 'app' logger writes to stdout through the rate limit; it is
+# set up on first use in every process, including the spawned workers.
+def get_logger(name: str) -> logging.Logger:
+    global _configured
+    if not _configured:
+        with _configure_lock:
+            if not _configured:
+                handler = logging.StreamHandler(sys.stdout)
+                handler.setFormatter(logging.Formatter(LOG_FORMAT))
+                handler.addFilter(_rate_limit)
+                root = logging.getLogger('app')
+                root.addHandler(handler)
+                root.setLevel(LOG_LEVEL)
+                root.propagate = False
+                _configured = True
+    return logging.getLogger(name)
+
+# Records dropped by the rate limit in this process
+def suppressed_messages() -> int:
+    return _rate_limit.suppressed
@@ -0,0 +1,151 @@
+from datetime import datetime
+import pytz
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.instrument import COMPUTE, DB_FETCH, timed_iter
+from app.log import get_logger
+from app.report.engines import StoreInputs, get_engine
+from app.report.pollstore import get_poll_store
+from app.report.metrics import BusinessHours, Poll, resolve_timezone, add_business_hours
+
+logger = get_logger(__name__)
+
+# Number of rows the server-side cursor transfers per network round-trip
+BULK_FETCH_SIZE = 20000
+
+# Number of stores handed to the report engine at once
+ENGINE_BATCH_SIZE = 2000
+
+# The columns are compared without casts (create_table.py migrates tables loaded from the CSV files to text store
+# ids and timestamptz polls), so the lookups use the (store_id, timestamp_utc) index.
+MAX_TIMESTAMPS_QUERY = """
+    SELECT store_id, MAX(timestamp_utc)
+    FROM store_status
+    WHERE store_id = ANY(%s)
+    GROUP BY store_id
+"""
+
+# Timezones from the store registry (app/report/stores.py), which mirrors the timezones table for every store with
+# polls and is looked up by its primary key. The uptime endpoints read the inputs of a store with the same queries.
+TIMEZONES_QUERY = "SELECT store_id, timezone_str FROM stores WHERE store_id = ANY(%s)"
+
+MENU_HOURS_QUERY = """
+    SELECT store_id, "dayOfWeek", start_time_local, end_time_local
+    FROM menu_hours
+    WHERE store_id = ANY(%s)
+"""
+
+# Same 7 day window as the per-store path, taken relative to each store's own latest poll
+WEEK_POLLS_QUERY = """
+    WITH bounds AS (
+        SELECT store_id, MAX(timestamp_utc) AS max_ts
+        FROM store_status
+        WHERE store_id = ANY(%s)
+        GROUP BY store_id
+    )
+    SELECT s.store_id, s.timestamp_utc, s.status
+    FROM store_status s
+    JOIN bounds b ON b.store_id = s.store_id
+    WHERE s.timestamp_utc >= b.max_ts - INTERVAL '7 days'
+    ORDER BY s.store_id, s.timestamp_utc
+"""
+
+# Timezone of every requested store, defaulting like the per-store path for stores without a row
+def fetch_timezones(conn, store_ids: List[str]) -> Dict[str, object]:
+    with conn.cursor() as cur:
+        cur.execute(TIMEZONES_QUERY, (store_ids,))
+        tz_strings = {str(store_id): tz_str for store_id, tz_str in cur.fetchall()}
+    return {store_id: resolve_timezone(store_id, tz_strings.get(store_id)) for store_id in store_ids}
+
+# Business hours of every requested store that has rows in menu_hours
+def fetch_business_hours(conn, store_ids: List[str]) -> Dict[str, BusinessHours]:
+    business_hours: Dict[str, BusinessHours] = {}
+    with conn.cursor() as cur:
+        cur.execute(MENU_HOURS_QUERY, (store_ids,))
+        for store_id, day_of_week, start_local, end_local in cur.fetchall():
+            add_business_hours(business_hours.setdefault(str(store_id), {}), day_of_week, start_local, end_local)
+    return business_hours
+
+# Loads the reference time, timezone and business hours of every requested store in three queries
+def fetch_store_inputs(conn, store_ids: List[str]) -> Tuple[Dict[str, datetime], Dict[str, object], Dict[str, BusinessHours]]:
+    with conn.cursor() as cur:
+        cur.execute(MAX_TIMESTAMPS_QUERY, (store_ids,))
+        max_times = {str(store_id): max_ts or datetime.now(pytz.utc) for store_id, max_ts in cur.fetchall()}
+    timezones = fetch_timezones(conn, list(max_times))
+    business_hours = fetch_business_hours(conn, store_ids)
+    return max_times, timezones, business_hours
+
+# Streams the last 7 days of polls of every requested store through a server-side cursor,
+# yielding one (store_id, polls) group at a time so only a single store is held in memory
+def iter_store_polls(conn, store_ids: List[str]) -> Iterator[Tuple[str, List[Poll]]]:
+    with conn.cursor(name='bulk_report_polls') as cur:
+        cur.itersize = BULK_FETCH_SIZE
+        cur.execute(WEEK_POLLS_QUERY, (store_ids,))
+        current_store_id = None
+        current_polls: List[Poll] = []
+        for store_id, timestamp_utc, status in cur:
+            store_id = str(store_id)
+            if store_id != current_store_id:
+                if current_store_id is not None:
+                    yield current_store_id, current_polls
+                current_store_id = store_id
+                current_polls = []
+            current_polls.append((timestamp_utc, status))
+        if current_store_id is not None:
+            yield current_store_id, current_polls
+
+# Bulk path: produces the same rows, in the same order, as calling the per-store path for each store. A row is
+# yielded as soon as the rows of every store before it in store_ids are done. The polls are streamed in store_id
+# order, so when store_ids is sorted the same way (ORDER BY store_id) only one engine batch is held in memory.
+def iter_bulk_report_rows(conn, store_ids: List[str], engine: Optional[str] = None) -> Iterator[List]:
+    compute_rows = get_engine(engine)
+    store_ids = list(dict.fromkeys(store_ids))
+    poll_store = get_poll_store()
+    if poll_store is not None:
+        # Report workers with the resident poll store read the polls and reference times from memory
+        with DB_FETCH:
+            max_times = poll_store.max_times(store_ids)
+            timezones = fetch_timezones(conn, list(max_times))
+            business_hours = fetch_business_hours(conn, store_ids)
+        store_polls_iter = timed_iter(poll_store.iter_store_polls(store_ids), DB_FETCH)
+    else:
+        with DB_FETCH:
+            max_times, timezones, business_hours = fetch_store_inputs(conn, store_ids)
+        store_polls_iter = timed_iter(iter_store_polls(conn, store_ids), DB_FETCH)
+    logger.info("Loaded inputs for %d of %d requested stores", len(max_times), len(store_ids))
+
+    def store_inputs(store_id: str, store_polls: List[Poll]) -> StoreInputs:
+        return StoreInputs(store_id, store_polls, business_hours.get(store_id, {}), timezones[store_id], max_times[store_id])
+
+    pending_rows: Dict[str, List] = {}
+    next_index = 0
+
+    def ready_rows() -> Iterator[List]:
+        nonlocal next_index
+        while next_index < len(store_ids):
+            store_id = store_ids[next_index]
+            if store_id not in max_times:
+                logger.warning("Store %s not found in store_status.", store_id)
+            elif store_id in pending_rows:
+                yield pending_rows.pop(store_id)
+            else:
+                return
+            next_index += 1
+
+    streamed = set()
+    batch: List[StoreInputs] = []
+    for store_id, store_polls in store_polls_iter:
+        streamed.add(store_id)
+        batch.append(store_inputs(store_id, store_polls))
+        if len(batch) >= ENGINE_BATCH_SIZE:
+            with COMPUTE:
+                pending_rows.update((row[0], row) for row in compute_rows(batch))
+            batch = []
+            yield from ready_rows()
+    batch.extend(store_inputs(store_id, []) for store_id in max_times if store_id not in streamed)
+    with COMPUTE:
+        pending_rows.update((row[0], row) for row in compute_rows(batch))
+    yield from ready_rows()
+
+def bulk_report_rows(conn, store_ids: List[str], engine: Optional[str] = None) -> List[List]:
+    return list(iter_bulk_report_rows(conn, store_ids, engine))
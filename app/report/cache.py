@@ -0,0 +1,97 @@
+import os
+from datetime import datetime
+import pytz
+from typing import List, Optional, Tuple
+
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+# Completed reports are kept as a cache of report files in reports/. When the files take more than
+# REPORT_CACHE_MAX_BYTES, or there are more than REPORT_CACHE_MAX_REPORTS of them, the least recently used reports
+# are deleted and marked 'Expired'.
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+REPORT_CACHE_MAX_REPORTS = int(os.environ.get('REPORT_CACHE_MAX_REPORTS', '1000'))
+
+# Serializes evictions of concurrent report workers
+EVICTION_LOCK_ID = 16234248
+
+# The latest poll plus the version of every input table, bumped by triggers (see create_table.py) whenever rows are
+# inserted, updated or deleted
+DATA_WATERMARK_QUERY = """
+    SELECT (SELECT MAX(timestamp_utc) FROM store_status),
+        (SELECT string_agg(table_name || '=' || version, ',' ORDER BY table_name) FROM data_versions)
+"""
+
+CACHED_REPORT_QUERY = """
+    SELECT report_id, report_path FROM reports
+    WHERE dedup_key = %s AND status = 'Complete' AND report_path IS NOT NULL
+    ORDER BY completed_at DESC
+    LIMIT 1
+"""
+
+# Most recently used first
+CACHED_REPORTS_QUERY = """
+    SELECT report_id, report_path FROM reports
+    WHERE status = 'Complete' AND report_path IS NOT NULL
+    ORDER BY COALESCE(last_used_at, completed_at, created_at) DESC
+"""
+
+def data_watermark(cur) -> str:
+    cur.execute(DATA_WATERMARK_QUERY)
+    max_timestamp, versions = cur.fetchone()
+    return f"{max_timestamp}|{versions or ''}"
+
+def touch_report(cur, report_id: str) -> None:
+    cur.execute("UPDATE reports SET last_used_at = %s WHERE report_id = %s", (datetime.now(pytz.utc), report_id))
+
+# An expired report can no longer be the base of a delta report (see app/report/delta.py), so its inputs go too
+def expire_reports(cur, report_ids: List[str]) -> None:
+    cur.execute("UPDATE reports SET status = 'Expired', report_path = NULL, inputs_stores = NULL "
+                "WHERE report_id = ANY(%s)", (report_ids,))
+    cur.execute("DELETE FROM report_inputs WHERE report_id = ANY(%s)", (report_ids,))
+
+# The completed report with the given key whose file is still on disk, marked as used. A report whose file was
+# deleted behind the cache's back is expired.
+def find_cached_report(cur, key: str) -> Optional[str]:
+    cur.execute(CACHED_REPORT_QUERY, (key,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    report_id, report_path = row
+    if not os.path.exists(report_path):
+        expire_reports(cur, [report_id])
+        return None
+    touch_report(cur, report_id)
+    return report_id
+
+# Deletes the least recently used report files until the rest fit the quota. The most recently used report is
+# always kept. Returns the ids of the expired reports.
+def evict_reports(conn, max_bytes: int = REPORT_CACHE_MAX_BYTES, max_reports: int = REPORT_CACHE_MAX_REPORTS) -> List[str]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (EVICTION_LOCK_ID,))
+        cur.execute(CACHED_REPORTS_QUERY)
+        kept, kept_bytes = 0, 0
+        evicted: List[Tuple[str, str]] = []
+        for report_id, report_path in cur.fetchall():
+            try:
+                size = os.path.getsize(report_path)
+            except OSError:
+                evicted.append((report_id, report_path))
+                continue
+            if kept and (kept + 1 > max_reports or kept_bytes + size > max_bytes):
+                evicted.append((report_id, report_path))
+                continue
+            kept += 1
+            kept_bytes += size
+        if evicted:
+            expire_reports(cur, [report_id for report_id, _ in evicted])
+    conn.commit()
+
+    # Files are removed once the rows no longer point at them; a download already streaming a file keeps reading it
+    for _, report_path in evicted:
+        if os.path.exists(report_path):
+            os.remove(report_path)
+    if evicted:
+        logger.info("Evicted %d cached reports, keeping %d reports (%d bytes)", len(evicted), kept, kept_bytes)
+    return [report_id for report_id, _ in evicted]
@@ -0,0 +1,165 @@
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, time as time_obj
+import pytz
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from app.instrument import BUSINESS_HOURS
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+BusinessHours = Dict[int, Tuple[time_obj, time_obj]]
+BusinessPeriod = Tuple[datetime, datetime]
+
+# Business hours used for days that have no row in menu_hours (open 24 hours)
+OPEN_ALL_DAY = (time_obj(0, 0), time_obj(23, 59, 59, 999999))
+
+# Maximum number of compiled calendars kept in memory
+CALENDAR_CACHE_SIZE = 100000
+
+# Business hours of a store compiled into UTC intervals for every local date of a date range.
+# Each local date has one opening period and, when both that day and the previous day close after midnight,
+# the UTC end of the previous day's shift. Lookups are binary searches, so no datetime is localized after
+# the calendar has been built.
+class BusinessCalendar:
+    def __init__(self, store_id: str, store_business_hours: BusinessHours, pytz_timezone,
+                 first_date: date, last_date: date):
+        self.store_id = store_id
+        self.store_business_hours = store_business_hours
+        self.pytz_timezone = pytz_timezone
+        self.first_date = first_date
+        self.last_date = last_date
+
+        self.dates: List[int] = []
+        self.opens: List[datetime] = []
+        self.closes: List[datetime] = []
+        self.overnight_ends: List[Optional[datetime]] = []
+        local_date = first_date
+        while local_date <= last_date:
+            opens_utc, closes_utc, overnight_end_utc = self._compile_day(local_date)
+            self.dates.append(local_date.toordinal())
+            self.opens.append(opens_utc)
+            self.closes.append(closes_utc)
+            self.overnight_ends.append(overnight_end_utc)
+            local_date += timedelta(days=1)
+
+    # Converts the business hours of one local date into UTC
+    def _compile_day(self, local_date: date) -> Tuple[datetime, datetime, Optional[datetime]]:
+        store_id, store_business_hours, pytz_timezone = self.store_id, self.store_business_hours, self.pytz_timezone
+        start_time_local, end_time_local = store_business_hours.get(local_date.weekday(), OPEN_ALL_DAY)
+
+        naive_start_local = datetime.combine(local_date, start_time_local)
+        naive_end_local = datetime.combine(local_date, end_time_local)
+        if end_time_local <= start_time_local:
+            naive_end_local += timedelta(days=1)
+
+        try:
+            start_utc = pytz_timezone.localize(naive_start_local, is_dst=None).astimezone(pytz.utc)
+            end_utc = pytz_timezone.localize(naive_end_local, is_dst=None).astimezone(pytz.utc)
+        except (pytz.exceptions.AmbiguousTimeError, pytz.exceptions.NonExistentTimeError) as e:
+            logger.warning("DST issue for store %s on %s: %s. Using fallback.", store_id, local_date, e)
+            try:
+                start_utc = pytz_timezone.localize(naive_start_local, is_dst=False).astimezone(pytz.utc)
+                end_utc = pytz_timezone.localize(naive_end_local, is_dst=False).astimezone(pytz.utc)
+            except:
+                start_utc = pytz_timezone.localize(naive_start_local + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
+                end_utc = pytz_timezone.localize(naive_end_local + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
+
+        # Set the end_time to next day in case this situation takes place (edge case)
+        overnight_end_utc = None
+        if end_time_local <= start_time_local:
+            prev_local_date = local_date - timedelta(days=1)
+            prev_start_local, prev_end_local = store_business_hours.get(prev_local_date.weekday(), OPEN_ALL_DAY)
+            if prev_end_local <= prev_start_local:
+                naive_prev_end = datetime.combine(local_date, prev_end_local)
+                try:
+                    overnight_end_utc = pytz_timezone.localize(naive_prev_end, is_dst=None).astimezone(pytz.utc)
+                except:
+                    overnight_end_utc = pytz_timezone.localize(naive_prev_end + timedelta(hours=1), is_dst=None).astimezone(pytz.utc)
+
+        return start_utc, end_utc, overnight_end_utc
+
+    # UTC business periods of a local date. The tail of the previous day's overnight shift starts at anchor_utc.
+    def periods_for_day(self, local_date: date, anchor_utc: datetime) -> List[BusinessPeriod]:
+        index = bisect_left(self.dates, local_date.toordinal())
+        if index < len(self.dates) and self.dates[index] == local_date.toordinal():
+            opens_utc, closes_utc, overnight_end_utc = self.opens[index], self.closes[index], self.overnight_ends[index]
+        else:
+            opens_utc, closes_utc, overnight_end_utc = self._compile_day(local_date)
+
+        business_periods = [(opens_utc, closes_utc)]
+        if overnight_end_utc is not None:
+            business_periods.append((anchor_utc, overnight_end_utc))
+        return business_periods
+
+    # Opening periods of the compiled range that overlap [start_utc, end_utc], in order
+    def intervals_between(self, start_utc: datetime, end_utc: datetime) -> List[BusinessPeriod]:
+        first = bisect_left(self.closes, start_utc)
+        last = bisect_right(self.opens, end_utc)
+        return [(self.opens[i], self.closes[i]) for i in range(first, last) if self.closes[i] >= start_utc]
+
+_calendar_cache: "OrderedDict[Tuple, Tuple[Hashable, BusinessCalendar]]" = OrderedDict()
+_calendar_cache_lock = threading.Lock()
+
+# Identifies the inputs a calendar was compiled from, so a calendar is rebuilt as soon as the
+# store's menu_hours or timezone change
+def calendar_version(store_business_hours: BusinessHours, pytz_timezone) -> Hashable:
+    return tuple(sorted(store_business_hours.items())), str(pytz_timezone)
+
+# Returns the calendar of a store for a local date range, compiling it only when the range has not been seen
+# yet or the business hours changed since it was compiled
+def business_calendar(store_id: str, store_business_hours: BusinessHours, pytz_timezone,
+                      first_date: date, last_date: date) -> BusinessCalendar:
+    key = (store_id, first_date, last_date)
+    version = calendar_version(store_business_hours, pytz_timezone)
+    with _calendar_cache_lock:
+        cached = _calendar_cache.get(key)
+        if cached and cached[0] == version:
+            _calendar_cache.move_to_end(key)
+            return cached[1]
+
+    calendar = BusinessCalendar(store_id, store_business_hours, pytz_timezone, first_date, last_date)
+    with _calendar_cache_lock:
+        _calendar_cache[key] = (version, calendar)
+        _calendar_cache.move_to_end(key)
+        while len(_calendar_cache) > CALENDAR_CACHE_SIZE:
+            _calendar_cache.popitem(last=False)
+    return calendar
+
+# Drops the compiled calendars of one store, or of every store, e.g. after menu_hours has been reloaded
+def invalidate_business_calendars(store_id: Optional[str] = None) -> None:
+    with _calendar_cache_lock:
+        if store_id is None:
+            _calendar_cache.clear()
+            return
+        for key in [key for key in _calendar_cache if key[0] == store_id]:
+            del _calendar_cache[key]
+
+# Business periods of the last hour and of every UTC day of the last week, relative to the reference time.
+# Each day is returned as (UTC midnight of the day, periods of the local date at that midnight).
+def report_periods(store_id: str, store_business_hours: BusinessHours, pytz_timezone,
+                   target_ref_time_utc: datetime) -> Tuple[List[BusinessPeriod], List[Tuple[datetime, List[BusinessPeriod]]]]:
+    with BUSINESS_HOURS:
+        one_week_ago_utc = target_ref_time_utc - timedelta(days=7)
+        last_hour_start_utc = target_ref_time_utc - timedelta(hours=1)
+
+        # Local dates can be one day off the UTC dates of the window
+        calendar = business_calendar(store_id, store_business_hours, pytz_timezone,
+                                     one_week_ago_utc.date() - timedelta(days=1),
+                                     target_ref_time_utc.date() + timedelta(days=1))
+
+        # Converts time to local timezone
+        last_hour_local_dt = last_hour_start_utc.astimezone(pytz_timezone)
+        hour_periods = calendar.periods_for_day(last_hour_local_dt.date(), last_hour_start_utc)
+
+        daily_periods = []
+        current_utc_date = one_week_ago_utc.date()
+        while current_utc_date <= target_ref_time_utc.date():
+            iter_utc_dt = pytz.utc.localize(datetime.combine(current_utc_date, time_obj.min))
+            iter_local_dt = iter_utc_dt.astimezone(pytz_timezone)
+            daily_periods.append((iter_utc_dt, calendar.periods_for_day(iter_local_dt.date(), iter_utc_dt)))
+            current_utc_date += timedelta(days=1)
+
+        return hour_periods, daily_periods
@@ -0,0 +1,235 @@
+import csv
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from psycopg2.extras import execute_values
+
+from app.log import get_logger
+from app.report.bulk import fetch_business_hours, fetch_timezones
+from app.report.metrics import REPORT_HEADER
+from app.report.rollup import hours_version
+from app.report.windows import WindowSpec
+
+logger = get_logger(__name__)
+
+# Delta reports. With REPORT_RECORD_INPUTS=1, a CSV report with the default windows records the inputs of every store
+# it covers in report_inputs: the store's latest poll, a digest of its polls in the week before it, and the version
+# of its business hours and timezone. A report's row of a store depends on nothing else, so a report requested with
+# a base_report_id reads the same inputs again, recomputes only the stores whose inputs differ from those recorded
+# with the base (or that the base does not cover) and copies the rows of the other stores from the base's CSV. The
+# report is the whole CSV ('full'), or only the rows that changed, were added or were removed since the base ('diff').
+
+# Reports record their inputs only with REPORT_RECORD_INPUTS=1; without it no report can be the base of a delta
+# report. Recording reads every store's week of polls again (about 2.5 s per 20,000 stores, a tenth of a full report)
+# and writes a row per store to report_inputs, so it is off unless delta reports are wanted.
+REPORT_RECORD_INPUTS = os.environ.get('REPORT_RECORD_INPUTS', '0') == '1'
+
+# Most recent reports whose inputs are kept (about 100 bytes a store); older reports can no longer be a base
+REPORT_INPUTS_KEEP = int(os.environ.get('REPORT_INPUTS_KEEP', '20'))
+
+DELTA_MODES = ('full', 'diff')
+
+# Columns of a diff report: a row of the report and what happened to it since the base, 'added', 'changed' or
+# 'removed' (with the base's numbers)
+DIFF_HEADER = REPORT_HEADER + ['change']
+
+# Latest poll of each store and a digest of its polls in the 7 days up to it, the window every report path reads:
+# the number of polls and of active polls and the summed ages of both, so adding, deleting or moving a poll or
+# changing its status changes the digest. Both are read from the (store_id, timestamp_utc) index alone.
+POLL_WATERMARKS_QUERY = """
+    SELECT s.store_id, w.last_poll_utc, d.polls_digest
+    FROM unnest(%s::text[]) s(store_id)
+    CROSS JOIN LATERAL (
+        SELECT MAX(p.timestamp_utc) AS last_poll_utc FROM store_status p WHERE p.store_id = s.store_id
+    ) w
+    CROSS JOIN LATERAL (
+        SELECT concat_ws(':', count(*), count(*) FILTER (WHERE p.status = 'active'),
+                         sum(w.last_poll_utc - p.timestamp_utc),
+                         sum(w.last_poll_utc - p.timestamp_utc) FILTER (WHERE p.status = 'active')) AS polls_digest
+        FROM store_status p
+        WHERE p.store_id = s.store_id AND p.timestamp_utc >= w.last_poll_utc - INTERVAL '7 days'
+    ) d
+    WHERE w.last_poll_utc IS NOT NULL
+"""
+
+INSERT_INPUTS_QUERY = """
+    INSERT INTO report_inputs (report_id, store_id, last_poll_utc, polls_digest, hours_version) VALUES %s
+"""
+
+REPORT_INPUTS_QUERY = """
+    SELECT store_id, last_poll_utc, polls_digest, hours_version FROM report_inputs WHERE report_id = %s
+"""
+
+# Drops the inputs of all but the REPORT_INPUTS_KEEP most recently completed reports that have them
+PRUNE_INPUTS_QUERY = """
+    WITH stale AS (
+        UPDATE reports SET inputs_stores = NULL
+        WHERE report_id IN (
+            SELECT report_id FROM reports WHERE inputs_stores IS NOT NULL ORDER BY completed_at DESC OFFSET %s
+        )
+        RETURNING report_id
+    )
+    DELETE FROM report_inputs WHERE report_id IN (SELECT report_id FROM stale)
+"""
+
+# Read by /trigger_report on both servers and again when the delta report runs
+BASE_REPORT_QUERY = "SELECT status, report_path, params, inputs_stores FROM reports WHERE report_id = %s"
+
+class StoreInputsVersion(NamedTuple):
+    last_poll_utc: datetime
+    polls_digest: str
+    hours_version: str
+
+InputVersions = Dict[str, StoreInputsVersion]
+
+# Delta options of a report request: "base_report_id" and "delta" ('full', the default, or 'diff'). None without a
+# base report. Raises ValueError for a malformed request or options a delta report does not support.
+def parse_delta(data: Optional[Dict], windows: Optional[WindowSpec] = None,
+                output: Optional[Dict[str, str]] = None) -> Optional[Dict[str, str]]:
+    base_report_id = data.get('base_report_id') if data else None
+    mode = (data.get('delta') if data else None) or 'full'
+    if not base_report_id:
+        if data and data.get('delta'):
+            raise ValueError("delta needs a base_report_id")
+        return None
+    if not isinstance(base_report_id, str) or not base_report_id.isalnum():
+        raise ValueError("base_report_id must be the id of a report")
+    if mode not in DELTA_MODES:
+        raise ValueError(f"Unknown delta {mode}. Available deltas: {', '.join(DELTA_MODES)}")
+    if windows is not None or output is not None:
+        raise ValueError("Delta reports are CSV files with the default windows")
+    return {'base_report_id': base_report_id, 'mode': mode}
+
+# Part of the dedup key of a delta report
+def delta_key(delta: Dict[str, str]) -> str:
+    return f"base:{delta['base_report_id']}:{delta['mode']}"
+
+# Whether a report records its inputs, which only full CSV reports with the default windows do
+def records_inputs(windows: Optional[WindowSpec], output: Optional[Dict[str, str]],
+                   delta: Optional[Dict[str, str]] = None) -> bool:
+    return REPORT_RECORD_INPUTS and windows is None and output is None and (delta is None or delta['mode'] == 'full')
+
+# Why the report of a BASE_REPORT_QUERY row cannot be the base of a delta report from the given source, or None
+def base_report_problem(row: Tuple, source: str) -> Optional[str]:
+    status, report_path, params, inputs_stores = row
+    if isinstance(params, str):
+        params = json.loads(params)
+    if status == 'Expired':
+        return "The base report was evicted from the cache"
+    if status != 'Complete' or not report_path:
+        return f"The base report is {status}, not Complete"
+    if inputs_stores is None and not REPORT_RECORD_INPUTS:
+        return ("The base report has no recorded inputs: REPORT_RECORD_INPUTS is off, so reports do not record them. "
+                "Set REPORT_RECORD_INPUTS=1 to use delta reports")
+    if inputs_stores is None:
+        return (f"The base report has no recorded inputs: only CSV reports with the default windows record them, "
+                f"and only the latest {REPORT_INPUTS_KEEP} keep them")
+    base_source = (params or {}).get('source') or 'raw'
+    if base_source != source:
+        return f"The base report was computed from the {base_source} source"
+    if not os.path.exists(report_path):
+        return "The base report's file was not found"
+    return None
+
+# Inputs of the given stores that have polls. The timezones and business hours are read like the bulk path does.
+def read_input_versions(conn, store_ids: List[str]) -> InputVersions:
+    with conn.cursor() as cur:
+        cur.execute(POLL_WATERMARKS_QUERY, (store_ids,))
+        watermarks = {store_id: (last_poll_utc, polls_digest) for store_id, last_poll_utc, polls_digest in cur.fetchall()}
+    polled = list(watermarks)
+    timezones = fetch_timezones(conn, polled)
+    business_hours = fetch_business_hours(conn, polled)
+    return {store_id: StoreInputsVersion(last_poll_utc, polls_digest,
+                                         hours_version(business_hours.get(store_id, {}), timezones[store_id]))
+            for store_id, (last_poll_utc, polls_digest) in watermarks.items()}
+
+# Records the inputs of a completed report, in its transaction, and drops those of older reports
+def record_inputs(cur, report_id: str, versions: InputVersions) -> None:
+    execute_values(cur, INSERT_INPUTS_QUERY,
+                   [(report_id, store_id) + tuple(version) for store_id, version in versions.items()], page_size=5000)
+    cur.execute("UPDATE reports SET inputs_stores = %s WHERE report_id = %s", (len(versions), report_id))
+    cur.execute(PRUNE_INPUTS_QUERY, (REPORT_INPUTS_KEEP,))
+
+def load_input_versions(cur, report_id: str) -> InputVersions:
+    cur.execute(REPORT_INPUTS_QUERY, (report_id,))
+    return {store_id: StoreInputsVersion(last_poll_utc, polls_digest, version)
+            for store_id, last_poll_utc, polls_digest, version in cur.fetchall()}
+
+# Rows of a CSV report by store id, as the text of the file
+def read_report_rows(report_path: str) -> Dict[str, List[str]]:
+    with open(report_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        if next(reader, None) != REPORT_HEADER:
+            raise ValueError(f"{report_path} is not a CSV report with the default windows")
+        return {row[0]: row for row in reader}
+
+# A computed row as the CSV writer writes it, to compare it with a row read back from a report
+def csv_values(row: List) -> List[str]:
+    return ['' if value is None else str(value) for value in row]
+
+# Stores whose row has to be computed again: those with inputs other than the base's, and those with polls the base
+# has no row for
+def affected_stores(store_ids: List[str], versions: InputVersions, base_versions: InputVersions,
+                    base_rows: Dict[str, List[str]]) -> List[str]:
+    return [store_id for store_id in store_ids
+            if versions.get(store_id) != base_versions.get(store_id) or (store_id in versions and store_id not in base_rows)]
+
+# Rows of the delta report in the order of store_ids: the recomputed rows of the affected stores (in that order too)
+# merged with the base's rows of the others. A diff only has the rows that differ from the base, and the base's rows
+# of stores left out of the report at the end.
+def iter_delta_rows(store_ids: List[str], affected: Set[str], recomputed: Iterator[List],
+                    base_rows: Dict[str, List[str]], diff: bool) -> Iterator[List]:
+    recomputed = iter(recomputed)
+    pending = next(recomputed, None)
+    for store_id in store_ids:
+        if store_id not in affected:
+            if not diff and store_id in base_rows:
+                yield base_rows[store_id]
+            continue
+        row = None
+        if pending is not None and pending[0] == store_id:
+            row, pending = pending, next(recomputed, None)
+        base_row = base_rows.get(store_id)
+        if not diff:
+            if row is not None:
+                yield row
+        elif row is None:
+            if base_row is not None:
+                yield base_row + ['removed']
+        elif base_row is None:
+            yield row + ['added']
+        elif csv_values(row) != base_row:
+            yield row + ['changed']
+    if diff:
+        selected = set(store_ids)
+        for store_id, base_row in base_rows.items():
+            if store_id not in selected:
+                yield base_row + ['removed']
+
+# Writes a delta report of store_ids against its base, given the current inputs of the stores. The affected stores
+# are computed by the requested path in one go, their rows read through read_conn (a replica, see app/db.py) when
+# given; the base report and its inputs are always read from conn. Returns the stores recomputed and the rows written.
+def write_delta_report(conn, report_filepath: str, store_ids: List[str], delta: Dict[str, str],
+                       versions: InputVersions, bulk: bool, engine: Optional[str], rollup: bool,
+                       read_conn=None) -> Dict[str, int]:
+    from app.api.endpoints import iter_report_rows, write_report_csv
+
+    base_report_id = delta['base_report_id']
+    with conn.cursor() as cur:
+        cur.execute(BASE_REPORT_QUERY, (base_report_id,))
+        row = cur.fetchone()
+        problem = base_report_problem(row, 'rollup' if rollup else 'raw') if row else "The base report was not found"
+        if problem:
+            raise ValueError(f"Report {base_report_id}: {problem}")
+        base_versions = load_input_versions(cur, base_report_id)
+    base_rows = read_report_rows(row[1])
+    affected = affected_stores(store_ids, versions, base_versions, base_rows)
+    logger.info("Delta of report %s: recomputing %d of %d stores", base_report_id, len(affected), len(store_ids))
+
+    recomputed = iter_report_rows(read_conn or conn, affected, bulk, engine, rollup) if affected else iter(())
+    diff = delta['mode'] == 'diff'
+    rows = iter_delta_rows(store_ids, set(affected), recomputed, base_rows, diff)
+    row_count = write_report_csv(report_filepath, rows, columns=DIFF_HEADER if diff else REPORT_HEADER)
+    return {'recomputed': len(affected), 'rows': row_count}
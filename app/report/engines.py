@@ -0,0 +1,60 @@
+import os
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from app.instrument import observe_store_seconds
+from app.log import get_logger
+from app.report.metrics import BusinessHours, Poll, compute_store_metrics
+
+logger = get_logger(__name__)
+
+# Everything needed to compute the report row of one store
+class StoreInputs(NamedTuple):
+    store_id: str
+    polls: List[Poll]
+    business_hours: BusinessHours
+    timezone: object
+    ref_time: datetime
+
+Engine = Callable[[List[StoreInputs]], List[List]]
+
+# Engine used when a report does not ask for one: 'python' or 'numpy'
+DEFAULT_ENGINE = os.environ.get('REPORT_ENGINE', 'python')
+
+# Reference implementation: walks the polls of each store with datetime objects
+def python_engine(stores: List[StoreInputs]) -> List[List]:
+    rows = []
+    for store in stores:
+        started = time.perf_counter()
+        rows.append(compute_store_metrics(store.store_id, store.polls, store.business_hours, store.timezone,
+                                          store.ref_time))
+        observe_store_seconds('python', time.perf_counter() - started)
+    return rows
+
+# Vectorized implementation over int64 epoch arrays, computing a whole batch of stores at once. The cost of a store
+# is the batch's time divided by its stores.
+def numpy_engine(stores: List[StoreInputs]) -> List[List]:
+    from app.report.vectorized import compute_batch_metrics
+    started = time.perf_counter()
+    rows = compute_batch_metrics(stores)
+    if stores:
+        observe_store_seconds('numpy', (time.perf_counter() - started) / len(stores), len(stores))
+    return rows
+
+ENGINES: Dict[str, Engine] = {
+    'python': python_engine,
+    'numpy': numpy_engine,
+}
+
+def get_engine(name: Optional[str] = None) -> Engine:
+    name = name or DEFAULT_ENGINE
+    if name not in ENGINES:
+        raise ValueError(f"Unknown report engine '{name}'. Available engines: {', '.join(ENGINES)}")
+    if name == 'numpy':
+        try:
+            import numpy
+        except ImportError:
+            logger.warning("numpy is not installed. Falling back to the python report engine.")
+            return python_engine
+    return ENGINES[name]
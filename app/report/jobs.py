@@ -0,0 +1,287 @@
+import atexit
+import json
+import multiprocessing
+import os
+import select
+import threading
+import time
+import uuid
+from datetime import datetime
+import pytz
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+
+from app.db import connect, get_db_params
+from app.instrument import REPORT_PROFILE, profiled, publish_metrics
+from app.log import get_logger
+from app.report.cache import data_watermark, find_cached_report
+from app.report.delta import delta_key
+from app.report.pollstore import POLL_STORE, PollStore, enable_poll_store, get_poll_store, worker_name
+from app.report.stores import resolve_store_ids, selection_key
+from app.report.windows import WindowSpec, spec_from_params, spec_key, spec_params
+from app.report.formats import output_key
+
+logger = get_logger(__name__)
+
+# Report jobs are queued as rows of the reports table with status 'Queued' and the report options in params, so
+# pending reports survive a restart. A fixed pool of worker processes claims them one at a time; the interval math
+# is CPU bound, so the default is one worker per core.
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', os.cpu_count() or 1))
+
+# Seconds an idle worker waits for a notification before looking at the queue again
+QUEUE_POLL_INTERVAL = float(os.environ.get('REPORT_QUEUE_POLL_INTERVAL', '5'))
+
+# Channel notified whenever a report is queued
+QUEUE_CHANNEL = 'report_jobs'
+
+# A worker holds the advisory lock (JOB_LOCK_CLASS, hashtext(report_id)) while it runs a report. A 'Running' report
+# whose lock is free belonged to a worker that died, and is queued again.
+JOB_LOCK_CLASS = 4815
+
+# Identical requests share a report while it is queued or running, and completed reports with the same key are
+# served from the report cache
+ENQUEUE_QUERY = """
+    INSERT INTO reports (report_id, store_id, status, created_at, params, dedup_key)
+    VALUES (%s, %s, 'Queued', %s, %s, %s)
+    ON CONFLICT (dedup_key) WHERE status IN ('Queued', 'Running') DO NOTHING
+    RETURNING report_id
+"""
+
+PENDING_DUPLICATE_QUERY = "SELECT report_id FROM reports WHERE dedup_key = %s AND status IN ('Queued', 'Running')"
+
+# Claims the oldest queued report and takes its lock in the same statement, so it is never seen running unlocked
+CLAIM_QUERY = """
+    WITH job AS (
+        SELECT report_id FROM reports
+        WHERE status = 'Queued'
+        ORDER BY created_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE reports r SET status = 'Running', started_at = %s
+    FROM job
+    WHERE r.report_id = job.report_id
+    RETURNING r.report_id, r.store_id, r.params, pg_advisory_lock(%s, hashtext(r.report_id))
+"""
+
+# Reports started directly by generate_report_logic have no params and are left alone
+REQUEUE_ORPHANS_QUERY = """
+    UPDATE reports SET status = 'Queued', started_at = NULL
+    WHERE status = 'Running' AND params IS NOT NULL AND pg_try_advisory_xact_lock(%s, hashtext(report_id))
+    RETURNING report_id
+"""
+
+# Identifies the content of a report: the stores (a store id or the key of a selection), the source and the data
+# watermark (latest poll and versions of the input tables), so a request made after the data changed gets a fresh
+# report. The engines and the bulk and per-store paths produce the same rows, so they are not part of the key.
+def dedup_key(cur, stores: str, source: str) -> str:
+    return '|'.join([stores, source, data_watermark(cur)])
+
+# Source part of the dedup key, with the windows and as-of time of a report with custom windows (see
+# app/report/windows.py), the format of a columnar report (see app/report/formats.py) and the base and mode of a
+# delta report (see app/report/delta.py)
+def report_variant(source: str, windows: Optional[WindowSpec] = None, output: Optional[Dict[str, str]] = None,
+                   delta: Optional[Dict[str, str]] = None) -> str:
+    parts = [source]
+    if windows is not None:
+        parts.append(spec_key(windows))
+    if output is not None:
+        parts.append(output_key(output))
+    if delta is not None:
+        parts.append(delta_key(delta))
+    return ';'.join(parts)
+
+# Returns the report serving this request and how: 'cached' (a completed report with the same key), 'pending' (an
+# identical report already queued or running) or 'queued'. A report is on a single store, or on the stores of a
+# selection (see app/report/stores.py; every store when None) as one batched job. The number of shard processes does
+# not change the report, so it is not part of the key, and neither is the profiler: a request to profile a report
+# that is cached or pending gets that report, unprofiled.
+def enqueue_report(conn, store_id: Optional[str], engine: Optional[str], bulk: bool, source: str,
+                   shards: int = 1, profile: Optional[str] = None,
+                   selection: Optional[Dict[str, List[str]]] = None,
+                   windows: Optional[WindowSpec] = None,
+                   output: Optional[Dict[str, str]] = None,
+                   delta: Optional[Dict[str, str]] = None) -> Tuple[str, str]:
+    params = {'engine': engine, 'bulk': bulk, 'source': source, 'shards': shards, 'profile': profile,
+              'stores': selection, 'windows': spec_params(windows), 'output': output, 'delta': delta}
+    with conn.cursor() as cur:
+        key = dedup_key(cur, store_id or selection_key(selection), report_variant(source, windows, output, delta))
+        cached_report_id = find_cached_report(cur, key)
+        if cached_report_id:
+            conn.commit()
+            return cached_report_id, 'cached'
+        while True:
+            report_id = uuid.uuid4().hex
+            cur.execute(ENQUEUE_QUERY, (report_id, store_id, datetime.now(pytz.utc), json.dumps(params), key))
+            if cur.fetchone():
+                cur.execute(f"NOTIFY {QUEUE_CHANNEL}")
+                conn.commit()
+                return report_id, 'queued'
+            cur.execute(PENDING_DUPLICATE_QUERY, (key,))
+            row = cur.fetchone()
+            conn.commit()
+            # The duplicate may have finished in between, in which case the report is queued after all
+            if row:
+                return row[0], 'pending'
+
+def requeue_orphans(conn) -> List[str]:
+    with conn.cursor() as cur:
+        cur.execute(REQUEUE_ORPHANS_QUERY, (JOB_LOCK_CLASS,))
+        report_ids = [row[0] for row in cur.fetchall()]
+        if report_ids:
+            cur.execute(f"NOTIFY {QUEUE_CHANNEL}")
+    conn.commit()
+    return report_ids
+
+def claim_report(conn) -> Optional[Tuple[str, Optional[str], Dict]]:
+    with conn.cursor() as cur:
+        cur.execute(CLAIM_QUERY, (datetime.now(pytz.utc), JOB_LOCK_CLASS))
+        row = cur.fetchone()
+    conn.commit()
+    return row[:3] if row else None
+
+def release_report(conn, report_id: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (JOB_LOCK_CLASS, report_id))
+    conn.commit()
+
+def fail_report(conn, report_id: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute("UPDATE reports SET status = 'Error', completed_at = %s WHERE report_id = %s",
+                    (datetime.now(pytz.utc), report_id))
+    conn.commit()
+
+def _wait_for_jobs(conn) -> None:
+    if select.select([conn], [], [], QUEUE_POLL_INTERVAL) != ([], [], []):
+        conn.poll()
+        conn.notifies.clear()
+
+# Runs one claimed report on a pooled connection, which generate_report_logic gives back when it is done. If the
+# work before it fails, the connection is given back here, so a database error does not use up the pool.
+def run_report(report_id: str, store_id: Optional[str], params: Dict) -> None:
+    from app.api.endpoints import generate_report_logic
+
+    conn = connect()
+    generating = False
+    try:
+        poll_store = get_poll_store()
+        if poll_store is not None:
+            # Bring the resident polls up to date before the report reads them
+            poll_store.refresh(conn)
+        if store_id:
+            store_ids = [store_id]
+        else:
+            with conn.cursor() as cur:
+                # The stores selected when the report was requested, from the store registry. In the order the bulk
+                # path streams the polls, so report rows are written as they are computed.
+                store_ids = resolve_store_ids(cur, params.get('stores'))
+        with profiled(report_id, params.get('profile') or REPORT_PROFILE):
+            generating = True
+            generate_report_logic(report_id, conn, store_ids, params['bulk'], params['engine'],
+                                  params['source'] == 'rollup', params.get('shards', 1),
+                                  spec_from_params(params.get('windows')), params.get('output'), params.get('delta'))
+    except BaseException:
+        if not generating:
+            conn.close()
+        raise
+
+def refresh_poll_store(poll_store: PollStore, worker_index: int) -> None:
+    conn = connect()
+    try:
+        poll_store.refresh(conn)
+        poll_store.publish_stats(conn, worker_name(worker_index))
+    finally:
+        conn.close()
+
+# Main loop of a worker process: claims queued reports one at a time and sleeps until notified when there are none.
+# The queue connection LISTENs and holds the job locks for the life of the worker, so it is not taken from the pool.
+def worker_main(worker_index: int) -> None:
+    logger.info("Report worker %d started (pid %d)", worker_index, os.getpid())
+    queue_conn = None
+    # Loaded on the first pass of the loop and refreshed while the worker is idle
+    poll_store = enable_poll_store() if POLL_STORE else None
+    while True:
+        try:
+            if queue_conn is None or queue_conn.closed:
+                queue_conn = psycopg2.connect(**get_db_params())
+                with queue_conn.cursor() as cur:
+                    cur.execute(f"LISTEN {QUEUE_CHANNEL}")
+                queue_conn.commit()
+                publish_metrics(queue_conn, worker_name(worker_index))
+
+            if poll_store is not None and poll_store.refresh_due():
+                refresh_poll_store(poll_store, worker_index)
+
+            for report_id in requeue_orphans(queue_conn):
+                logger.warning("Report worker %d: requeued report %s of a stopped worker", worker_index, report_id)
+
+            job = claim_report(queue_conn)
+            if job is None:
+                _wait_for_jobs(queue_conn)
+                continue
+
+            report_id, store_id, params = job
+            logger.info("Report worker %d: generating report %s", worker_index, report_id)
+            try:
+                run_report(report_id, store_id, params)
+            except psycopg2.OperationalError:
+                # Left running: the report is queued again once the database is reachable
+                raise
+            except Exception as e:
+                logger.error("Report worker %d: report %s failed: %s", worker_index, report_id, e)
+                fail_report(queue_conn, report_id)
+            finally:
+                release_report(queue_conn, report_id)
+            # Read by /metrics on the web servers
+            publish_metrics(queue_conn, worker_name(worker_index))
+        except psycopg2.OperationalError as e:
+            logger.error("Report worker %d: database error: %s", worker_index, e)
+            if queue_conn is not None:
+                queue_conn.close()
+            queue_conn = None
+            time.sleep(QUEUE_POLL_INTERVAL)
+
+# Fixed-size pool of report worker processes. The processes are spawned rather than forked, so they do not inherit
+# the connections or threads of the web server, and a supervisor thread replaces workers that exit. Workers start
+# shard processes of their own, which daemon processes may not do, so they are stopped when the server exits.
+class ReportWorkerPool:
+    def __init__(self, workers: int = REPORT_WORKERS):
+        self.workers = workers
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.stopping = threading.Event()
+        self.supervisor: Optional[threading.Thread] = None
+
+    def _start_worker(self, worker_index: int) -> None:
+        context = multiprocessing.get_context('spawn')
+        process = context.Process(target=worker_main, args=(worker_index,), name=f"report-worker-{worker_index}")
+        process.start()
+        self.processes[worker_index] = process
+
+    def _supervise(self) -> None:
+        while not self.stopping.wait(QUEUE_POLL_INTERVAL):
+            for worker_index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning("Report worker %d exited with code %s, restarting it", worker_index, process.exitcode)
+                    self._start_worker(worker_index)
+
+    def start(self) -> None:
+        for worker_index in range(self.workers):
+            self._start_worker(worker_index)
+        self.supervisor = threading.Thread(target=self._supervise, daemon=True, name='report-worker-supervisor')
+        self.supervisor.start()
+        atexit.register(self.stop)
+        logger.info("Started %d report workers", self.workers)
+
+    def join(self) -> None:
+        self.supervisor.join()
+
+    def stop(self) -> None:
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.supervisor.join()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
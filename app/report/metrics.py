@@ -0,0 +1,144 @@
+import functools
+import pytz
+from datetime import datetime, timedelta, time as time_obj
+from typing import List, Tuple, Optional
+
+from app.log import get_logger
+from app.report.calendar import BusinessHours, report_periods
+
+logger = get_logger(__name__)
+
+# Columns of the generated report, in output order
+REPORT_HEADER = ['store_id', 'uptime_last_hour(minutes)', 'uptime_last_day(hours)', 'uptime_last_week(hours)',
+                 'downtime_last_hour(minutes)', 'downtime_last_day(hours)', 'downtime_last_week(hours)']
+
+# Stores without a row in the timezones table are assumed to be in America/Chicago
+DEFAULT_TIMEZONE = 'America/Chicago'
+
+Poll = Tuple[datetime, str]
+
+# Timezone objects by name. pytz.timezone normalizes and looks up the name on every call; the report paths
+# resolve the timezone of every store, so each name is looked up once per process.
+@functools.lru_cache(maxsize=None)
+def _timezone(tz_str: str):
+    return pytz.timezone(tz_str)
+
+def resolve_timezone(store_id: str, tz_str: Optional[str]):
+    # Set default timezones as America/Chicago
+    tz_str = tz_str or DEFAULT_TIMEZONE
+    try:
+        return _timezone(tz_str)
+    except pytz.exceptions.UnknownTimeZoneError:
+        logger.warning("Unknown timezone '%s' for store %s. Defaulting to %s.", tz_str, store_id, DEFAULT_TIMEZONE)
+        return _timezone(DEFAULT_TIMEZONE)
+
+def add_business_hours(store_business_hours: BusinessHours, day_of_week: int, start_local: time_obj, end_local: time_obj) -> None:
+    # datetime.time doesn't read the time properly if the store closes at midnight so we address this edge case
+    end_local = time_obj(23, 59, 59, 999999) if end_local == time_obj(0, 0) else end_local
+    store_business_hours[day_of_week] = (start_local, end_local)
+
+# Computes one report row from the polls of the last 7 days (sorted by time), the business hours
+# and the timezone of a store. The reference time is the latest poll of the store.
+def compute_store_metrics(store_id: str, store_polls: List[Poll], store_business_hours: BusinessHours,
+                          pytz_timezone, max_utc_from_data: datetime) -> List:
+    # The target time in this case is the max timestamp
+    target_ref_time_utc = max_utc_from_data
+    last_hour_start_utc = target_ref_time_utc - timedelta(hours=1)
+
+    logger.debug("Processing store %s", store_id)
+
+    # output parameters
+    total_uptime_last_hour_s = 0
+    total_active_time_in_business_last_hour_s = 0
+    total_uptime_last_day_s = 0
+    total_active_time_in_business_last_day_s = 0
+    total_uptime_last_week_s = 0
+    total_active_time_in_business_last_week_s = 0
+
+    hour_periods, daily_periods = report_periods(store_id, store_business_hours, pytz_timezone, target_ref_time_utc)
+
+    # Calculate uptime for the last hour
+    # For each poll we calculate the duration of the poll to find the total uptime
+    for business_opens_utc, business_closes_utc in hour_periods:
+        if business_closes_utc < last_hour_start_utc or business_opens_utc > target_ref_time_utc:
+            continue
+        store_hour_polls = [
+            (ts, status) for ts, status in store_polls
+            if last_hour_start_utc - timedelta(hours=1) <= ts <= target_ref_time_utc + timedelta(hours=1)
+        ]
+        events = [(last_hour_start_utc, 'SYSTEM_OPEN')] + store_hour_polls + [(target_ref_time_utc, 'SYSTEM_CLOSE')]
+        events.sort(key=lambda x: x[0])
+
+        current_status = 'inactive'
+        last_poll_before = next((p for p in store_polls if p[0] < last_hour_start_utc), None)
+        if last_poll_before:
+            current_status = last_poll_before[1]
+
+        prev_event_time = last_hour_start_utc
+        for event_time, event_type in events:
+            actual_event_time = max(last_hour_start_utc, min(event_time, target_ref_time_utc))
+            actual_event_time = max(actual_event_time, business_opens_utc)
+            actual_event_time = min(actual_event_time, business_closes_utc)
+            if actual_event_time > prev_event_time:
+                duration_s = (actual_event_time - prev_event_time).total_seconds()
+                if current_status == 'active':
+                    total_uptime_last_hour_s += duration_s
+                total_active_time_in_business_last_hour_s += duration_s
+            if event_type not in ['SYSTEM_OPEN', 'SYSTEM_CLOSE']:
+                current_status = event_type
+            elif event_type == 'SYSTEM_CLOSE':
+                current_status = 'inactive'
+            prev_event_time = actual_event_time
+
+    # Calculate uptime for the last day and the last week
+    for iter_utc_dt, business_periods in daily_periods:
+        daily_uptime_s = 0
+        total_business_seconds_for_day = 0
+        for business_opens_utc, business_closes_utc in business_periods:
+            store_day_polls = [
+                (ts, status) for ts, status in store_polls
+                if business_opens_utc - timedelta(hours=1) <= ts <= business_closes_utc + timedelta(hours=1)
+            ]
+
+            events = [(business_opens_utc, 'SYSTEM_OPEN')] + store_day_polls + [(business_closes_utc, 'SYSTEM_CLOSE')]
+            events.sort(key=lambda x: x[0])
+
+            current_status = 'inactive'
+            last_poll_before = next((p for p in store_polls if p[0] < business_opens_utc), None)
+            if last_poll_before:
+                current_status = last_poll_before[1]
+
+            prev_event_time = business_opens_utc
+            for event_time, event_type in events:
+                actual_event_time = max(business_opens_utc, min(event_time, business_closes_utc))
+                if actual_event_time > prev_event_time:
+                    duration_s = (actual_event_time - prev_event_time).total_seconds()
+                    if current_status == 'active':
+                        daily_uptime_s += duration_s
+                if event_type not in ['SYSTEM_OPEN', 'SYSTEM_CLOSE']:
+                    current_status = event_type
+                elif event_type == 'SYSTEM_CLOSE':
+                    current_status = 'inactive'
+                prev_event_time = actual_event_time
+
+            total_business_seconds_for_day += max(0, (business_closes_utc - business_opens_utc).total_seconds())
+
+        if iter_utc_dt >= target_ref_time_utc - timedelta(days=1):
+            total_uptime_last_day_s += daily_uptime_s
+            total_active_time_in_business_last_day_s += total_business_seconds_for_day
+
+        total_uptime_last_week_s += daily_uptime_s
+        total_active_time_in_business_last_week_s += total_business_seconds_for_day
+
+    # Final output parameters
+    uptime_last_hour_min = round(total_uptime_last_hour_s / 60)
+    downtime_last_hour_min = round(max(0, total_active_time_in_business_last_hour_s - total_uptime_last_hour_s) / 60)
+    uptime_last_day_hours = round(total_uptime_last_day_s / 3600)
+    downtime_last_day_hours = round(max(0, total_active_time_in_business_last_day_s - total_uptime_last_day_s) / 3600)
+    uptime_last_week_hours = round(total_uptime_last_week_s / 3600)
+    downtime_last_week_hours = round(max(0, total_active_time_in_business_last_week_s - total_uptime_last_week_s) / 3600)
+
+    return [
+        store_id, uptime_last_hour_min, uptime_last_day_hours, uptime_last_week_hours,
+        downtime_last_hour_min, downtime_last_day_hours, downtime_last_week_hours
+    ]
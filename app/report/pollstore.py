@@ -0,0 +1,271 @@
+import bisect
+import json
+import os
+import socket
+import sys
+import time
+from array import array
+from datetime import datetime, timedelta
+import pytz
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.log import get_logger
+from app.report.metrics import Poll
+from app.timestamps import ONE_MICROSECOND, from_epoch_us
+
+logger = get_logger(__name__)
+
+# Resident poll store: report workers keep the recent polls of every store in memory and the bulk path reads them
+# from there instead of querying store_status. Off by default; set POLL_STORE=1.
+POLL_STORE = os.environ.get('POLL_STORE', '0') == '1'
+
+# Polls kept per store before its latest poll. Reports use the 7 days before the latest poll; older polls are
+# dropped in batches.
+POLL_STORE_HISTORY = timedelta(days=8)
+REPORT_WINDOW = timedelta(days=7)
+
+# Refreshes re-read the polls this far below the high-water mark, so polls that arrive a little late are not missed
+POLL_STORE_OVERLAP = timedelta(seconds=float(os.environ.get('POLL_STORE_OVERLAP', '900')))
+
+# Seconds between refreshes of an idle worker, and between full reloads that pick up polls arriving later than
+# the overlap
+POLL_STORE_REFRESH_INTERVAL = float(os.environ.get('POLL_STORE_REFRESH_INTERVAL', '5'))
+POLL_STORE_RELOAD_INTERVAL = float(os.environ.get('POLL_STORE_RELOAD_INTERVAL', '3600'))
+
+# Timestamps are converted to epoch microseconds and statuses to booleans by the server, so loading the polls
+# creates no datetime objects
+WARM_QUERY = """
+    WITH bounds AS (
+        SELECT store_id, MAX(timestamp_utc) AS max_ts
+        FROM store_status
+        GROUP BY store_id
+    )
+    SELECT s.store_id, (EXTRACT(EPOCH FROM s.timestamp_utc) * 1000000)::BIGINT, s.status = 'active'
+    FROM store_status s
+    JOIN bounds b ON b.store_id = s.store_id
+    WHERE s.timestamp_utc >= b.max_ts - %s
+    ORDER BY s.store_id, s.timestamp_utc
+"""
+
+DELTA_QUERY = """
+    SELECT store_id, (EXTRACT(EPOCH FROM timestamp_utc) * 1000000)::BIGINT, status = 'active'
+    FROM store_status
+    WHERE timestamp_utc >= %s
+    ORDER BY store_id, timestamp_utc
+"""
+
+# Bumped by every UPDATE, DELETE or TRUNCATE of store_status, after which the store is reloaded
+REWRITES_QUERY = "SELECT version FROM data_versions WHERE table_name = 'store_status:rewrites'"
+
+FETCH_SIZE = 20000
+
+# Polls of one store in time order: epoch microseconds and a bitmap with one bit per poll, set when it was active
+class StorePolls:
+    __slots__ = ('epochs', 'bits')
+
+    def __init__(self):
+        self.epochs = array('q')
+        self.bits = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def append(self, epoch_us: int, active: bool) -> None:
+        count = len(self.epochs)
+        if count % 8 == 0:
+            self.bits.append(0)
+        if active:
+            self.bits[count >> 3] |= 1 << (count & 7)
+        self.epochs.append(epoch_us)
+
+    # Keeps the first count polls
+    def truncate(self, count: int) -> None:
+        del self.epochs[count:]
+        del self.bits[(count + 7) // 8:]
+        if count % 8:
+            self.bits[-1] &= (1 << (count % 8)) - 1
+
+    # Drops the first count polls
+    def drop_front(self, count: int) -> None:
+        remaining = len(self.epochs) - count
+        del self.epochs[:count]
+        shifted = int.from_bytes(self.bits, 'little') >> count
+        self.bits = bytearray(shifted.to_bytes((remaining + 7) // 8, 'little'))
+
+# Read-only view of the polls of a store from index start on, handed to the report engines as StoreInputs.polls.
+# The numpy engine reads the epochs and the bitmap directly; iterating yields (datetime, status) tuples like the
+# polls read from the database, converted once.
+class ResidentPolls:
+    def __init__(self, store_polls: StorePolls, start: int):
+        self.epochs = store_polls.epochs[start:]
+        self.bits = store_polls.bits
+        self.start = start
+        self._polls: Optional[List[Poll]] = None
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def __iter__(self) -> Iterator[Poll]:
+        if self._polls is None:
+            bits, start = self.bits, self.start
+            self._polls = [
+                (from_epoch_us(epoch_us), 'active' if bits[(start + k) >> 3] >> ((start + k) & 7) & 1 else 'inactive')
+                for k, epoch_us in enumerate(self.epochs)
+            ]
+        return iter(self._polls)
+
+class PollStore:
+    def __init__(self):
+        self.stores: Dict[str, StorePolls] = {}
+        self.high_water_us: Optional[int] = None
+        self.rewrites_version: Optional[int] = None
+        self.loaded_at = 0.0
+        self.refreshed_at = 0.0
+        self.warm_seconds = 0.0
+        self.full_loads = 0
+        self.refreshes = 0
+        self.refresh_seconds_total = 0.0
+        self.refresh_seconds_max = 0.0
+        self.last_refresh_seconds = 0.0
+        self.last_refresh_rows = 0
+
+    # Streams (store_id, epoch, active) rows grouped by store
+    def _iter_groups(self, conn, query: str, params: Tuple) -> Iterator[Tuple[str, List[Tuple[int, bool]]]]:
+        with conn.cursor(name='poll_store_load') as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(query, params)
+            current_store_id, current_rows = None, []
+            for store_id, epoch_us, active in cur:
+                if store_id != current_store_id:
+                    if current_store_id is not None:
+                        yield current_store_id, current_rows
+                    current_store_id, current_rows = store_id, []
+                current_rows.append((epoch_us, active))
+            if current_store_id is not None:
+                yield current_store_id, current_rows
+        conn.commit()
+
+    def _rewrites_version(self, conn) -> Optional[int]:
+        with conn.cursor() as cur:
+            cur.execute(REWRITES_QUERY)
+            row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else None
+
+    # Loads the recent polls of every store, replacing the current contents
+    def warm(self, conn) -> None:
+        started = time.perf_counter()
+        rewrites_version = self._rewrites_version(conn)
+        stores: Dict[str, StorePolls] = {}
+        high_water_us = None
+        for store_id, rows in self._iter_groups(conn, WARM_QUERY, (POLL_STORE_HISTORY,)):
+            store_polls = stores[store_id] = StorePolls()
+            for epoch_us, active in rows:
+                store_polls.append(epoch_us, active)
+            high_water_us = rows[-1][0] if high_water_us is None else max(high_water_us, rows[-1][0])
+        self.stores, self.high_water_us, self.rewrites_version = stores, high_water_us, rewrites_version
+        self.warm_seconds = time.perf_counter() - started
+        self.loaded_at = self.refreshed_at = time.time()
+        self.full_loads += 1
+        logger.info("Poll store loaded %d polls of %d stores in %.1fs", self.poll_count(), len(stores), self.warm_seconds)
+
+    # Replaces the polls at or above the high-water mark minus the overlap with the rows now in store_status.
+    # Falls back to a full load when store_status was updated or deleted from, or the last full load is too old.
+    def refresh(self, conn) -> None:
+        if (self.high_water_us is None or time.time() - self.loaded_at >= POLL_STORE_RELOAD_INTERVAL
+                or self._rewrites_version(conn) != self.rewrites_version):
+            self.warm(conn)
+            return
+        started = time.perf_counter()
+        lower_us = self.high_water_us - POLL_STORE_OVERLAP // ONE_MICROSECOND
+        history_us = POLL_STORE_HISTORY // ONE_MICROSECOND
+        rows_read = 0
+        for store_id, rows in self._iter_groups(conn, DELTA_QUERY, (from_epoch_us(lower_us),)):
+            store_polls = self.stores.setdefault(store_id, StorePolls())
+            store_polls.truncate(bisect.bisect_left(store_polls.epochs, lower_us))
+            for epoch_us, active in rows:
+                store_polls.append(epoch_us, active)
+            rows_read += len(rows)
+            self.high_water_us = max(self.high_water_us, rows[-1][0])
+            # Old polls are dropped once there are enough of them to be worth the copy
+            expired = bisect.bisect_left(store_polls.epochs, store_polls.epochs[-1] - history_us)
+            if expired >= 64 or expired * 4 >= len(store_polls):
+                store_polls.drop_front(expired)
+        seconds = time.perf_counter() - started
+        self.refreshed_at = time.time()
+        self.refreshes += 1
+        self.refresh_seconds_total += seconds
+        self.refresh_seconds_max = max(self.refresh_seconds_max, seconds)
+        self.last_refresh_seconds = seconds
+        self.last_refresh_rows = rows_read
+
+    def refresh_due(self) -> bool:
+        return time.time() - self.refreshed_at >= POLL_STORE_REFRESH_INTERVAL
+
+    # Reference time of every requested store that has polls: its latest poll
+    def max_times(self, store_ids: List[str]) -> Dict[str, datetime]:
+        return {store_id: from_epoch_us(self.stores[store_id].epochs[-1])
+                for store_id in store_ids if store_id in self.stores and len(self.stores[store_id])}
+
+    # The polls of the 7 days before each store's latest poll, the same window the bulk query reads
+    def iter_store_polls(self, store_ids: List[str]) -> Iterator[Tuple[str, ResidentPolls]]:
+        window_us = REPORT_WINDOW // ONE_MICROSECOND
+        for store_id in store_ids:
+            store_polls = self.stores.get(store_id)
+            if store_polls is None or not len(store_polls):
+                continue
+            start = bisect.bisect_left(store_polls.epochs, store_polls.epochs[-1] - window_us)
+            yield store_id, ResidentPolls(store_polls, start)
+
+    def poll_count(self) -> int:
+        return sum(len(store_polls) for store_polls in self.stores.values())
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self.stores) + sum(
+            sys.getsizeof(store_id) + sys.getsizeof(store_polls) + sys.getsizeof(store_polls.epochs)
+            + sys.getsizeof(store_polls.bits)
+            for store_id, store_polls in self.stores.items()
+        )
+
+    def stats(self) -> Dict[str, object]:
+        polls = self.poll_count()
+        memory_bytes = self.memory_bytes()
+        return {
+            'stores': len(self.stores),
+            'polls': polls,
+            'memory_bytes': memory_bytes,
+            'bytes_per_poll': round(memory_bytes / polls, 2) if polls else None,
+            'high_water_mark': from_epoch_us(self.high_water_us).isoformat() if self.high_water_us is not None else None,
+            'full_loads': self.full_loads,
+            'last_full_load_seconds': round(self.warm_seconds, 3),
+            'refreshes': self.refreshes,
+            'last_refresh_seconds': round(self.last_refresh_seconds, 4),
+            'avg_refresh_seconds': round(self.refresh_seconds_total / self.refreshes, 4) if self.refreshes else None,
+            'max_refresh_seconds': round(self.refresh_seconds_max, 4),
+            'last_refresh_rows': self.last_refresh_rows,
+            'refreshed_at': datetime.fromtimestamp(self.refreshed_at, pytz.utc).isoformat() if self.refreshed_at else None,
+        }
+
+    # Report workers publish their stats for the /admin/poll_store endpoint of the web server
+    def publish_stats(self, conn, worker: str) -> None:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO poll_store_stats (worker, stats, updated_at) VALUES (%s, %s, %s)
+                   ON CONFLICT (worker) DO UPDATE SET stats = EXCLUDED.stats, updated_at = EXCLUDED.updated_at""",
+                (worker, json.dumps(self.stats()), datetime.now(pytz.utc))
+            )
+        conn.commit()
+
+# The poll store of this process, once a report worker has enabled it
+_poll_store: Optional[PollStore] = None
+
+def get_poll_store() -> Optional[PollStore]:
+    return _poll_store
+
+def enable_poll_store() -> PollStore:
+    global _poll_store
+    _poll_store = PollStore()
+    return _poll_store
+
+def worker_name(worker_index: int) -> str:
+    return f"{socket.gethostname()}/report-worker-{worker_index}"
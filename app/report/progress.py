@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+import pytz
+from typing import Dict, List, Optional
+
+from app.db import connect
+
+# Seconds between progress updates of a running report. Every update is also a checkpoint: the rows written so far
+# are flushed to disk and a restarted report resumes after them, so this is also about the most work a crash loses.
+REPORT_PROGRESS_INTERVAL = float(os.environ.get('REPORT_PROGRESS_INTERVAL', '5'))
+
+# Read by /get_report on both servers
+REPORT_STATUS_QUERY = """
+    SELECT status, report_path, stores_total, stores_done, stores_resumed, COALESCE(started_at, created_at),
+        progress_updated_at, shards_done, shards_total
+    FROM reports
+    WHERE report_id = %s
+"""
+
+# Progress of a queued or running report for /get_report: stores done out of the total, the rate of the current
+# run (stores done before a restart do not count) and the estimated seconds left. None before the store list is
+# known.
+def progress_summary(stores_total: Optional[int], stores_done: Optional[int], stores_resumed: Optional[int],
+                     started_at: Optional[datetime], progress_updated_at: Optional[datetime],
+                     shards_done: Optional[int] = None, shards_total: Optional[int] = None) -> Optional[Dict]:
+    if stores_total is None:
+        return None
+    stores_done = stores_done or 0
+    progress = {
+        'stores_done': stores_done,
+        'stores_total': stores_total,
+        'percent': round(100.0 * stores_done / stores_total, 1) if stores_total else 100.0,
+        'stores_per_second': None,
+        'eta_seconds': None,
+        'updated_at': progress_updated_at.isoformat() if progress_updated_at else None,
+    }
+    if shards_total:
+        progress['shards_done'] = shards_done or 0
+        progress['shards_total'] = shards_total
+    if stores_resumed:
+        progress['stores_resumed'] = stores_resumed
+    stores_this_run = stores_done - (stores_resumed or 0)
+    if started_at and progress_updated_at and stores_this_run > 0:
+        seconds = (progress_updated_at - started_at).total_seconds()
+        if seconds > 0:
+            rate = stores_this_run / seconds
+            # Counted from the last update, which may be up to REPORT_PROGRESS_INTERVAL seconds old
+            since_update = (datetime.now(pytz.utc) - progress_updated_at).total_seconds()
+            progress['stores_per_second'] = round(rate, 2)
+            progress['eta_seconds'] = round(max(0.0, (stores_total - stores_done) / rate - max(since_update, 0.0)), 1)
+    return progress
+
+# Identifies the store list and shard count of a sharded report, whose shard files are only reused by a run that
+# splits the same stores the same way
+def shard_fingerprint(store_ids: List[str], shard_count: int) -> str:
+    digest = hashlib.md5('\n'.join(store_ids).encode()).hexdigest()
+    return f"{shard_count}:{len(store_ids)}:{digest}"
+
+def load_checkpoint(conn, report_id: str) -> Optional[Dict]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT checkpoint FROM reports WHERE report_id = %s", (report_id,))
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+def _update(conn, report_id: str, assignments: str, params: tuple) -> None:
+    with conn.cursor() as cur:
+        cur.execute(f"UPDATE reports SET {assignments}, progress_updated_at = %s WHERE report_id = %s",
+                    params + (datetime.now(pytz.utc), report_id))
+    conn.commit()
+
+# Records the progress of an unsharded report as its rows are written, in store_ids order. The updates use a pooled
+# connection of their own: the report's connection may be iterating a server-side cursor, which a commit would
+# close. Every update flushes the partial CSV to disk and stores a checkpoint (the last store written and the size
+# of the file after it), from which a restarted run of the report continues.
+class ReportProgress:
+    def __init__(self, report_id: str, store_ids: List[str], stores_done: int = 0):
+        self.report_id = report_id
+        self.store_ids = store_ids
+        self.positions = {store_id: position for position, store_id in enumerate(store_ids)}
+        self.stores_done = stores_done
+        self.last_store_id: Optional[str] = store_ids[stores_done - 1] if stores_done else None
+        self.last_update = time.monotonic()
+        self.conn = connect()
+        _update(self.conn, report_id, "stores_total = %s, stores_done = %s, stores_resumed = %s",
+                (len(store_ids), stores_done, stores_done))
+
+    # Where a run resumes: the number of stores done and the size of the partial CSV after them, if the checkpoint
+    # matches the file on disk and this store list
+    @staticmethod
+    def resume_point(checkpoint: Optional[Dict], partial_filepath: str, store_ids: List[str]) -> Optional[Dict]:
+        if not checkpoint or 'bytes' not in checkpoint or not os.path.exists(partial_filepath):
+            return None
+        stores_done = checkpoint['stores_done']
+        if not 0 < stores_done <= len(store_ids) or store_ids[stores_done - 1] != checkpoint['store_id']:
+            return None
+        if os.path.getsize(partial_filepath) < checkpoint['bytes']:
+            return None
+        return checkpoint
+
+    def row_written(self, store_id: str, csvfile) -> None:
+        # Stores without a row are skipped over; rows come in the order of store_ids
+        self.stores_done = self.positions[store_id] + 1
+        self.last_store_id = store_id
+        if time.monotonic() - self.last_update >= REPORT_PROGRESS_INTERVAL:
+            self.checkpoint(csvfile)
+
+    # A columnar report (no csvfile) cannot be appended to once its file is closed, so its checkpoint has no size and
+    # a restarted run starts over
+    def checkpoint(self, csvfile) -> None:
+        checkpoint = {'store_id': self.last_store_id, 'stores_done': self.stores_done}
+        if csvfile is not None:
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+            checkpoint['bytes'] = csvfile.tell()
+        _update(self.conn, self.report_id, "stores_done = %s, checkpoint = %s",
+                (self.stores_done, json.dumps(checkpoint)))
+        self.last_update = time.monotonic()
+
+    def close(self) -> None:
+        self.conn.close()
+
+# Records the rows written by a shard process. The shards of a report run concurrently, so each adds the stores it
+# finished since its last update to stores_done.
+class ShardProgress:
+    def __init__(self, report_id: str):
+        self.report_id = report_id
+        self.pending = 0
+        self.last_update = time.monotonic()
+        self.conn = connect()
+
+    def row_written(self, store_id: str, csvfile) -> None:
+        self.pending += 1
+        if time.monotonic() - self.last_update >= REPORT_PROGRESS_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            _update(self.conn, self.report_id, "stores_done = stores_done + %s", (self.pending,))
+            self.pending = 0
+        self.last_update = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+# Progress and checkpoint of a sharded report at the start of a run: the shards already on disk count as done
+def start_sharded_progress(conn, report_id: str, stores_total: int, stores_done: int, fingerprint: str) -> None:
+    _update(conn, report_id, "stores_total = %s, stores_done = %s, stores_resumed = %s, checkpoint = %s",
+            (stores_total, stores_done, stores_done, json.dumps({'shards': fingerprint})))
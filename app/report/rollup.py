@@ -0,0 +1,416 @@
+import hashlib
+from datetime import datetime, timedelta
+import pytz
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from app.instrument import COMPUTE, DB_FETCH
+from app.log import get_logger
+from app.report.bulk import BULK_FETCH_SIZE, ENGINE_BATCH_SIZE, fetch_business_hours, fetch_timezones
+from app.report.calendar import BusinessCalendar, BusinessHours, business_calendar, calendar_version
+from app.report.metrics import Poll
+
+logger = get_logger(__name__)
+
+# Hourly rollups of store_status. Every hour a store has been observed for gets a row in store_status_hourly
+# holding the business time and the active business time of that hour, plus the status in effect at the end of
+# the hour. Between two polls a store keeps the status of the earlier poll; before its first rolled up poll it has
+# the status of its origin, inactive unless retention (app/retention.py) moved the origin forward. The hour
+# containing a store's latest poll is partial and is extended by the next catch-up.
+ROLLUP_NAME = 'store_status_hourly'
+
+# Serializes catch-ups, since two concurrent runs would add the same polls twice
+ROLLUP_LOCK_ID = 48151623
+
+# The first catch-up only rolls up this much history before the latest poll
+INITIAL_HISTORY = timedelta(days=8)
+
+ONE_HOUR = timedelta(hours=1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+MINUTE_US = 60 * 10**6
+HOUR_US = 60 * MINUTE_US
+
+# Bucket of one hour: [active business microseconds, business microseconds, status at the end of the hour]
+Buckets = Dict[datetime, list]
+
+class RollupState(NamedTuple):
+    origin_utc: datetime
+    last_poll_utc: datetime
+    last_status: str
+    hours_version: str
+    origin_status: str
+
+# Each store's own latest rolled up poll is its watermark, so a store that reports later than the others is not
+# skipped. Stores without a state start at the origin given for new stores.
+NEW_POLLS_QUERY = """
+    SELECT s.store_id, s.timestamp_utc, s.status
+    FROM store_status s
+    LEFT JOIN store_rollup_state r ON r.store_id = s.store_id
+    WHERE s.timestamp_utc > %(origin)s
+        AND s.timestamp_utc > GREATEST(r.last_poll_utc, %(origin)s)
+    ORDER BY s.store_id, s.timestamp_utc
+"""
+
+STORE_POLLS_QUERY = """
+    SELECT timestamp_utc, status
+    FROM store_status
+    WHERE store_id = %s AND timestamp_utc > %s AND timestamp_utc <= %s
+    ORDER BY timestamp_utc
+"""
+
+UPSERT_BUCKETS = """
+    INSERT INTO store_status_hourly (store_id, hour_utc, uptime_us, business_us, end_status) VALUES %s
+    ON CONFLICT (store_id, hour_utc) DO UPDATE SET
+        uptime_us = store_status_hourly.uptime_us + EXCLUDED.uptime_us,
+        business_us = store_status_hourly.business_us + EXCLUDED.business_us,
+        end_status = EXCLUDED.end_status
+"""
+
+UPSERT_STATE = """
+    INSERT INTO store_rollup_state (store_id, origin_utc, last_poll_utc, last_status, hours_version, origin_status)
+    VALUES %s
+    ON CONFLICT (store_id) DO UPDATE SET
+        origin_utc = EXCLUDED.origin_utc,
+        last_poll_utc = EXCLUDED.last_poll_utc,
+        last_status = EXCLUDED.last_status,
+        hours_version = EXCLUDED.hours_version,
+        origin_status = EXCLUDED.origin_status
+"""
+
+# 168 complete hours plus the partial hour of the latest poll for the week, 24 plus the partial hour for the day,
+# and the status at the end of the hour before the last-hour window starts
+ROLLUP_TOTALS_QUERY = """
+    SELECT r.store_id, r.last_poll_utc,
+        COALESCE(SUM(h.uptime_us) FILTER (WHERE h.hour_utc >= date_trunc('hour', r.last_poll_utc, 'UTC') - INTERVAL '24 hours'), 0),
+        COALESCE(SUM(h.business_us) FILTER (WHERE h.hour_utc >= date_trunc('hour', r.last_poll_utc, 'UTC') - INTERVAL '24 hours'), 0),
+        COALESCE(SUM(h.uptime_us), 0),
+        COALESCE(SUM(h.business_us), 0),
+        MAX(h.end_status) FILTER (WHERE h.hour_utc = date_trunc('hour', r.last_poll_utc - INTERVAL '1 hour', 'UTC') - INTERVAL '1 hour')
+    FROM store_rollup_state r
+    LEFT JOIN store_status_hourly h
+        ON h.store_id = r.store_id AND h.hour_utc >= date_trunc('hour', r.last_poll_utc, 'UTC') - INTERVAL '168 hours'
+    WHERE r.store_id = ANY(%s)
+    GROUP BY r.store_id, r.last_poll_utc
+"""
+
+# Moves the origin of rolled up stores forward to their retention cutoff, with the status of their latest poll at
+# or before it. The buckets from the cutoff hour on are unchanged, since the cutoff is on an hour boundary.
+ADVANCE_ORIGINS_QUERY = """
+    UPDATE store_rollup_state r SET
+        origin_utc = c.cutoff_utc,
+        origin_status = COALESCE((
+            SELECT p.status FROM store_status p
+            WHERE p.store_id = r.store_id AND p.timestamp_utc > r.origin_utc AND p.timestamp_utc <= c.cutoff_utc
+            ORDER BY p.timestamp_utc DESC
+            LIMIT 1
+        ), r.origin_status)
+    FROM unnest(%s::text[], %s::timestamptz[]) c(store_id, cutoff_utc)
+    WHERE r.store_id = c.store_id AND r.origin_utc < c.cutoff_utc
+"""
+
+# Raw polls of the hour before the latest poll, starting at the hour boundary before the window
+LAST_HOUR_POLLS_QUERY = """
+    SELECT r.store_id, s.timestamp_utc, s.status
+    FROM store_status s
+    JOIN store_rollup_state r ON r.store_id = s.store_id
+    WHERE r.store_id = ANY(%s)
+        AND s.timestamp_utc >= date_trunc('hour', r.last_poll_utc - INTERVAL '1 hour', 'UTC')
+        AND s.timestamp_utc <= r.last_poll_utc
+    ORDER BY r.store_id, s.timestamp_utc
+"""
+
+def hours_version(store_business_hours: BusinessHours, pytz_timezone) -> str:
+    return hashlib.md5(repr(calendar_version(store_business_hours, pytz_timezone)).encode()).hexdigest()
+
+def _hour_start(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+# Adds the business time of [segment_start, segment_end] to the hourly buckets it crosses
+def _add_segment(buckets: Buckets, calendar: BusinessCalendar, segment_start: datetime, segment_end: datetime,
+                 status: str) -> None:
+    if segment_end <= segment_start:
+        return
+    hour = _hour_start(segment_start)
+    while hour < segment_end:
+        buckets.setdefault(hour, [0, 0, status])[2] = status
+        hour += ONE_HOUR
+
+    # Business periods of consecutive days can overlap, so time already counted is skipped
+    covered_until = segment_start
+    for business_opens_utc, business_closes_utc in calendar.intervals_between(segment_start, segment_end):
+        start = max(business_opens_utc, covered_until)
+        end = min(business_closes_utc, segment_end)
+        while start < end:
+            hour = _hour_start(start)
+            piece_end = min(hour + ONE_HOUR, end)
+            duration_us = (piece_end - start) // ONE_MICROSECOND
+            bucket = buckets[hour]
+            bucket[1] += duration_us
+            if status == 'active':
+                bucket[0] += duration_us
+            start = piece_end
+        covered_until = max(covered_until, end)
+
+# Rolls up the polls following start_utc, the store having start_status at start_utc. Time after the last poll
+# is not counted yet.
+def accumulate(store_id: str, store_business_hours: BusinessHours, pytz_timezone, start_utc: datetime,
+               start_status: str, store_polls: List[Poll]) -> Buckets:
+    end_utc = store_polls[-1][0] if store_polls else start_utc
+    calendar = business_calendar(store_id, store_business_hours, pytz_timezone,
+                                 start_utc.date() - timedelta(days=1), end_utc.date() + timedelta(days=1))
+    buckets: Buckets = {}
+    prev_time, prev_status = start_utc, start_status
+    for ts, status in store_polls:
+        _add_segment(buckets, calendar, prev_time, ts, prev_status)
+        prev_time, prev_status = ts, status
+    if store_polls:
+        # The hour of the latest poll ends with the status of that poll
+        buckets.setdefault(_hour_start(prev_time), [0, 0, prev_status])[2] = prev_status
+    return buckets
+
+def _bucket_rows(store_id: str, buckets: Buckets) -> List[Tuple]:
+    return [(store_id, hour, uptime_us, business_us, end_status)
+            for hour, (uptime_us, business_us, end_status) in sorted(buckets.items())]
+
+def load_state(cur) -> Dict[str, RollupState]:
+    cur.execute("SELECT store_id, origin_utc, last_poll_utc, last_status, hours_version, origin_status "
+                "FROM store_rollup_state")
+    return {row[0]: RollupState(*row[1:]) for row in cur.fetchall()}
+
+def _fetch_store_polls(cur, store_id: str, after_utc: datetime, until_utc: datetime) -> List[Poll]:
+    cur.execute(STORE_POLLS_QUERY, (store_id, after_utc, until_utc))
+    return cur.fetchall()
+
+# Recomputes every bucket of a store from the raw polls, starting at its origin
+def recompute_store(cur, store_id: str, state: RollupState, store_business_hours: BusinessHours,
+                    pytz_timezone) -> Buckets:
+    store_polls = _fetch_store_polls(cur, store_id, state.origin_utc, state.last_poll_utc)
+    return accumulate(store_id, store_business_hours, pytz_timezone, state.origin_utc, state.origin_status,
+                      store_polls)
+
+def _iter_new_polls(conn, origin_utc: datetime) -> Iterator[Tuple[str, List[Poll]]]:
+    with conn.cursor(name='rollup_new_polls') as cur:
+        cur.itersize = BULK_FETCH_SIZE
+        cur.execute(NEW_POLLS_QUERY, {'origin': origin_utc})
+        current_store_id = None
+        current_polls: List[Poll] = []
+        for store_id, timestamp_utc, status in cur:
+            store_id = str(store_id)
+            if store_id != current_store_id:
+                if current_store_id is not None:
+                    yield current_store_id, current_polls
+                current_store_id = store_id
+                current_polls = []
+            current_polls.append((timestamp_utc, status))
+        if current_store_id is not None:
+            yield current_store_id, current_polls
+
+# Rolls up one batch of stores with new polls and returns the number of stores rebuilt from scratch
+def _catch_up_batch(cur, batch: List[Tuple[str, List[Poll]]], states: Dict[str, RollupState],
+                    new_store_origin: datetime) -> int:
+    conn = cur.connection
+    store_ids = [store_id for store_id, _ in batch]
+    timezones = fetch_timezones(conn, store_ids)
+    business_hours = fetch_business_hours(conn, store_ids)
+
+    bucket_rows, state_rows, rebuilt = [], [], 0
+    for store_id, store_polls in batch:
+        store_business_hours = business_hours.get(store_id, {})
+        version = hours_version(store_business_hours, timezones[store_id])
+        state = states.get(store_id)
+        last_poll_utc, last_status = store_polls[-1]
+        if state is None or state.last_poll_utc < new_store_origin:
+            # New stores, and stores that stopped polling for longer than the history kept, start over at the origin
+            origin_utc, origin_status = new_store_origin, 'inactive'
+            if state is not None:
+                cur.execute("DELETE FROM store_status_hourly WHERE store_id = %s", (store_id,))
+            buckets = accumulate(store_id, store_business_hours, timezones[store_id], origin_utc, 'inactive', store_polls)
+        elif state.hours_version != version:
+            # Business hours changed: every bucket of the store is recomputed with the new hours
+            origin_utc, origin_status = state.origin_utc, state.origin_status
+            cur.execute("DELETE FROM store_status_hourly WHERE store_id = %s", (store_id,))
+            buckets = recompute_store(cur, store_id, state._replace(last_poll_utc=last_poll_utc),
+                                      store_business_hours, timezones[store_id])
+            rebuilt += 1
+        else:
+            origin_utc, origin_status = state.origin_utc, state.origin_status
+            buckets = accumulate(store_id, store_business_hours, timezones[store_id],
+                                 state.last_poll_utc, state.last_status, store_polls)
+        bucket_rows.extend(_bucket_rows(store_id, buckets))
+        state_rows.append((store_id, origin_utc, last_poll_utc, last_status, version, origin_status))
+
+    if bucket_rows:
+        execute_values(cur, UPSERT_BUCKETS, bucket_rows, page_size=5000)
+    execute_values(cur, UPSERT_STATE, state_rows, page_size=5000)
+    return rebuilt
+
+# Catch-up job: rolls up every poll newer than its store's latest rolled up poll in a single transaction and moves
+# the watermark (the latest poll rolled up over all stores). Stores seen for the first time start INITIAL_HISTORY
+# before the previous watermark. A poll that arrives with a timestamp older than its store's latest rolled up poll
+# is not picked up; `rollup.py check` finds the affected stores and `rollup.py rebuild` recomputes them.
+def catch_up(conn) -> Dict[str, object]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+        cur.execute("SELECT watermark FROM rollup_watermarks WHERE name = %s", (ROLLUP_NAME,))
+        row = cur.fetchone()
+        if row:
+            watermark = row[0]
+        else:
+            cur.execute("SELECT MAX(timestamp_utc) FROM store_status")
+            watermark = cur.fetchone()[0]
+            if watermark is None:
+                conn.commit()
+                return {'stores': 0, 'polls': 0, 'rebuilt': 0, 'watermark': None}
+        new_store_origin = watermark - INITIAL_HISTORY
+        states = load_state(cur)
+
+        stores, polls, rebuilt = 0, 0, 0
+        new_watermark = watermark
+        batch: List[Tuple[str, List[Poll]]] = []
+        for store_id, store_polls in _iter_new_polls(conn, new_store_origin):
+            batch.append((store_id, store_polls))
+            stores += 1
+            polls += len(store_polls)
+            new_watermark = max(new_watermark, store_polls[-1][0])
+            if len(batch) >= ENGINE_BATCH_SIZE:
+                rebuilt += _catch_up_batch(cur, batch, states, new_store_origin)
+                batch = []
+        if batch:
+            rebuilt += _catch_up_batch(cur, batch, states, new_store_origin)
+
+        cur.execute(
+            """INSERT INTO rollup_watermarks (name, watermark, updated_at) VALUES (%s, %s, %s)
+               ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark, updated_at = EXCLUDED.updated_at""",
+            (ROLLUP_NAME, new_watermark, datetime.now(pytz.utc))
+        )
+    conn.commit()
+    return {'stores': stores, 'polls': polls, 'rebuilt': rebuilt, 'watermark': new_watermark}
+
+# Consistency check: recomputes the buckets of the given stores (all rolled up stores by default) from the raw
+# polls and returns the differences as (store_id, hour, stored bucket, recomputed bucket)
+def check_consistency(conn, store_ids: Optional[List[str]] = None) -> List[Tuple]:
+    differences = []
+    with conn.cursor() as cur:
+        states = load_state(cur)
+        store_ids = store_ids if store_ids is not None else sorted(states)
+        timezones = fetch_timezones(conn, store_ids)
+        business_hours = fetch_business_hours(conn, store_ids)
+        for store_id in store_ids:
+            if store_id not in states:
+                differences.append((store_id, None, None, 'not rolled up'))
+                continue
+            expected = recompute_store(cur, store_id, states[store_id], business_hours.get(store_id, {}),
+                                       timezones[store_id])
+            cur.execute(
+                "SELECT hour_utc, uptime_us, business_us, end_status FROM store_status_hourly WHERE store_id = %s",
+                (store_id,)
+            )
+            stored = {hour: [uptime_us, business_us, end_status] for hour, uptime_us, business_us, end_status in cur.fetchall()}
+            for hour in sorted(set(expected) | set(stored)):
+                if expected.get(hour) != stored.get(hour):
+                    differences.append((store_id, hour, stored.get(hour), expected.get(hour)))
+    conn.rollback()
+    return differences
+
+# Forgets the rollups of stores whose polls were replaced (every store when store_ids is None), in the caller's
+# transaction, so the next catch-up rolls them up from scratch
+def invalidate(cur, store_ids: Optional[List[str]] = None) -> None:
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+    if store_ids is None:
+        cur.execute("TRUNCATE store_status_hourly, store_rollup_state")
+        cur.execute("DELETE FROM rollup_watermarks WHERE name = %s", (ROLLUP_NAME,))
+    else:
+        cur.execute("DELETE FROM store_status_hourly WHERE store_id = ANY(%s)", (store_ids,))
+        cur.execute("DELETE FROM store_rollup_state WHERE store_id = ANY(%s)", (store_ids,))
+
+# Drops the rollups older than each store's retention cutoff (an hour boundary), in the caller's transaction, before
+# the polls older than the cutoff are deleted. Stores whose rollups end before their cutoff are forgotten, since
+# their next catch-up could not start from deleted polls; the rest keep their buckets from the cutoff on, and a
+# rebuild or check from the new origin gives the same buckets.
+def trim(cur, cutoffs: Dict[str, datetime]) -> None:
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+    store_ids, cutoff_times = list(cutoffs), list(cutoffs.values())
+    cur.execute(
+        """SELECT r.store_id FROM store_rollup_state r
+           JOIN unnest(%s::text[], %s::timestamptz[]) c(store_id, cutoff_utc) ON c.store_id = r.store_id
+           WHERE r.last_poll_utc < c.cutoff_utc""",
+        (store_ids, cutoff_times)
+    )
+    stale = [row[0] for row in cur.fetchall()]
+    if stale:
+        invalidate(cur, stale)
+    cur.execute(ADVANCE_ORIGINS_QUERY, (store_ids, cutoff_times))
+    cur.execute(
+        """DELETE FROM store_status_hourly h USING unnest(%s::text[], %s::timestamptz[]) c(store_id, cutoff_utc)
+           WHERE h.store_id = c.store_id AND h.hour_utc < c.cutoff_utc""",
+        (store_ids, cutoff_times)
+    )
+
+# Replaces the buckets of the given stores with a full recompute from the raw polls
+def rebuild(conn, store_ids: List[str]) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+        states = load_state(cur)
+        timezones = fetch_timezones(conn, store_ids)
+        business_hours = fetch_business_hours(conn, store_ids)
+        rebuilt = 0
+        for store_id in store_ids:
+            if store_id not in states:
+                continue
+            buckets = recompute_store(cur, store_id, states[store_id], business_hours.get(store_id, {}),
+                                      timezones[store_id])
+            cur.execute("DELETE FROM store_status_hourly WHERE store_id = %s", (store_id,))
+            if buckets:
+                execute_values(cur, UPSERT_BUCKETS, _bucket_rows(store_id, buckets), page_size=5000)
+            rebuilt += 1
+    conn.commit()
+    return rebuilt
+
+# Report rows from the rollups: the day and week come from the hourly buckets, only the last hour reads raw polls.
+# Rows are yielded one store at a time, in the order of store_ids.
+def iter_rollup_report_rows(conn, store_ids: List[str]) -> Iterator[List]:
+    with DB_FETCH, conn.cursor() as cur:
+        cur.execute(ROLLUP_TOTALS_QUERY, (store_ids,))
+        totals = {row[0]: row[1:] for row in cur.fetchall()}
+
+        cur.execute(LAST_HOUR_POLLS_QUERY, (store_ids,))
+        last_hour_polls: Dict[str, List[Poll]] = {}
+        for store_id, timestamp_utc, status in cur.fetchall():
+            last_hour_polls.setdefault(store_id, []).append((timestamp_utc, status))
+
+        store_list = list(totals)
+        timezones = fetch_timezones(conn, store_list)
+        business_hours = fetch_business_hours(conn, store_list)
+
+    for store_id in store_ids:
+        if store_id not in totals:
+            logger.warning("Store %s not found in store_status.", store_id)
+            continue
+        last_poll_utc, uptime_day_us, business_day_us, uptime_week_us, business_week_us, prev_end_status = totals[store_id]
+        last_hour_start_utc = last_poll_utc - ONE_HOUR
+
+        # Status at the start of the last hour: latest poll at or before it, else the end of the previous hour
+        start_status = prev_end_status or 'inactive'
+        window_polls = []
+        for ts, status in last_hour_polls.get(store_id, []):
+            if ts <= last_hour_start_utc:
+                start_status = status
+            else:
+                window_polls.append((ts, status))
+        with COMPUTE:
+            hour_buckets = accumulate(store_id, business_hours.get(store_id, {}), timezones[store_id],
+                                      last_hour_start_utc, start_status, window_polls)
+        uptime_hour_us = sum(bucket[0] for bucket in hour_buckets.values())
+        business_hour_us = sum(bucket[1] for bucket in hour_buckets.values())
+
+        yield [
+            store_id,
+            round(uptime_hour_us / MINUTE_US), round(uptime_day_us / HOUR_US), round(uptime_week_us / HOUR_US),
+            round(max(0, business_hour_us - uptime_hour_us) / MINUTE_US),
+            round(max(0, business_day_us - uptime_day_us) / HOUR_US),
+            round(max(0, business_week_us - uptime_week_us) / HOUR_US),
+        ]
+
+def rollup_report_rows(conn, store_ids: List[str]) -> List[List]:
+    return list(iter_rollup_report_rows(conn, store_ids))
@@ -0,0 +1,127 @@
+import csv
+import glob
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+from app.db import connect, connect_replica
+from app.instrument import SHARD_MERGE, merge, reset, snapshot
+from app.log import get_logger
+from app.report.metrics import REPORT_HEADER
+from app.report.progress import ShardProgress, load_checkpoint, shard_fingerprint, start_sharded_progress
+from app.report.windows import WindowSpec, report_header
+from app.report.formats import merge_columnar
+
+logger = get_logger(__name__)
+
+# Number of processes an all-stores report is computed with. Every report worker can start this many, so keep
+# REPORT_WORKERS * REPORT_SHARD_WORKERS near the number of cores.
+REPORT_SHARD_WORKERS = int(os.environ.get('REPORT_SHARD_WORKERS', '1'))
+
+# More shards than processes, so a process that finishes early picks up another shard instead of idling
+SHARDS_PER_WORKER = 4
+
+# Splits the store list into contiguous ranges of near-equal size. Concatenating the shards in order gives back
+# the original list, which keeps the rows of the merged report in the order of store_ids.
+def split_shards(store_ids: List[str], shard_count: int) -> List[List[str]]:
+    shard_count = max(1, min(shard_count, len(store_ids)))
+    shard_size, remainder = divmod(len(store_ids), shard_count)
+    shards, start = [], 0
+    for shard_index in range(shard_count):
+        end = start + shard_size + (1 if shard_index < remainder else 0)
+        shards.append(store_ids[start:end])
+        start = end
+    return shards
+
+def shard_path(report_filepath: str, shard_index: int) -> str:
+    return f"{report_filepath}.part{shard_index:04d}"
+
+# Runs in a shard process: computes the rows of one shard on its own connection and writes them, without a
+# header, to a partial CSV next to the report (or a partial Parquet or Arrow file, for a columnar report). The rows written are added to the report's progress as they go.
+# Returns the shard's index and rows, and its phase timers and store costs for the report worker's metrics.
+# With the primary's position at the start of the report, the rows are read from a replica that has replayed up to it
+# (see app/db.py) when one has.
+def compute_shard(report_id: str, report_filepath: str, shard_index: int, store_ids: List[str], bulk: bool,
+                  engine: Optional[str], rollup: bool, windows: Optional[WindowSpec] = None,
+                  output: Optional[Dict[str, str]] = None, position: Optional[str] = None) -> Tuple[int, int, Dict]:
+    from app.api.endpoints import iter_report_rows, write_report_csv
+
+    # The shard processes live for the whole report, so a process running several shards reuses its connection
+    conn = connect_replica(position) or connect()
+    progress = ShardProgress(report_id)
+    reset()
+    try:
+        rows = iter_report_rows(conn, store_ids, bulk, engine, rollup, windows)
+        row_count = write_report_csv(shard_path(report_filepath, shard_index), rows, header=False, progress=progress,
+                                     columns=report_header(windows) if windows else REPORT_HEADER, output=output)
+        return shard_index, row_count, snapshot()
+    finally:
+        progress.close()
+        conn.close()
+
+def _record_progress(conn, report_id: str, shards_done: int, shards_total: int) -> None:
+    with conn.cursor() as cur:
+        cur.execute("UPDATE reports SET shards_done = %s, shards_total = %s WHERE report_id = %s",
+                    (shards_done, shards_total, report_id))
+    conn.commit()
+
+# Sharded mode: computes the shards in `workers` processes, records the number of finished shards in the reports
+# row, and concatenates the partial CSVs in shard order into report_filepath. Returns the number of rows written.
+# A finished shard's partial CSV is its checkpoint: it is kept until the report is merged, and a later run of the
+# report that splits the same stores into the same shards only computes the shards that are missing.
+def write_sharded_report(conn, report_id: str, report_filepath: str, store_ids: List[str], workers: int,
+                         bulk: bool = True, engine: Optional[str] = None, rollup: bool = False,
+                         windows: Optional[WindowSpec] = None, output: Optional[Dict[str, str]] = None,
+                         position: Optional[str] = None) -> int:
+    shards = split_shards(store_ids, workers * SHARDS_PER_WORKER)
+    fingerprint = shard_fingerprint(store_ids, len(shards))
+    checkpoint = load_checkpoint(conn, report_id)
+    resumable = bool(checkpoint) and checkpoint.get('shards') == fingerprint
+    shards_done = [shard_index for shard_index in range(len(shards))
+                   if resumable and os.path.exists(shard_path(report_filepath, shard_index))]
+    if not resumable:
+        # Shards of a different split are of no use
+        for path in glob.glob(f"{glob.escape(report_filepath)}.part*"):
+            os.remove(path)
+    start_sharded_progress(conn, report_id, len(store_ids), sum(len(shards[k]) for k in shards_done), fingerprint)
+    _record_progress(conn, report_id, len(shards_done), len(shards))
+    if shards_done:
+        logger.info("Resuming report %s: %d of %d shards already done", report_id, len(shards_done), len(shards))
+    logger.info("Computing report %s in %d shards with %d processes", report_id, len(shards), workers)
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        futures = [executor.submit(compute_shard, report_id, report_filepath, shard_index, shard, bulk, engine, rollup,
+                                   windows, output, position)
+                   for shard_index, shard in enumerate(shards) if shard_index not in shards_done]
+        total_rows = 0
+        for done_count, future in enumerate(as_completed(futures), start=len(shards_done) + 1):
+            _, shard_rows, shard_metrics = future.result()
+            total_rows += shard_rows
+            merge(shard_metrics)
+            _record_progress(conn, report_id, done_count, len(shards))
+        executor.shutdown()
+
+        # Merged under a temporary name like the unsharded report, so a download never sees a partial file
+        columns = report_header(windows) if windows else REPORT_HEADER
+        if output is not None:
+            with SHARD_MERGE:
+                merge_columnar([shard_path(report_filepath, shard_index) for shard_index in range(len(shards))],
+                               f"{report_filepath}.tmp", columns, output)
+        else:
+            with SHARD_MERGE, open(f"{report_filepath}.tmp", 'w', newline='') as csvfile:
+                csv.writer(csvfile).writerow(columns)
+                for shard_index in range(len(shards)):
+                    with open(shard_path(report_filepath, shard_index), newline='') as partial:
+                        shutil.copyfileobj(partial, csvfile)
+        os.replace(f"{report_filepath}.tmp", report_filepath)
+        for shard_index in range(len(shards)):
+            os.remove(shard_path(report_filepath, shard_index))
+        return total_rows
+    finally:
+        # A failed shard cancels the shards that have not started yet. The finished shards stay for the next run.
+        executor.shutdown(cancel_futures=True)
+        for path in glob.glob(f"{glob.escape(report_filepath)}*.tmp"):
+            os.remove(path)
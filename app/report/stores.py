@@ -0,0 +1,75 @@
+import hashlib
+import os
+from typing import Dict, List, Optional, Tuple
+
+from app.report.metrics import DEFAULT_TIMEZONE
+
+# The stores table is the registry of the stores with polls, one row per store with its timezone. Triggers on
+# store_status and timezones keep it up to date (see create_table.py), so the stores of a report are found with
+# index lookups instead of a scan of the polls.
+
+# Most store ids a report request may list
+REPORT_MAX_STORE_IDS = int(os.environ.get('REPORT_MAX_STORE_IDS', '50000'))
+
+# Timezone a store's report is computed in: stores without a row in timezones are in DEFAULT_TIMEZONE. Matches the
+# expression of idx_stores_timezone.
+STORE_TIMEZONE = f"COALESCE(timezone_str, '{DEFAULT_TIMEZONE}')"
+
+STORE_REGISTERED_QUERY = "SELECT 1 FROM stores WHERE store_id = %s"
+
+ANY_STORE_QUERY = "SELECT 1 FROM stores LIMIT 1"
+
+# Selection of stores of a report request: a list of store ids ('store_ids') and the timezones of the stores
+# ('timezone', one or a list). Both are optional and combine; the selection is None when the request selects every
+# store. Raises ValueError for a malformed request.
+def parse_selection(data: Optional[Dict]) -> Optional[Dict[str, List[str]]]:
+    selection = {}
+    for field, key in (('store_ids', 'store_ids'), ('timezone', 'timezones')):
+        value = data.get(field) if data else None
+        if value is None or value == '' or value == []:
+            continue
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list) or not all(isinstance(item, str) and item for item in value):
+            raise ValueError(f"{field} must be a string or a list of strings")
+        selection[key] = sorted(set(value))
+    if len(selection.get('store_ids', ())) > REPORT_MAX_STORE_IDS:
+        raise ValueError(f"store_ids lists more than {REPORT_MAX_STORE_IDS} stores")
+    return selection or None
+
+# The stores of a selection in store_id order, which is the order the bulk path streams the polls in
+def selection_query(selection: Optional[Dict[str, List[str]]]) -> Tuple[str, List]:
+    clauses, params = [], []
+    if selection and 'store_ids' in selection:
+        clauses.append("store_id = ANY(%s)")
+        params.append(selection['store_ids'])
+    if selection and 'timezones' in selection:
+        clauses.append(f"{STORE_TIMEZONE} = ANY(%s)")
+        params.append(selection['timezones'])
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+    return f"SELECT store_id FROM stores{where} ORDER BY store_id", params
+
+def resolve_store_ids(cur, selection: Optional[Dict[str, List[str]]]) -> List[str]:
+    query, params = selection_query(selection)
+    cur.execute(query, params)
+    return [row[0] for row in cur.fetchall()]
+
+# Store ids listed in the selection that are not in the registry, given the registered stores among them
+def unknown_store_ids(selection: Optional[Dict[str, List[str]]], registered: List[str]) -> List[str]:
+    if not selection or 'store_ids' not in selection:
+        return []
+    registered = set(registered)
+    return [store_id for store_id in selection['store_ids'] if store_id not in registered]
+
+# Part of the dedup key of a report on the selected stores. A list of store ids is identified by its digest, so keys
+# stay short; the selection is kept whole in the report's params.
+def selection_key(selection: Optional[Dict[str, List[str]]]) -> str:
+    if not selection:
+        return '*'
+    parts = []
+    if 'store_ids' in selection:
+        digest = hashlib.md5('\n'.join(selection['store_ids']).encode()).hexdigest()
+        parts.append(f"ids:{len(selection['store_ids'])}:{digest}")
+    if 'timezones' in selection:
+        parts.append(f"tz:{','.join(selection['timezones'])}")
+    return ';'.join(parts)
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from app.report.bulk import MENU_HOURS_QUERY, TIMEZONES_QUERY
+from app.report.engines import StoreInputs, get_engine
+from app.report.metrics import REPORT_HEADER, BusinessHours, Poll, add_business_hours, resolve_timezone
+
+# Synchronous uptime of a few stores for GET /stores/<store_id>/uptime: the six metrics of the report, computed by
+# the same engine from the same inputs, returned as JSON without a report file. Computed rows are memoized per
+# process for UPTIME_CACHE_TTL seconds. A row is only reused while the store's latest poll and the versions of
+# menu_hours, timezones and rewritten polls are those it was computed from, so a new poll makes the next request
+# compute the store again; a late poll older than the store's latest one is seen once the TTL expires.
+
+UPTIME_CACHE_TTL = float(os.environ.get('UPTIME_CACHE_TTL', '5'))
+UPTIME_CACHE_SIZE = int(os.environ.get('UPTIME_CACHE_SIZE', '10000'))
+
+# Most stores one request may ask for
+UPTIME_MAX_STORES = int(os.environ.get('UPTIME_MAX_STORES', '20'))
+
+# Engine computing the rows. The numpy engine computes a store in about a tenth of the time of the python engine
+# and gives the same rows (see benchmarks/differential_engines.py); without numpy the python engine is used.
+UPTIME_ENGINE = os.environ.get('UPTIME_ENGINE', 'numpy')
+
+# Tables whose version is part of every cached row: polls that were updated or deleted, and the business hours and
+# timezones
+VERSION_TABLES = ['menu_hours', 'store_status:rewrites', 'timezones']
+
+# Latest poll of each requested store (NULL for an unknown store) and the versions of VERSION_TABLES, in one
+# round-trip. The latest poll is read with a backward scan of the (store_id, timestamp_utc) index.
+VALIDATORS_QUERY = """
+    SELECT s.store_id,
+        (SELECT MAX(p.timestamp_utc) FROM store_status p WHERE p.store_id = s.store_id),
+        (SELECT array_agg(COALESCE(v.version, 0) ORDER BY t.table_name)
+         FROM unnest(%s::text[]) t(table_name) LEFT JOIN data_versions v ON v.table_name = t.table_name)
+    FROM unnest(%s::text[]) s(store_id)
+"""
+
+# The 7 days of polls up to the latest poll the validators saw, so a poll written in between does not make the
+# polls disagree with the reference time. Sorting on the position of the store is cheaper than on its text id.
+WEEK_POLLS_QUERY = """
+    SELECT p.store_id, p.timestamp_utc, p.status
+    FROM unnest(%s::text[], %s::timestamptz[]) WITH ORDINALITY c(store_id, max_ts, position)
+    JOIN store_status p ON p.store_id = c.store_id
+        AND p.timestamp_utc >= c.max_ts - INTERVAL '7 days' AND p.timestamp_utc <= c.max_ts
+    ORDER BY c.position, p.timestamp_utc
+"""
+
+# What a cached row was computed from
+Validator = Tuple[datetime, Tuple[int, ...]]
+
+class CachedRow(NamedTuple):
+    validator: Validator
+    row: List
+    expires_at: float
+
+# Per-process LRU memo of report rows, keyed by store id
+class UptimeCache:
+    def __init__(self, ttl: float = UPTIME_CACHE_TTL, max_entries: int = UPTIME_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[str, CachedRow]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Cached rows of the stores whose validator is unchanged and whose entry has not expired
+    def lookup(self, validators: Dict[str, Validator]) -> Dict[str, List]:
+        now = time.monotonic()
+        rows = {}
+        with self.lock:
+            for store_id, validator in validators.items():
+                entry = self.entries.get(store_id)
+                if entry is not None and entry.validator == validator and entry.expires_at > now:
+                    self.entries.move_to_end(store_id)
+                    rows[store_id] = entry.row
+            self.hits += len(rows)
+            self.misses += len(validators) - len(rows)
+        return rows
+
+    def store(self, rows: Iterable[List], validators: Dict[str, Validator]) -> None:
+        if self.ttl <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for row in rows:
+                self.entries[row[0]] = CachedRow(validators[row[0]], row, expires_at)
+                self.entries.move_to_end(row[0])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {'entries': len(self.entries), 'hits_total': self.hits, 'misses_total': self.misses}
+
+uptime_cache = UptimeCache()
+
+# Store ids of a request for several stores: ?store_id=a&store_id=b or ?store_ids=a,b. Raises ValueError.
+def parse_store_ids(values: List[str]) -> List[str]:
+    store_ids = list(dict.fromkeys(store_id.strip() for value in values for store_id in value.split(',')
+                                   if store_id.strip()))
+    if not store_ids:
+        raise ValueError("Give the stores as ?store_id=<id>, repeated, or ?store_ids=<id>,<id>")
+    if len(store_ids) > UPTIME_MAX_STORES:
+        raise ValueError(f"At most {UPTIME_MAX_STORES} stores per request; use /trigger_report for more")
+    return store_ids
+
+# Validators of the known stores from the rows of VALIDATORS_QUERY, and the latest poll of each
+def read_validators(rows: Iterable[Tuple]) -> Tuple[Dict[str, Validator], Dict[str, datetime]]:
+    validators, max_times = {}, {}
+    for store_id, max_ts, versions in rows:
+        if max_ts is not None:
+            validators[store_id] = (max_ts, tuple(versions))
+            max_times[store_id] = max_ts
+    return validators, max_times
+
+# Engine inputs of the stores from the rows of TIMEZONES_QUERY, MENU_HOURS_QUERY and WEEK_POLLS_QUERY
+def build_inputs(max_times: Dict[str, datetime], timezone_rows: Iterable[Tuple], hours_rows: Iterable[Tuple],
+                 poll_rows: Iterable[Tuple]) -> List[StoreInputs]:
+    tz_strings = {store_id: tz_str for store_id, tz_str in timezone_rows}
+    business_hours: Dict[str, BusinessHours] = {}
+    for store_id, day_of_week, start_local, end_local in hours_rows:
+        add_business_hours(business_hours.setdefault(store_id, {}), day_of_week, start_local, end_local)
+    polls: Dict[str, List[Poll]] = {}
+    for store_id, timestamp_utc, status in poll_rows:
+        polls.setdefault(store_id, []).append((timestamp_utc, status))
+    return [StoreInputs(store_id, polls.get(store_id, []), business_hours.get(store_id, {}),
+                        resolve_timezone(store_id, tz_strings.get(store_id)), max_ts)
+            for store_id, max_ts in max_times.items()]
+
+def compute_rows(inputs: List[StoreInputs]) -> List[List]:
+    return get_engine(UPTIME_ENGINE)(inputs) if inputs else []
+
+# JSON of a report row, with the report's column names
+def uptime_json(row: List, last_poll_utc: datetime, cached: bool) -> Dict[str, object]:
+    return {**dict(zip(REPORT_HEADER, row)), 'last_poll_utc': last_poll_utc.isoformat(), 'cached': cached}
+
+# Uptime of the given stores through a psycopg2 connection, in the order asked for. Unknown stores are left out.
+def store_uptimes(conn, store_ids: List[str], cache: Optional[UptimeCache] = uptime_cache) -> List[Dict[str, object]]:
+    with conn.cursor() as cur:
+        cur.execute(VALIDATORS_QUERY, (VERSION_TABLES, store_ids))
+        validators, max_times = read_validators(cur.fetchall())
+        cached = cache.lookup(validators) if cache is not None else {}
+        missing = {store_id: max_ts for store_id, max_ts in max_times.items() if store_id not in cached}
+        computed: Dict[str, List] = {}
+        if missing:
+            missing_ids = list(missing)
+            cur.execute(TIMEZONES_QUERY, (missing_ids,))
+            timezone_rows = cur.fetchall()
+            cur.execute(MENU_HOURS_QUERY, (missing_ids,))
+            hours_rows = cur.fetchall()
+            cur.execute(WEEK_POLLS_QUERY, (missing_ids, list(missing.values())))
+            poll_rows = cur.fetchall()
+            computed = {row[0]: row for row in compute_rows(build_inputs(missing, timezone_rows, hours_rows, poll_rows))}
+            if cache is not None:
+                cache.store(computed.values(), validators)
+    conn.commit()
+    return [uptime_json(cached.get(store_id) or computed[store_id], max_times[store_id], store_id in cached)
+            for store_id in store_ids if store_id in max_times]
@@ -0,0 +1,166 @@
+import numpy as np
+from datetime import timedelta
+from typing import List, Tuple
+
+from app.report.metrics import compute_store_metrics, report_periods
+from app.timestamps import to_epoch_us
+
+MINUTE_US = 60 * 10**6
+HOUR_US = 60 * MINUTE_US
+
+# Store keys are packed as store_index * span + offset into a single int64, so one sorted array
+# can be searched for every store at once. Larger batches are split to keep the keys in range.
+MAX_PACKED_KEY = 2**62
+
+# Polls of all stores concatenated in store order; the polls of store k are times[offsets[k]:offsets[k + 1]]
+def _poll_arrays(stores) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    counts = np.fromiter((len(store.polls) for store in stores), dtype=np.int64, count=len(stores))
+    offsets = np.zeros(len(stores) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    total = int(offsets[-1])
+    if total and all(hasattr(store.polls, 'epochs') for store in stores):
+        # Polls from the resident poll store already are epoch arrays with a status bitmap
+        times = np.concatenate([np.frombuffer(store.polls.epochs, dtype=np.int64) for store in stores])
+        active = np.concatenate([
+            np.unpackbits(np.frombuffer(store.polls.bits, dtype=np.uint8), bitorder='little')[
+                store.polls.start:store.polls.start + len(store.polls)]
+            for store in stores
+        ]).astype(bool)
+        return offsets, times, active
+    times = np.fromiter((to_epoch_us(ts) for store in stores for ts, _ in store.polls), dtype=np.int64, count=total)
+    active = np.fromiter((status == 'active' for store in stores for _, status in store.polls), dtype=bool, count=total)
+    return offsets, times, active
+
+# One row per business period: owning store, open, close, whether it belongs to the last-hour window and
+# whether its day falls in the last-day window. The periods are the same ones the Python engine walks.
+def _period_arrays(stores) -> Tuple[np.ndarray, ...]:
+    store_index, opens, closes, is_hour, in_last_day = [], [], [], [], []
+    for k, store in enumerate(stores):
+        hour_periods, daily_periods = report_periods(store.store_id, store.business_hours, store.timezone, store.ref_time)
+        for business_opens_utc, business_closes_utc in hour_periods:
+            store_index.append(k)
+            opens.append(to_epoch_us(business_opens_utc))
+            closes.append(to_epoch_us(business_closes_utc))
+            is_hour.append(True)
+            in_last_day.append(False)
+        last_day_start = store.ref_time - timedelta(days=1)
+        for iter_utc_dt, business_periods in daily_periods:
+            for business_opens_utc, business_closes_utc in business_periods:
+                store_index.append(k)
+                opens.append(to_epoch_us(business_opens_utc))
+                closes.append(to_epoch_us(business_closes_utc))
+                is_hour.append(False)
+                in_last_day.append(iter_utc_dt >= last_day_start)
+    return (np.array(store_index, dtype=np.int64), np.array(opens, dtype=np.int64), np.array(closes, dtype=np.int64),
+            np.array(is_hour, dtype=bool), np.array(in_last_day, dtype=bool))
+
+# Active time inside [A, B] for every period. Inside the window the status is taken from the latest poll at or
+# before each instant, ignoring polls older than window_start; before the first such poll it is initial_active.
+def _active_us(keys, times, active, prefix, key_base, A, B, window_start, initial_active) -> np.ndarray:
+    lo = np.searchsorted(keys, key_base + window_start, side='left')
+    last_at_a = np.searchsorted(keys, key_base + A, side='right') - 1
+    first_inside = last_at_a + 1
+    last_inside = np.searchsorted(keys, key_base + B, side='left') - 1
+
+    if len(times) == 0:
+        return (B - A) * initial_active
+
+    last_index = len(times) - 1
+    status_at_a = np.where(last_at_a >= lo, active[np.clip(last_at_a, 0, last_index)], initial_active)
+
+    first_inside_c = np.clip(first_inside, 0, last_index)
+    last_inside_c = np.clip(last_inside, 0, last_index)
+    head = (times[first_inside_c] - A) * status_at_a
+    middle = prefix[last_inside_c] - prefix[first_inside_c]
+    tail = (B - times[last_inside_c]) * active[last_inside_c]
+    return np.where(last_inside >= first_inside, head + middle + tail, (B - A) * status_at_a)
+
+# Computes the report rows of a batch of stores with int64 epoch-microsecond arrays. Produces the same numbers
+# as compute_store_metrics: every period of every store is resolved with searchsorted over the concatenated polls
+# and the active durations between polls come from a single cumulative sum.
+def compute_batch_metrics(stores) -> List[List]:
+    if not stores:
+        return []
+
+    offsets, times, active = _poll_arrays(stores)
+    store_index, opens, closes, is_hour, in_last_day = _period_arrays(stores)
+
+    ref_us = np.array([to_epoch_us(store.ref_time) for store in stores], dtype=np.int64)
+    last_hour_start = ref_us - HOUR_US
+
+    base = min(int(times.min()) if len(times) else 0, int(opens.min()) if len(opens) else 0,
+               int(last_hour_start.min())) - HOUR_US
+    span = max(int(times.max()) if len(times) else 0, int(opens.max()) if len(opens) else 0,
+               int(closes.max()) if len(closes) else 0, int(ref_us.max())) - base + 1
+    if len(stores) > 1 and len(stores) * span >= MAX_PACKED_KEY:
+        middle_store = len(stores) // 2
+        return compute_batch_metrics(stores[:middle_store]) + compute_batch_metrics(stores[middle_store:])
+
+    poll_store = np.repeat(np.arange(len(stores), dtype=np.int64), np.diff(offsets))
+    keys = poll_store * span + (times - base)
+
+    # prefix[i] is the active time from the first poll up to poll i; only differences within a store are used
+    gaps = np.diff(times, append=times[-1:] if len(times) else times)
+    prefix = np.zeros(len(times) + 1, dtype=np.int64)
+    np.cumsum(gaps * active, out=prefix[1:])
+
+    # Status before the first poll of a window falls back to the store's first poll of the week when that poll
+    # is older than the start of the window, otherwise to inactive
+    has_polls = np.diff(offsets) > 0
+    first_poll = np.clip(offsets[:-1], 0, max(len(times) - 1, 0))
+    first_time = times[first_poll] if len(times) else np.zeros(len(stores), dtype=np.int64)
+    first_active = has_polls & (active[first_poll] if len(times) else False)
+
+    key_base = store_index * span - base
+    initial_store = first_active[store_index]
+    initial_time = first_time[store_index]
+
+    # Last hour: periods are clipped to [ref - 1h, ref], and the time between the start of the hour and the
+    # opening of the period is counted with the initial status
+    hour = np.flatnonzero(is_hour & (closes >= last_hour_start[store_index]) & (opens <= ref_us[store_index]))
+    hour_start = last_hour_start[store_index[hour]]
+    hour_b = np.minimum(ref_us[store_index[hour]], closes[hour])
+    hour_a = np.minimum(np.maximum(hour_start, opens[hour]), hour_b)
+    hour_initial = initial_store[hour] & (initial_time[hour] < hour_start)
+    hour_up = _active_us(keys, times, active, prefix, key_base[hour], hour_a, hour_b, hour_start - HOUR_US, hour_initial)
+    hour_up += (hour_a - hour_start) * hour_initial
+
+    # Day and week: each period is measured from its opening to its closing
+    day = np.flatnonzero(~is_hour)
+    day_opens, day_closes = opens[day], closes[day]
+    day_initial = initial_store[day] & (initial_time[day] < day_opens)
+    day_up = _active_us(keys, times, active, prefix, key_base[day], day_opens, day_closes, day_opens - HOUR_US, day_initial)
+    day_up = np.where(day_closes > day_opens, day_up, 0)
+    day_business = np.maximum(day_closes - day_opens, 0)
+    last_day = in_last_day[day]
+
+    def per_store(periods, values, mask=None):
+        if mask is not None:
+            periods, values = periods[mask], values[mask]
+        return np.bincount(store_index[periods], weights=values, minlength=len(stores))
+
+    uptime_hour = per_store(hour, hour_up)
+    business_hour = per_store(hour, hour_b - hour_start)
+    uptime_day = per_store(day, day_up, last_day)
+    business_day = per_store(day, day_business, last_day)
+    uptime_week = per_store(day, day_up)
+    business_week = per_store(day, day_business)
+
+    # Exact totals in microseconds, rounded to whole minutes/hours. A total that lands exactly on a half unit is a
+    # rounding tie whose outcome in compute_store_metrics depends on its floating point summation order, so those
+    # stores are recomputed with the reference implementation.
+    totals = np.rint(np.stack([
+        uptime_hour, uptime_day, uptime_week,
+        np.maximum(business_hour - uptime_hour, 0),
+        np.maximum(business_day - uptime_day, 0),
+        np.maximum(business_week - uptime_week, 0),
+    ], axis=1)).astype(np.int64)
+    units = np.array([MINUTE_US, HOUR_US, HOUR_US, MINUTE_US, HOUR_US, HOUR_US], dtype=np.int64)
+    rounded = (totals + units // 2) // units
+    ties = np.flatnonzero((totals % units == units // 2).any(axis=1))
+
+    rows = [[store.store_id] + rounded[k].tolist() for k, store in enumerate(stores)]
+    for k in ties:
+        store = stores[k]
+        rows[k] = compute_store_metrics(store.store_id, store.polls, store.business_hours, store.timezone, store.ref_time)
+    return rows
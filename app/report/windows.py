@@ -0,0 +1,284 @@
+import os
+import re
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from app.instrument import BUSINESS_HOURS, COMPUTE, DB_FETCH, timed_iter
+from app.log import get_logger
+from app.report.bulk import BULK_FETCH_SIZE, MAX_TIMESTAMPS_QUERY, fetch_business_hours, fetch_timezones
+from app.report.calendar import business_calendar
+from app.report.metrics import BusinessHours
+from app.timestamps import from_epoch_us, parse_timestamp, to_epoch_us, use_epoch_timestamps
+
+logger = get_logger(__name__)
+
+# Reports with custom windows (the last 15 minutes, the last 30 days...) and an optional as-of time. Each window
+# ends at the reference time (the as-of time, or else the store's latest poll) and covers the business time within
+# it: the store keeps the status of a poll until the next one, and its business periods come from its calendar.
+# Unlike the default report, whose day and week are whole UTC days, a window covers exactly its length.
+
+# Longest window a report may ask for. The polls of the longest window are streamed one store at a time, so the
+# time grows with the window while the memory holds a single store's polls.
+REPORT_MAX_WINDOW_DAYS = int(os.environ.get('REPORT_MAX_WINDOW_DAYS', '31'))
+
+MAX_WINDOWS = 12
+
+# A poll this long or less before a window gives the status at its start; without one the store starts the window
+# inactive. The default report gives polls the same hour of slack around business periods.
+STATUS_LOOKBACK = timedelta(hours=1)
+
+UNIT_SECONDS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+# Windows of a report that only asks for an as-of time
+DEFAULT_WINDOWS = ['1h', '1d', '1w']
+
+WINDOW_PATTERN = re.compile(r'^(\d+)([mhdw])$')
+
+class Window(NamedTuple):
+    spec: str
+    seconds: int
+
+class WindowSpec(NamedTuple):
+    windows: Tuple[Window, ...]
+    as_of: Optional[datetime]
+
+def parse_window(text: str) -> Window:
+    match = WINDOW_PATTERN.match(text.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid window '{text}': use a number and a unit m, h, d or w, e.g. 15m or 30d")
+    count, unit = int(match.group(1)), match.group(2)
+    seconds = count * UNIT_SECONDS[unit]
+    if seconds <= 0:
+        raise ValueError(f"Invalid window '{text}': windows must be longer than 0")
+    if seconds > REPORT_MAX_WINDOW_DAYS * 86400:
+        raise ValueError(f"Invalid window '{text}': windows are at most {REPORT_MAX_WINDOW_DAYS} days")
+    return Window(f"{count}{unit}", seconds)
+
+# Window spec of a report request: "windows" (a list, or a comma separated string, of lengths such as "15m", "1h",
+# "30d") and "as_of" (a timestamp). None when the request asks for neither, which is the default report. Raises
+# ValueError for a malformed request.
+def parse_window_spec(data: Optional[Dict]) -> Optional[WindowSpec]:
+    windows = data.get('windows') if data else None
+    as_of = data.get('as_of') if data else None
+    # true would otherwise be epoch second 1, and a dict would reach the timestamp parser
+    if as_of is not None and (isinstance(as_of, bool) or not isinstance(as_of, (str, int, float))):
+        raise ValueError("as_of must be a timestamp: an ISO 8601 string or epoch seconds")
+    if not windows and not as_of:
+        return None
+    if isinstance(windows, str):
+        windows = windows.split(',')
+    if windows is None or windows == []:
+        windows = DEFAULT_WINDOWS
+    if not isinstance(windows, list) or not all(isinstance(window, str) for window in windows):
+        raise ValueError("windows must be a list of window lengths such as \"15m\" or \"30d\"")
+    parsed, seen = [], set()
+    for text in windows:
+        window = parse_window(text)
+        # Windows of the same length would have the same columns
+        if window.seconds not in seen:
+            seen.add(window.seconds)
+            parsed.append(window)
+    if len(parsed) > MAX_WINDOWS:
+        raise ValueError(f"A report has at most {MAX_WINDOWS} windows")
+    return WindowSpec(tuple(parsed), parse_timestamp(as_of) if as_of else None)
+
+# The spec as stored in a queued report's params, and back
+def spec_params(spec: Optional[WindowSpec]) -> Optional[Dict]:
+    if spec is None:
+        return None
+    return {'windows': [window.spec for window in spec.windows],
+            'as_of': spec.as_of.isoformat() if spec.as_of else None}
+
+def spec_from_params(params: Optional[Dict]) -> Optional[WindowSpec]:
+    return parse_window_spec(params) if params else None
+
+# Part of the dedup key of a report with custom windows. 'columns=spec' leaves out the cached reports written with
+# the columns of the default report's names.
+def spec_key(spec: WindowSpec) -> str:
+    as_of = spec.as_of.isoformat() if spec.as_of else 'latest'
+    return f"windows:{','.join(window.spec for window in spec.windows)}@{as_of}:columns=spec"
+
+# Windows up to an hour are reported in minutes, longer ones in hours
+def _window_unit(window: Window) -> Tuple[str, int]:
+    return ('minutes', 60) if window.seconds <= 3600 else ('hours', 3600)
+
+# Columns of a report with custom windows, laid out like the default report: the uptime of every window, then the
+# downtime of every window. They are named by the window's length (uptime_1d), never like the columns of the default
+# report (uptime_last_day): the windows are trailing, the default report's day and week are whole UTC days, and the
+# numbers differ.
+def report_header(spec: WindowSpec) -> List[str]:
+    header = ['store_id']
+    for kind in ('uptime', 'downtime'):
+        header.extend(f"{kind}_{window.spec}({_window_unit(window)[0]})" for window in spec.windows)
+    return header
+
+# Totals at `at`, from the cumulative totals recorded at every change of status or business state. Between two
+# changes a total grows either at full rate or not at all.
+def _total_at(times: List[int], totals: List[int], at: int) -> int:
+    index = bisect_right(times, at) - 1
+    if index + 1 >= len(times):
+        return totals[-1]
+    if totals[index + 1] == totals[index]:
+        return totals[index]
+    return totals[index] + (at - times[index])
+
+# Report row of one store for every window of the spec, from a single pass over its polls (epoch microseconds and
+# status, sorted by time) and business periods. The pass records the cumulative uptime and business time at every
+# change of either, so each window is the difference of the totals at the reference time and at its start, and an
+# extra window costs two binary searches.
+def compute_window_metrics(store_id: str, polls: List[Tuple[int, str]], store_business_hours: BusinessHours,
+                           pytz_timezone, ref_time: datetime, spec: WindowSpec) -> List:
+    end_us = to_epoch_us(ref_time)
+    start_us = end_us - max(window.seconds for window in spec.windows) * 10**6
+    lookback_us = start_us - STATUS_LOOKBACK // timedelta(microseconds=1)
+
+    with BUSINESS_HOURS:
+        start = from_epoch_us(start_us)
+        calendar = business_calendar(store_id, store_business_hours, pytz_timezone,
+                                     start.date() - timedelta(days=1), ref_time.date() + timedelta(days=1))
+        # Open and close times, alternating; overlapping periods are merged
+        boundaries: List[int] = []
+        for opens, closes in calendar.intervals_between(start, ref_time):
+            opens_us, closes_us = max(to_epoch_us(opens), start_us), min(to_epoch_us(closes), end_us)
+            if closes_us <= opens_us:
+                continue
+            if boundaries and opens_us <= boundaries[-1]:
+                boundaries[-1] = max(boundaries[-1], closes_us)
+            else:
+                boundaries.extend((opens_us, closes_us))
+
+    # Status at the start of the longest window: that of the latest poll before it, if recent enough
+    active = False
+    poll_index = 0
+    while poll_index < len(polls) and polls[poll_index][0] <= start_us:
+        if polls[poll_index][0] >= lookback_us:
+            active = polls[poll_index][1] == 'active'
+        poll_index += 1
+
+    times, uptime, business = [start_us], [0], [0]
+    uptime_us = business_us = 0
+    boundary_index = 0
+    now = start_us
+    while now < end_us:
+        next_boundary = boundaries[boundary_index] if boundary_index < len(boundaries) else end_us
+        next_poll = polls[poll_index][0] if poll_index < len(polls) else end_us
+        change = min(next_boundary, next_poll, end_us)
+        if change > now:
+            # An odd number of boundaries passed means the store is open
+            if boundary_index % 2:
+                business_us += change - now
+                if active:
+                    uptime_us += change - now
+            now = change
+            times.append(now)
+            uptime.append(uptime_us)
+            business.append(business_us)
+        if now >= end_us:
+            break
+        if next_boundary == now and boundary_index < len(boundaries):
+            boundary_index += 1
+        elif poll_index < len(polls):
+            active = polls[poll_index][1] == 'active'
+            poll_index += 1
+
+    uptimes, downtimes = [], []
+    for window in spec.windows:
+        window_start_us = end_us - window.seconds * 10**6
+        window_uptime = uptime_us - _total_at(times, uptime, window_start_us)
+        window_business = business_us - _total_at(times, business, window_start_us)
+        unit_us = _window_unit(window)[1] * 10**6
+        uptimes.append(round(window_uptime / unit_us))
+        downtimes.append(round(max(0, window_business - window_uptime) / unit_us))
+    return [store_id] + uptimes + downtimes
+
+# Polls of the longest window and the lookback before it, ending at each store's latest poll or at the as-of time
+LATEST_WINDOW_POLLS_QUERY = """
+    WITH bounds AS (
+        SELECT store_id, MAX(timestamp_utc) AS max_ts
+        FROM store_status
+        WHERE store_id = ANY(%s)
+        GROUP BY store_id
+    )
+    SELECT s.store_id, s.timestamp_utc, s.status
+    FROM store_status s
+    JOIN bounds b ON b.store_id = s.store_id
+    WHERE s.timestamp_utc >= b.max_ts - %s
+    ORDER BY s.store_id, s.timestamp_utc
+"""
+
+AS_OF_WINDOW_POLLS_QUERY = """
+    SELECT store_id, timestamp_utc, status
+    FROM store_status
+    WHERE store_id = ANY(%s) AND timestamp_utc >= %s AND timestamp_utc <= %s
+    ORDER BY store_id, timestamp_utc
+"""
+
+# Streams the polls of the windows, as epoch microseconds, one (store_id, polls) group at a time
+def iter_window_polls(conn, store_ids: List[str], spec: WindowSpec) -> Iterator[Tuple[str, List[Tuple[int, str]]]]:
+    span = timedelta(seconds=max(window.seconds for window in spec.windows)) + STATUS_LOOKBACK
+    with conn.cursor(name='window_report_polls') as cur:
+        cur.itersize = BULK_FETCH_SIZE
+        use_epoch_timestamps(cur)
+        if spec.as_of is None:
+            cur.execute(LATEST_WINDOW_POLLS_QUERY, (store_ids, span))
+        else:
+            cur.execute(AS_OF_WINDOW_POLLS_QUERY, (store_ids, spec.as_of - span, spec.as_of))
+        current_store_id = None
+        current_polls: List[Tuple[int, str]] = []
+        for store_id, timestamp_us, status in cur:
+            if store_id != current_store_id:
+                if current_store_id is not None:
+                    yield current_store_id, current_polls
+                current_store_id = store_id
+                current_polls = []
+            current_polls.append((timestamp_us, status))
+        if current_store_id is not None:
+            yield current_store_id, current_polls
+
+# Rows of a report with custom windows, in the order of store_ids, computed as the polls of each store arrive. With
+# an as-of time every store gets a row; otherwise stores without polls are skipped, like in the default report.
+def iter_window_report_rows(conn, store_ids: List[str], spec: WindowSpec) -> Iterator[List]:
+    store_ids = list(dict.fromkeys(store_ids))
+    with DB_FETCH:
+        if spec.as_of is None:
+            with conn.cursor() as cur:
+                cur.execute(MAX_TIMESTAMPS_QUERY, (store_ids,))
+                ref_times: Dict[str, datetime] = dict(cur.fetchall())
+        else:
+            ref_times = {store_id: spec.as_of for store_id in store_ids}
+        timezones = fetch_timezones(conn, list(ref_times))
+        business_hours = fetch_business_hours(conn, store_ids)
+
+    def store_row(store_id: str, polls: List[Tuple[int, str]]) -> List:
+        with COMPUTE:
+            return compute_window_metrics(store_id, polls, business_hours.get(store_id, {}), timezones[store_id],
+                                          ref_times[store_id], spec)
+
+    pending_rows: Dict[str, List] = {}
+    next_index = 0
+
+    def ready_rows() -> Iterator[List]:
+        nonlocal next_index
+        while next_index < len(store_ids):
+            store_id = store_ids[next_index]
+            if store_id not in ref_times:
+                logger.warning("Store %s not found in store_status.", store_id)
+            elif store_id in pending_rows:
+                yield pending_rows.pop(store_id)
+            else:
+                return
+            next_index += 1
+
+    streamed = set()
+    for store_id, polls in timed_iter(iter_window_polls(conn, store_ids, spec), DB_FETCH):
+        streamed.add(store_id)
+        pending_rows[store_id] = store_row(store_id, polls)
+        yield from ready_rows()
+    for store_id in ref_times:
+        if store_id not in streamed:
+            pending_rows[store_id] = store_row(store_id, [])
+    yield from ready_rows()
+
+def window_report_rows(conn, store_ids: List[str], spec: WindowSpec) -> List[List]:
+    return list(iter_window_report_rows(conn, store_ids, spec))
@@ -0,0 +1,176 @@
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from app.log import get_logger
+from app.report.rollup import trim
+from app.report.windows import REPORT_MAX_WINDOW_DAYS, STATUS_LOOKBACK
+
+logger = get_logger(__name__)
+
+# Retention of store_status. Reports read at most REPORT_MAX_WINDOW_DAYS (plus the hour before the window, for the
+# status at its start) before a store's latest poll, so polls older than RETENTION_DAYS before the latest poll of
+# their store are compacted into hourly summaries in store_status_archive and deleted. The cutoff of each store is
+# an hour boundary, so an hour is summarized at once. Stores are processed RETENTION_BATCH_STORES at a time, each
+# batch in a short transaction of its own, so other writers are never held up for long; VACUUM afterwards makes the
+# freed space reusable, which keeps the table at the size of the retained polls.
+
+RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', '35'))
+RETENTION_BATCH_STORES = int(os.environ.get('RETENTION_BATCH_STORES', '200'))
+
+# Shortest horizon that leaves every report unchanged
+MIN_RETENTION = timedelta(days=REPORT_MAX_WINDOW_DAYS) + STATUS_LOOKBACK
+
+# Cutoff of each store of the batch: the hour boundary at or before its latest poll minus the horizon
+CUTOFFS_QUERY = """
+    SELECT s.store_id, date_trunc('hour', (
+        SELECT MAX(p.timestamp_utc) FROM store_status p WHERE p.store_id = s.store_id
+    ) - %s, 'UTC')
+    FROM unnest(%s::text[]) s(store_id)
+"""
+
+# Deletes the polls older than their store's cutoff and adds them to the hourly summaries in the same statement.
+# A poll that arrives late for an hour already summarized is added to the summary of that hour.
+COMPACT_QUERY = """
+    WITH moved AS (
+        DELETE FROM store_status p
+        USING unnest(%(store_ids)s::text[], %(cutoffs)s::timestamptz[]) c(store_id, cutoff_utc)
+        WHERE p.store_id = c.store_id AND p.timestamp_utc < c.cutoff_utc
+        RETURNING p.store_id, p.timestamp_utc, p.status
+    ), archived AS (
+        INSERT INTO store_status_archive AS a (store_id, hour_utc, polls, active_polls, first_poll_utc,
+                                               last_poll_utc, last_status)
+        SELECT store_id, date_trunc('hour', timestamp_utc, 'UTC'), count(*), count(*) FILTER (WHERE status = 'active'),
+            MIN(timestamp_utc), MAX(timestamp_utc), (array_agg(status ORDER BY timestamp_utc DESC))[1]
+        FROM moved
+        GROUP BY 1, 2
+        ON CONFLICT (store_id, hour_utc) DO UPDATE SET
+            polls = a.polls + EXCLUDED.polls,
+            active_polls = a.active_polls + EXCLUDED.active_polls,
+            first_poll_utc = LEAST(a.first_poll_utc, EXCLUDED.first_poll_utc),
+            last_poll_utc = GREATEST(a.last_poll_utc, EXCLUDED.last_poll_utc),
+            last_status = CASE WHEN EXCLUDED.last_poll_utc > a.last_poll_utc THEN EXCLUDED.last_status
+                               ELSE a.last_status END
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM moved), (SELECT count(*) FROM archived)
+"""
+
+# What a compaction would do, without changing anything
+DRY_RUN_QUERY = """
+    SELECT count(*), count(DISTINCT (p.store_id, date_trunc('hour', p.timestamp_utc, 'UTC')))
+    FROM store_status p
+    JOIN unnest(%(store_ids)s::text[], %(cutoffs)s::timestamptz[]) c(store_id, cutoff_utc)
+        ON p.store_id = c.store_id AND p.timestamp_utc < c.cutoff_utc
+"""
+
+TABLE_SIZE_QUERY = "SELECT pg_total_relation_size('store_status')"
+
+def parse_horizon(days: float) -> timedelta:
+    horizon = timedelta(days=days)
+    if horizon < MIN_RETENTION:
+        raise ValueError(f"A horizon of {days:g} days would change reports, which read up to "
+                         f"{REPORT_MAX_WINDOW_DAYS} days and {STATUS_LOOKBACK // timedelta(minutes=1)} minutes "
+                         f"before a store's latest poll")
+    return horizon
+
+# Registered stores in store_id order, a batch at a time, read with keyset pagination
+def _iter_store_batches(conn, batch_size: int) -> Iterator[List[str]]:
+    last_store_id = ''
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("SELECT store_id FROM stores WHERE store_id > %s ORDER BY store_id LIMIT %s",
+                        (last_store_id, batch_size))
+            store_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        if not store_ids:
+            return
+        yield store_ids
+        last_store_id = store_ids[-1]
+
+def _table_size(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute(TABLE_SIZE_QUERY)
+        size = cur.fetchone()[0]
+    conn.commit()
+    return size
+
+# Compacts the polls of one batch of stores in one transaction, first moving the rollups of the stores past their
+# cutoff. Returns the polls moved and the hourly summaries written.
+def _compact_batch(conn, store_ids: List[str], horizon: timedelta, dry_run: bool) -> Dict[str, int]:
+    try:
+        with conn.cursor() as cur:
+            cur.execute(CUTOFFS_QUERY, (horizon, store_ids))
+            cutoffs: Dict[str, datetime] = {store_id: cutoff for store_id, cutoff in cur.fetchall()
+                                            if cutoff is not None}
+            params = {'store_ids': list(cutoffs), 'cutoffs': list(cutoffs.values())}
+            if dry_run:
+                cur.execute(DRY_RUN_QUERY, params)
+                polls, hours = cur.fetchone()
+            else:
+                trim(cur, cutoffs)
+                cur.execute(COMPACT_QUERY, params)
+                polls, hours = cur.fetchone()
+    except Exception:
+        conn.rollback()
+        raise
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    return {'polls': polls, 'hours': hours}
+
+# Reclaims the space of the deleted polls for new ones. Plain VACUUM does not lock out readers or writers; the file
+# keeps its size, which later polls fill. VACUUM cannot run inside a transaction.
+def vacuum(conn) -> None:
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE store_status")
+            cur.execute("ANALYZE store_status_archive")
+    finally:
+        conn.autocommit = autocommit
+
+# Retention job: compacts the polls older than the horizon of every store, batch by batch, then vacuums
+# store_status. With dry_run nothing is changed and the polls that would be moved are counted.
+def run_retention(conn, days: float = RETENTION_DAYS, batch_stores: int = RETENTION_BATCH_STORES,
+                  dry_run: bool = False, reclaim: bool = True) -> Dict[str, object]:
+    horizon = parse_horizon(days)
+    size_before = _table_size(conn)
+    started = time.perf_counter()
+    stores, polls, hours, batches = 0, 0, 0, 0
+    for store_ids in _iter_store_batches(conn, batch_stores):
+        moved = _compact_batch(conn, store_ids, horizon, dry_run)
+        stores += len(store_ids)
+        polls += moved['polls']
+        hours += moved['hours']
+        batches += 1
+        logger.debug("Batch %d: %d polls of %d stores into %d hours", batches, moved['polls'], len(store_ids),
+                     moved['hours'])
+    compact_seconds = time.perf_counter() - started
+
+    vacuum_seconds: Optional[float] = None
+    if reclaim and not dry_run and polls:
+        vacuum_started = time.perf_counter()
+        vacuum(conn)
+        vacuum_seconds = time.perf_counter() - vacuum_started
+
+    result = {
+        'dry_run': dry_run,
+        'horizon_days': days,
+        'stores': stores,
+        'batches': batches,
+        'polls': polls,
+        'hours': hours,
+        'seconds': round(compact_seconds, 3),
+        'polls_per_second': round(polls / compact_seconds) if compact_seconds > 0 else 0,
+        'vacuum_seconds': round(vacuum_seconds, 3) if vacuum_seconds is not None else None,
+        'size_before_bytes': size_before,
+        'size_after_bytes': _table_size(conn),
+    }
+    logger.info("Retention%s: %d polls older than %g days of %d stores into %d hourly summaries in %.1fs (%d/s)",
+                " (dry run)" if dry_run else "", polls, days, stores, hours, compact_seconds,
+                result['polls_per_second'])
+    return result
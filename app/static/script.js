@@ -1,5 +1,8 @@
 document.addEventListener('DOMContentLoaded', () => {
     const storeIdInput = document.getElementById('storeIdInput');
+    const timezoneInput = document.getElementById('timezoneInput');
+    const windowsInput = document.getElementById('windowsInput');
+    const asOfInput = document.getElementById('asOfInput');
     const triggerReportBtn = document.getElementById('triggerReportBtn');
     const getReportBtn = document.getElementById('getReportBtn');
     const reportIdInput = document.getElementById('reportIdInput');
@@ -7,13 +10,56 @@ document.addEventListener('DOMContentLoaded', () => {
 
     triggerReportBtn.disabled = false;
 
+    // The async server (run_asgi.py) pushes the status of a report as server-sent events, so the page can say when
+    // it is ready without polling. Other servers answer 404 and the status is checked with the button as before.
+    const watchReport = (reportId) => {
+        if (!window.EventSource) {
+            return;
+        }
+        const events = new EventSource('/report_status/' + reportId);
+        events.addEventListener('status', (event) => {
+            const data = JSON.parse(event.data);
+            if (data.report_id !== reportIdInput.value.trim()) {
+                events.close();
+            } else if (data.status === 'Complete') {
+                statusArea.textContent = `Report ${reportId} is Complete. Use "Get Report Status" to download it.`;
+                events.close();
+            } else if (data.status === 'Error') {
+                statusArea.textContent = `Report ${reportId} processing failed.`;
+                statusArea.classList.add('error');
+                events.close();
+            } else if (data.status === 'Expired') {
+                events.close();
+            }
+        });
+        events.onerror = () => events.close();
+    };
+
     // When the button is clicked generate the report. The button can be clicked with or without a store_id
     triggerReportBtn.addEventListener('click', () => {
         const storeId = storeIdInput.value.trim();
+        // Several store ids, or a timezone, are run as one report on the selected stores
+        const storeIds = storeId.split(/[\s,]+/).filter(id => id);
+        const timezone = timezoneInput.value.trim();
         statusArea.textContent = storeId ? `Triggering report for Store ID: ${storeId}... Please wait.` : `Triggering reports for all stores... Please wait.`;
         statusArea.classList.remove('error');
 
-        const requestBody = storeId ? { store_id: storeId } : {};
+        const requestBody = storeIds.length === 1 && !timezone ? { store_id: storeIds[0] } : {};
+        if (storeIds.length > 1 || (storeIds.length === 1 && timezone)) {
+            requestBody.store_ids = storeIds;
+        }
+        if (timezone) {
+            requestBody.timezone = timezone;
+        }
+        // Custom windows and/or an as-of time, sent as typed; the server checks them
+        const windows = windowsInput.value.trim();
+        const asOf = asOfInput.value.trim();
+        if (windows) {
+            requestBody.windows = windows;
+        }
+        if (asOf) {
+            requestBody.as_of = asOf;
+        }
         console.log('Sending request to /trigger_report with body:', requestBody);
 
         fetch('/trigger_report', {
@@ -42,9 +88,17 @@ document.addEventListener('DOMContentLoaded', () => {
                     if (data.report_ids.length > 0) {
                         reportIdInput.value = data.report_ids[0].report_id;
                     }
+                } else if (data.report_id && data.cached) {
+                    reportIdInput.value = data.report_id;
+                    statusArea.textContent = `The data has not changed since report ${data.report_id} was generated. Use "Get Report Status" to download it.`;
+                } else if (data.report_id && data.stores) {
+                    reportIdInput.value = data.report_id;
+                    statusArea.textContent = `Report generation started for ${data.stores} stores with Report ID: ${data.report_id}. Please copy this ID and use "Get Report Status" to check.`;
+                    watchReport(data.report_id);
                 } else if (data.report_id) {
                     reportIdInput.value = data.report_id;
                     statusArea.textContent = `Report generation started for Store ID ${storeId} with Report ID: ${data.report_id}. Please copy this ID and use "Get Report Status" to check.`;
+                    watchReport(data.report_id);
                 } else if (data.error) {
                     statusArea.textContent = `Error triggering report: ${data.error} - ${data.details || ''}`;
                     statusArea.classList.add('error');
@@ -60,6 +114,18 @@ document.addEventListener('DOMContentLoaded', () => {
             });
     });
 
+    // Stores done, rate and time left of a queued or running report, as returned by /get_report
+    function describeProgress(progress) {
+        if (!progress) {
+            return '';
+        }
+        let text = `: ${progress.stores_done} of ${progress.stores_total} stores done (${progress.percent}%)`;
+        if (progress.stores_per_second !== null) {
+            text += `, ${progress.stores_per_second} stores/s, about ${Math.ceil(progress.eta_seconds)} s left`;
+        }
+        return text;
+    }
+
     // Handle the event where the button is clicked to check the status of the report generation
     getReportBtn.addEventListener('click', () => {
         const reportId = reportIdInput.value.trim();
@@ -99,8 +165,10 @@ document.addEventListener('DOMContentLoaded', () => {
             .then(result => {
                 if (result.type === 'json') {
                     const data = result.data;
-                    if (data.status === 'Running') {
-                        statusArea.textContent = `Report ${reportId} is Running. Please check again in a moment.`;
+                    if (data.status === 'Queued') {
+                        statusArea.textContent = `Report ${reportId} is Queued${describeProgress(data.progress)}. Please check again in a moment.`;
+                    } else if (data.status === 'Running') {
+                        statusArea.textContent = `Report ${reportId} is Running${describeProgress(data.progress)}. Please check again in a moment.`;
                     } else if (data.status === 'Error') {
                         statusArea.textContent = `Report ${reportId} processing failed.`;
                         statusArea.classList.add('error');
@@ -0,0 +1,97 @@
+import argparse
+import filecmp
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.api.endpoints import generate_report_logic, get_db_params
+from benchmarks.synthetic import generate_dataset, load_dataset
+
+# Counts the statements sent to the server. On a local socket a round-trip costs microseconds, so the
+# benchmark also projects the wall time for a database that is a network hop away.
+class CountingCursor(psycopg2.extensions.cursor):
+    statements = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.statements += 1
+        return super().execute(query, vars)
+
+# Runs one report through generate_report_logic and returns (seconds, statements, csv path)
+def run_report(store_ids, bulk: bool):
+    conn = psycopg2.connect(**get_db_params(), cursor_factory=CountingCursor)
+    CountingCursor.statements = 0
+    report_id = uuid.uuid4().hex
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO reports (report_id, status, created_at) VALUES (%s, 'Running', %s)",
+            (report_id, datetime.now(pytz.utc))
+        )
+        conn.commit()
+        started = time.perf_counter()
+        generate_report_logic(report_id, conn, store_ids, bulk)
+        elapsed = time.perf_counter() - started
+        statements = CountingCursor.statements - 1
+
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("SELECT status, report_path FROM reports WHERE report_id = %s", (report_id,))
+        status, report_path = cur.fetchone()
+    conn.close()
+    if status != 'Complete':
+        raise RuntimeError(f"Report {report_id} finished with status {status}")
+    return elapsed, statements, report_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per-store and bulk report paths on synthetic data")
+    parser.add_argument('--stores', type=int, default=10000)
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--rtt-ms', type=float, default=1.0, help="network round-trip time used for the projection")
+    parser.add_argument('--skip-load', action='store_true', help="reuse the data already in the database")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_db_params())
+    if not args.skip_load:
+        print(f"Loading synthetic data for {args.stores} stores into {get_db_params()['dbname']}...")
+        load_dataset(conn, generate_dataset(args.stores, polls_per_hour=args.polls_per_hour))
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT store_id FROM store_status ORDER BY store_id")
+        store_ids = [row[0] for row in cur.fetchall()]
+    conn.close()
+
+    # Per-store progress output would dominate the measurement
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        per_store_s, per_store_statements, per_store_path = run_report(store_ids, bulk=False)
+        bulk_s, bulk_statements, bulk_path = run_report(store_ids, bulk=True)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    identical = filecmp.cmp(per_store_path, bulk_path, shallow=False)
+    print(f"stores:          {len(store_ids)}")
+    print(f"per-store path:  {per_store_s:.2f}s, {per_store_statements} statements")
+    print(f"bulk path:       {bulk_s:.2f}s, {bulk_statements} statements")
+    print(f"speedup:         {per_store_s / bulk_s:.1f}x")
+    rtt_s = args.rtt_ms / 1000
+    per_store_remote = per_store_s + per_store_statements * rtt_s
+    bulk_remote = bulk_s + bulk_statements * rtt_s
+    print(f"projected at {args.rtt_ms:g}ms RTT: per-store {per_store_remote:.2f}s, bulk {bulk_remote:.2f}s, "
+          f"speedup {per_store_remote / bulk_remote:.1f}x")
+    print(f"identical CSV:   {identical}")
+    for path in (per_store_path, bulk_path):
+        os.remove(path)
+    if not identical:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
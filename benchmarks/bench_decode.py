@@ -0,0 +1,149 @@
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extensions
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.db import get_db_params
+from app.report.metrics import resolve_timezone
+from app.timestamps import TIMESTAMPTZ, TIMESTAMPTZ_EPOCH_US, parse_timestamp
+
+# The per-row decoding the report paths did before app/timestamps.py: psycopg2's caster, then this
+def legacy_parse_timestamp(timestamp):
+    if not(timestamp):
+        return None
+    if isinstance(timestamp, datetime):
+        return timestamp.astimezone(pytz.utc) if timestamp.tzinfo else pytz.utc.localize(timestamp)
+    try:
+        if timestamp.endswith(' UTC'):
+            timestamp = timestamp[:-4]
+        dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
+        return pytz.utc.localize(dt)
+    except ValueError:
+        dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        return dt.astimezone(pytz.utc) if dt.tzinfo else pytz.utc.localize(dt)
+
+def legacy_resolve_timezone(store_id, tz_str):
+    return pytz.timezone(tz_str or 'America/Chicago')
+
+# Timestamps as the server sends them for a UTC session ('2023-01-24 09:06:42.605777+00', trailing zeros of the
+# fraction dropped) and as they appear in the CSV files ('2023-01-24 09:06:42.605777 UTC')
+def generate_timestamps(count: int, seed: int) -> tuple:
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 18)
+    server, csv = [], []
+    for _ in range(count):
+        dt = start + timedelta(seconds=rng.randrange(14 * 86400), microseconds=rng.randrange(1000000))
+        text = dt.strftime('%Y-%m-%d %H:%M:%S.%f').rstrip('0').rstrip('.')
+        server.append(text + '+00')
+        csv.append(dt.strftime('%Y-%m-%d %H:%M:%S.%f') + ' UTC')
+    return server, csv
+
+def timed(function, values) -> float:
+    started = time.perf_counter()
+    for value in values:
+        function(value)
+    return time.perf_counter() - started
+
+def report(name: str, seconds: float, rows: int, baseline: float = None) -> None:
+    line = f"{name:<34} {seconds:8.2f}s {seconds / rows * 1e9:8.0f} ns/row"
+    if baseline:
+        line += f"  {baseline / seconds:5.1f}x"
+    print(line)
+
+# Fetches rows of store_status with psycopg2's timestamptz caster plus legacy_parse_timestamp, and with the
+# casters of app/timestamps.py, and returns the seconds of each
+def fetch_store_status(conn, limit: int) -> dict:
+    results = {}
+    cases = [
+        ('fetch: psycopg2 + parse_timestamp', psycopg2.extensions.PYDATETIMETZ, legacy_parse_timestamp),
+        ('fetch: UTC caster', TIMESTAMPTZ, None),
+        ('fetch: epoch caster', TIMESTAMPTZ_EPOCH_US, None),
+        ('fetch: no timestamps', None, None),
+    ]
+    for name, caster, parse in cases:
+        with conn.cursor(name='bench_decode') as cur:
+            cur.itersize = 20000
+            if caster is not None:
+                psycopg2.extensions.register_type(caster, cur)
+            column = 'timestamp_utc' if caster is not None else 'store_id'
+            started = time.perf_counter()
+            cur.execute(f"SELECT {column} FROM store_status LIMIT %s", (limit,))
+            rows = 0
+            if parse is not None:
+                for timestamp_utc, in cur:
+                    parse(timestamp_utc)
+                    rows += 1
+            else:
+                for _ in cur:
+                    rows += 1
+            results[name] = (time.perf_counter() - started, rows)
+        conn.commit()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-row cost of decoding poll timestamps, before and after the "
+                                                 "typed casters of app/timestamps.py")
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--batch', type=int, default=1_000_000, help="timestamps generated and decoded at a time")
+    parser.add_argument('--fetch-rows', type=int, default=0,
+                        help="also fetch up to this many rows of store_status with each decoder")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_db_params())
+    cur = conn.cursor()
+
+    legacy_db = lambda value: legacy_parse_timestamp(psycopg2.extensions.PYDATETIMETZ(value, cur))
+    utc_db = lambda value: TIMESTAMPTZ(value, cur)
+    epoch_db = lambda value: TIMESTAMPTZ_EPOCH_US(value, cur)
+    totals = {name: 0.0 for name in ('legacy_db', 'utc_db', 'epoch_db', 'legacy_csv', 'csv')}
+
+    # The decoders must agree before they are timed
+    server, csv = generate_timestamps(1000, seed=-1)
+    for server_text, csv_text in zip(server, csv):
+        expected = legacy_db(server_text)
+        if not (utc_db(server_text) == expected == parse_timestamp(csv_text) == legacy_parse_timestamp(csv_text)):
+            sys.exit(f"Decoders disagree on {server_text}")
+
+    done = 0
+    while done < args.rows:
+        count = min(args.batch, args.rows - done)
+        server, csv = generate_timestamps(count, seed=done)
+        totals['legacy_db'] += timed(legacy_db, server)
+        totals['utc_db'] += timed(utc_db, server)
+        totals['epoch_db'] += timed(epoch_db, server)
+        totals['legacy_csv'] += timed(legacy_parse_timestamp, csv)
+        totals['csv'] += timed(parse_timestamp, csv)
+        done += count
+
+    tz_names = ['America/Chicago', 'America/New_York', 'America/Denver', 'America/Los_Angeles', 'Asia/Beirut']
+    lookups = [tz_names[k % len(tz_names)] for k in range(min(args.rows, 1_000_000))]
+    legacy_tz = timed(lambda tz_str: legacy_resolve_timezone('1', tz_str), lookups)
+    cached_tz = timed(lambda tz_str: resolve_timezone('1', tz_str), lookups)
+
+    print(f"rows: {args.rows}")
+    report('server text, psycopg2 + parse', totals['legacy_db'], args.rows)
+    report('server text, UTC caster', totals['utc_db'], args.rows, totals['legacy_db'])
+    report('server text, epoch caster', totals['epoch_db'], args.rows, totals['legacy_db'])
+    report('CSV text, old parse_timestamp', totals['legacy_csv'], args.rows)
+    report('CSV text, parse_timestamp', totals['csv'], args.rows, totals['legacy_csv'])
+    report('timezone, pytz.timezone', legacy_tz, len(lookups))
+    report('timezone, cached', cached_tz, len(lookups), legacy_tz)
+
+    if args.fetch_rows:
+        results = fetch_store_status(conn, args.fetch_rows)
+        baseline = results['fetch: psycopg2 + parse_timestamp'][0]
+        for name, (seconds, rows) in results.items():
+            report(name, seconds, rows, baseline if name != 'fetch: psycopg2 + parse_timestamp' else None)
+    conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import csv
+import filecmp
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import psycopg2
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+import app.report.delta as delta_module
+from app.api.endpoints import generate_report_logic, get_db_params
+from app.report.delta import affected_stores, load_input_versions, read_input_versions, read_report_rows
+from benchmarks.synthetic import generate_dataset, load_dataset
+
+# Delta reports against a base report: loads synthetic polls into the configured database (the tables are
+# recreated, so point POSTGRES_DB at a scratch database), runs an all-stores report as the base, and a delta of it
+# before any change, which must be the same file. Then it changes the inputs of some stores: new polls for --churn
+# of the stores, and for a few stores each edited business hours, a status flipped on the latest poll and a late
+# poll inside the week. The stores found affected must be exactly those, the full delta must be the same file as a
+# report computed from scratch, and the diff must hold exactly the rows that differ. Prints the time of each report,
+# next to a full report that does not record its inputs.
+
+# Runs one all-stores bulk report, a delta report with a base, and returns (seconds, csv path)
+def run_report(store_ids, engine: str, delta=None):
+    conn = psycopg2.connect(**get_db_params())
+    report_id = uuid.uuid4().hex
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO reports (report_id, status, created_at, params) VALUES (%s, 'Running', %s, %s)",
+                    (report_id, datetime.now(pytz.utc), json.dumps({'source': 'raw', 'delta': delta})))
+    conn.commit()
+    started = time.perf_counter()
+    generate_report_logic(report_id, conn, store_ids, True, engine, delta=delta)
+    elapsed = time.perf_counter() - started
+
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("SELECT status, report_path FROM reports WHERE report_id = %s", (report_id,))
+        status, report_path = cur.fetchone()
+    conn.close()
+    if status != 'Complete':
+        raise RuntimeError(f"Report {report_id} finished with status {status}")
+    return report_id, elapsed, report_path
+
+# Changes the inputs of some stores and returns the stores changed
+def churn(conn, store_ids, churn_ratio: float, edits: int, rng: random.Random):
+    polled = rng.sample(store_ids, int(len(store_ids) * churn_ratio))
+    others = [store_id for store_id in store_ids if store_id not in set(polled)]
+    hours_edited, flipped, late = (others[index * edits:(index + 1) * edits] for index in range(3))
+    with conn.cursor() as cur:
+        cur.execute("SELECT store_id, MAX(timestamp_utc) FROM store_status WHERE store_id = ANY(%s) GROUP BY store_id",
+                    (polled + late,))
+        latest = dict(cur.fetchall())
+        new_polls = [(store_id, latest[store_id] + timedelta(minutes=rng.uniform(30, 90)), 'active')
+                     for store_id in polled]
+        # Late polls fall between two existing polls, a day before the latest
+        new_polls += [(store_id, latest[store_id] - timedelta(days=1, microseconds=rng.randrange(1, 10**6)), 'inactive')
+                      for store_id in late]
+        cur.executemany("INSERT INTO store_status (store_id, timestamp_utc, status) VALUES (%s, %s, %s)", new_polls)
+        cur.execute("""UPDATE menu_hours SET end_time_local = end_time_local - INTERVAL '30 minutes'
+                       WHERE store_id = ANY(%s)""", (hours_edited,))
+        cur.execute("""
+            UPDATE store_status p SET status = CASE p.status WHEN 'active' THEN 'inactive' ELSE 'active' END
+            FROM (SELECT store_id, MAX(timestamp_utc) AS max_ts FROM store_status WHERE store_id = ANY(%s)
+                  GROUP BY store_id) l
+            WHERE p.store_id = l.store_id AND p.timestamp_utc = l.max_ts
+        """, (flipped,))
+    conn.commit()
+    # Stores without business hours are open all the time, so editing their hours changes nothing
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT store_id FROM menu_hours WHERE store_id = ANY(%s)", (hours_edited,))
+        hours_edited = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return set(polled) | set(hours_edited) | set(flipped) | set(late)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time delta reports against a full report")
+    parser.add_argument('--stores', type=int, default=5000)
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--churn', type=float, default=0.05, help="share of the stores that get new polls")
+    parser.add_argument('--edits', type=int, default=10,
+                        help="stores with edited hours, with a flipped status and with a late poll, each")
+    parser.add_argument('--engine', default='numpy')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-load', action='store_true', help="reuse the data already in the database")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    conn = psycopg2.connect(**get_db_params())
+    if not args.skip_load:
+        print(f"Loading synthetic data for {args.stores} stores into {get_db_params()['dbname']}...")
+        load_dataset(conn, generate_dataset(args.stores, polls_per_hour=args.polls_per_hour, seed=args.seed))
+    with conn.cursor() as cur:
+        cur.execute("SELECT store_id FROM stores ORDER BY store_id")
+        store_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+
+    # The first report warms the caches and is not timed
+    failures, timings, paths = [], {}, []
+    delta_module.REPORT_RECORD_INPUTS = False
+    for _ in range(2):
+        _, timings['full, inputs not recorded'], path = run_report(store_ids, args.engine)
+        paths.append(path)
+    delta_module.REPORT_RECORD_INPUTS = True
+    base_id, timings['full (base)'], base_path = run_report(store_ids, args.engine)
+    _, timings['delta, no change'], same_path = run_report(store_ids, args.engine, {'base_report_id': base_id, 'mode': 'full'})
+    paths += [base_path, same_path]
+    if not filecmp.cmp(base_path, same_path, shallow=False):
+        failures.append("the delta of an unchanged base differs from the base")
+
+    changed = churn(conn, store_ids, args.churn, args.edits, rng)
+    with conn.cursor() as cur:
+        affected = set(affected_stores(store_ids, read_input_versions(conn, store_ids),
+                                       load_input_versions(cur, base_id), read_report_rows(base_path)))
+    conn.commit()
+    conn.close()
+    if affected != changed:
+        failures.append(f"{len(affected - changed)} stores found affected without a change, "
+                        f"{len(changed - affected)} changed stores missed")
+
+    _, timings['full after churn'], full_path = run_report(store_ids, args.engine)
+    _, timings['delta after churn'], delta_path = run_report(store_ids, args.engine, {'base_report_id': base_id, 'mode': 'full'})
+    _, timings['diff after churn'], diff_path = run_report(store_ids, args.engine, {'base_report_id': base_id, 'mode': 'diff'})
+    paths += [full_path, delta_path, diff_path]
+    if not filecmp.cmp(full_path, delta_path, shallow=False):
+        failures.append("the delta after churn differs from the full report")
+    base_rows, full_rows = read_report_rows(base_path), read_report_rows(full_path)
+    expected = {store_id for store_id, row in full_rows.items() if base_rows.get(store_id) != row}
+    with open(diff_path, newline='') as csvfile:
+        diff_rows = list(csv.reader(csvfile))[1:]
+    if {row[0] for row in diff_rows} != expected or any(row[:-1] != full_rows[row[0]] for row in diff_rows):
+        failures.append("the diff does not hold exactly the rows that changed")
+
+    print(f"stores: {len(store_ids)}, changed: {len(changed)}, rows changed: {len(expected)}, engine: {args.engine}")
+    for name, seconds in timings.items():
+        print(f"{name:>26}: {seconds:7.2f}s  {timings['full, inputs not recorded'] / seconds:5.1f}x as fast as a "
+              f"full report")
+    for path in paths:
+        os.remove(path)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+from typing import List, Tuple
+
+import psycopg2
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.api.endpoints import STORE_EXISTS_QUERY, STORE_MAX_TIMESTAMP_QUERY, STORE_WEEK_POLLS_QUERY, get_db_params
+from app.report.bulk import MAX_TIMESTAMPS_QUERY, WEEK_POLLS_QUERY
+from app.report.rollup import STORE_POLLS_QUERY
+from benchmarks.synthetic import generate_dataset, load_dataset
+from create_table import create_schema
+
+# The lookups as they were before the schema migration, casting the columns of every row: (query, parameters)
+LEGACY_QUERIES = {
+    'store exists': ("SELECT store_id FROM store_status WHERE store_id = %s", ('store_id',)),
+    'store max timestamp': ("SELECT MAX(timestamp_utc::timestamp) FROM store_status WHERE store_id = %s", ('store_id',)),
+    'store week polls': ("""
+        SELECT timestamp_utc, status FROM store_status
+        WHERE store_id = %s AND timestamp_utc::timestamp >= %s
+        ORDER BY timestamp_utc::timestamp
+    """, ('store_id', 'week_start')),
+    'bulk max timestamps': ("""
+        SELECT store_id, MAX(timestamp_utc::timestamp) FROM store_status
+        WHERE store_id::text = ANY(%s) GROUP BY store_id
+    """, ('store_ids',)),
+}
+
+# The same lookups after the migration, as the report paths run them
+QUERIES = {
+    'store exists': (STORE_EXISTS_QUERY, ('store_id',)),
+    'store max timestamp': (STORE_MAX_TIMESTAMP_QUERY, ('store_id',)),
+    'store week polls': (STORE_WEEK_POLLS_QUERY, ('store_id', 'week_start')),
+    'bulk max timestamps': (MAX_TIMESTAMPS_QUERY, ('store_ids',)),
+    'bulk week polls': (WEEK_POLLS_QUERY, ('store_ids',)),
+    'rollup store polls': (STORE_POLLS_QUERY, ('store_id', 'week_start', 'week_end')),
+}
+
+# Number of stores passed to the bulk queries; with every store a sequential scan is the right plan
+BULK_SAMPLE_SIZE = 50
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+# Scans of store_status in the plan of a query, and its problems: a sequential scan of store_status, or a sort of
+# the polls the index already orders
+def explain(cur, query: str, params) -> Tuple[List[str], List[str]]:
+    cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cur.fetchone()[0][0]['Plan']
+    scans, problems = [], []
+    for node in plan_nodes(plan):
+        if node.get('Relation Name') == 'store_status':
+            scans.append(node['Node Type'])
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == 'store_status':
+            problems.append('sequential scan of store_status')
+        if node['Node Type'] == 'Sort' and not any(
+                'Aggregate' in child['Node Type'] for child in node.get('Plans', [])):
+            problems.append(f"sort on {', '.join(node['Sort Key'])}")
+    return scans, problems
+
+# Average milliseconds per execution over the sample parameters
+def time_query(cur, query: str, samples) -> float:
+    started = time.perf_counter()
+    for params in samples:
+        cur.execute(query, params)
+        cur.fetchall()
+    return (time.perf_counter() - started) * 1000 / len(samples)
+
+def sample_params(cur, count: int, seed: int):
+    cur.execute("SELECT DISTINCT store_id FROM store_status")
+    store_ids = sorted(str(row[0]) for row in cur.fetchall())
+    rng = random.Random(seed)
+    chosen = rng.sample(store_ids, min(count, len(store_ids)))
+    cur.execute("SELECT MAX(timestamp_utc::text::timestamp) FROM store_status")
+    week_end = cur.fetchone()[0]
+    samples = [{'store_id': store_id, 'week_start': week_end - timedelta(days=7), 'week_end': week_end,
+                'store_ids': rng.sample(store_ids, min(BULK_SAMPLE_SIZE, len(store_ids)))}
+               for store_id in chosen]
+    return samples
+
+def measure(cur, queries, samples, label: str) -> dict:
+    results = {}
+    for name, (query, param_names) in queries.items():
+        query_samples = [tuple(sample[param_name] for param_name in param_names) for sample in samples]
+        scans, problems = explain(cur, query, query_samples[0])
+        results[name] = {'ms': time_query(cur, query, query_samples), 'scans': scans, 'problems': problems}
+        print(f"{label:7} {name:22} {results[name]['ms']:9.3f} ms   {', '.join(sorted(set(scans)))}"
+              + (f"   ({'; '.join(problems)})" if problems else ''))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the store_status lookups before and after the schema "
+                                                 "migration and check that they use the (store_id, timestamp_utc) index")
+    parser.add_argument('--stores', type=int, default=10000)
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--samples', type=int, default=200, help="number of stores each query is timed with")
+    parser.add_argument('--skip-load', action='store_true',
+                        help="reuse the data already in the database (only the migrated queries are measured)")
+    parser.add_argument('--json', help="write the timings and plan problems to this file")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_db_params())
+    report = {}
+    if not args.skip_load:
+        print(f"Loading synthetic data for {args.stores} stores into {get_db_params()['dbname']}...")
+        load_dataset(conn, generate_dataset(args.stores, polls_per_hour=args.polls_per_hour), migrate=False)
+        with conn.cursor() as cur:
+            cur.execute("CREATE INDEX idx_store_status_store_id ON store_status (store_id);"
+                        "CREATE INDEX idx_store_status_timestamp ON store_status (timestamp_utc);")
+            conn.commit()
+            report['before'] = measure(cur, LEGACY_QUERIES, sample_params(cur, args.samples, 0), 'before')
+        started = time.perf_counter()
+        create_schema(conn)
+        report['migration_s'] = time.perf_counter() - started
+        print(f"migration: {report['migration_s']:.1f}s")
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM store_status")
+        report['rows'] = cur.fetchone()[0]
+        report['after'] = measure(cur, QUERIES, sample_params(cur, args.samples, 0), 'after')
+        print(f"rows: {report['rows']}")
+    conn.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    # The sampled lookups must be served by the indexes; a report over every store may still scan the table
+    failed = [name for name, result in report['after'].items() if result['problems']]
+    if failed:
+        print(f"Queries not served by the index: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
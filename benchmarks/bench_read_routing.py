@@ -0,0 +1,245 @@
+import argparse
+import filecmp
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import psycopg2
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+import app.db as db
+from app.api.endpoints import generate_report_logic
+from app.db import get_db_params
+from app.ingest import INSERT_STAGED_QUERY, STAGING_TABLE_QUERY
+from app.report.progress import REPORT_STATUS_QUERY
+
+# Write and lookup latency on the primary while reports run, with the reports reading from the primary and with
+# them routed to the replicas given by --replicas (or POSTGRES_REPLICAS), e.g. a streaming replica of the configured
+# database started on the same machine:
+#   pg_basebackup -D /tmp/replica -R -X stream -h <primary>
+#   postgres -D /tmp/replica -p 5433 -c hot_standby_feedback=on
+# A writer thread adds batches of --batch polls to store_status the way the /polls flusher does (COPY into a staging
+# table, then INSERT of the new rows) and a reader thread looks up the status of a report like /get_report does,
+# first with no report running, then while --concurrency processes each run an all-stores report, once per routing.
+# Before that, a report read from the replica must be the same file as one read from the primary. Prints the
+# latency percentiles of every phase and the rows and buffers the primary read during it (from pg_stat_database);
+# the polls written are deleted afterwards. The latencies only improve with routing when the replicas do not share
+# the primary's CPUs and disks.
+
+# Rows returned and buffers read by the primary's database so far
+PRIMARY_READS_QUERY = """
+    SELECT tup_returned + tup_fetched, blks_hit + blks_read FROM pg_stat_database WHERE datname = current_database()
+"""
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def primary_reads(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_stat_clear_snapshot()")
+        cur.execute(PRIMARY_READS_QUERY)
+        row = cur.fetchone()
+    conn.commit()
+    return row
+
+# Runs one all-stores bulk report in a report process, reading from the given replicas (none: the primary), and
+# returns its path
+def run_report(engine: str, replicas: List[str], results=None) -> str:
+    db.POSTGRES_REPLICAS[:] = replicas
+    conn = psycopg2.connect(**get_db_params())
+    report_id = uuid.uuid4().hex
+    with conn.cursor() as cur:
+        cur.execute("SELECT store_id FROM stores WHERE store_id NOT LIKE 'routing-bench-%' ORDER BY store_id")
+        store_ids = [row[0] for row in cur.fetchall()]
+        cur.execute("INSERT INTO reports (report_id, status, created_at, params) VALUES (%s, 'Running', %s, %s)",
+                    (report_id, datetime.now(pytz.utc), json.dumps({'source': 'raw'})))
+    conn.commit()
+    generate_report_logic(report_id, conn, store_ids, True, engine)
+
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("SELECT status, report_path FROM reports WHERE report_id = %s", (report_id,))
+        status, report_path = cur.fetchone()
+    conn.close()
+    if status != 'Complete':
+        raise RuntimeError(f"Report {report_id} finished with status {status}")
+    if results is not None:
+        results.put((report_path, db.report_read_counts()))
+    return report_path
+
+# Adds batches of polls for stores of its own until stopped, recording the seconds of each batch
+class Writer(threading.Thread):
+    def __init__(self, run: str, batch: int, stop: threading.Event):
+        super().__init__(daemon=True)
+        self.run_id = run
+        self.batch = batch
+        self.stop = stop
+        self.latencies: List[float] = []
+        self.next_poll = datetime.now(pytz.utc)
+
+    def run(self) -> None:
+        conn = psycopg2.connect(**get_db_params())
+        with conn.cursor() as cur:
+            cur.execute(STAGING_TABLE_QUERY)
+        conn.commit()
+        while not self.stop.is_set():
+            data = io.StringIO()
+            for index in range(self.batch):
+                data.write(f"routing-bench-{self.run_id}-{index % 100},{self.next_poll.isoformat()},active\n")
+                self.next_poll += timedelta(microseconds=1)
+            data.seek(0)
+            started = time.perf_counter()
+            with conn.cursor() as cur:
+                cur.copy_expert("COPY polls_ingest (store_id, timestamp_utc, status) FROM STDIN WITH (FORMAT csv)", data)
+                cur.execute(INSERT_STAGED_QUERY)
+            conn.commit()
+            self.latencies.append(time.perf_counter() - started)
+            time.sleep(0.01)
+        conn.close()
+
+# Looks up the status of a report until stopped, recording the seconds of each lookup
+class StatusReader(threading.Thread):
+    def __init__(self, report_id: str, stop: threading.Event):
+        super().__init__(daemon=True)
+        self.report_id = report_id
+        self.stop = stop
+        self.latencies: List[float] = []
+
+    def run(self) -> None:
+        conn = psycopg2.connect(**get_db_params())
+        while not self.stop.is_set():
+            started = time.perf_counter()
+            with conn.cursor() as cur:
+                cur.execute(REPORT_STATUS_QUERY, (self.report_id,))
+                cur.fetchone()
+            conn.commit()
+            self.latencies.append(time.perf_counter() - started)
+            time.sleep(0.01)
+        conn.close()
+
+# Runs the writer and the reader alongside `concurrency` reports (for `seconds` without reports) and returns the
+# latencies, the seconds of the phase and the report paths
+def run_phase(run: str, report_id: str, batch: int, engine: str, concurrency: int, replicas: List[str],
+              seconds: float):
+    stop = threading.Event()
+    writer, reader = Writer(run, batch, stop), StatusReader(report_id, stop)
+    writer.start()
+    reader.start()
+    started = time.perf_counter()
+    paths, reads = [], {}
+    if concurrency:
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        processes = [context.Process(target=run_report, args=(engine, replicas, results)) for _ in range(concurrency)]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            path, counts = results.get()
+            paths.append(path)
+            for database, count in counts.items():
+                reads[database] = reads.get(database, 0) + count
+        for process in processes:
+            process.join()
+    else:
+        time.sleep(seconds)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    writer.join()
+    reader.join()
+    return writer.latencies, reader.latencies, elapsed, paths, reads
+
+def main():
+    parser = argparse.ArgumentParser(description="Primary write latency under concurrent reports, with and without "
+                                                 "read routing")
+    parser.add_argument('--replicas', default=';'.join(db.POSTGRES_REPLICAS),
+                        help="replica DSNs separated by ';' (default: POSTGRES_REPLICAS)")
+    parser.add_argument('--concurrency', type=int, default=2, help="reports running at once")
+    parser.add_argument('--batch', type=int, default=100, help="polls written per batch")
+    parser.add_argument('--engine', default='numpy')
+    parser.add_argument('--idle-seconds', type=float, default=10.0, help="length of the phase without reports")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    replicas = [dsn.strip() for dsn in args.replicas.split(';') if dsn.strip()]
+    if not replicas:
+        parser.error("give the replicas with --replicas or POSTGRES_REPLICAS")
+    run = uuid.uuid4().hex[:8]
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("SELECT report_id FROM reports ORDER BY created_at DESC LIMIT 1")
+        row = cur.fetchone()
+    conn.commit()
+    report_id = row[0] if row else run
+
+    failures, paths = [], []
+    try:
+        # Also warms the caches of both servers
+        primary_path = run_report(args.engine, [])
+        replica_path = run_report(args.engine, replicas)
+        paths += [primary_path, replica_path]
+        if db.report_read_counts().get('primary'):
+            failures.append("the report meant for a replica was read from the primary")
+        if not filecmp.cmp(primary_path, replica_path, shallow=False):
+            failures.append("the report read from the replica differs from the report read from the primary")
+
+        phases = {}
+        for name, concurrency, routing in [('no reports', 0, []), ('reports on the primary', args.concurrency, []),
+                                           ('reports on replicas', args.concurrency, replicas)]:
+            rows_before, buffers_before = primary_reads(conn)
+            writes, lookups, elapsed, phase_paths, reads = run_phase(run, report_id, args.batch, args.engine,
+                                                                     concurrency, routing, args.idle_seconds)
+            # The statistics are flushed by each backend within a second of its transactions
+            time.sleep(1.5)
+            rows_after, buffers_after = primary_reads(conn)
+            paths += phase_paths
+            phases[name] = {
+                'seconds': round(elapsed, 1),
+                'reads': reads,
+                'writes': len(writes),
+                'write_p50_ms': round(percentile(writes, 0.5) * 1000, 1),
+                'write_p99_ms': round(percentile(writes, 0.99) * 1000, 1),
+                'lookup_p50_ms': round(percentile(lookups, 0.5) * 1000, 2),
+                'lookup_p99_ms': round(percentile(lookups, 0.99) * 1000, 2),
+                'primary_rows_read': rows_after - rows_before,
+                'primary_buffers_read': buffers_after - buffers_before,
+            }
+            if routing and reads.get('primary'):
+                failures.append(f"{reads['primary']} of the routed reports fell back to the primary")
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM store_status WHERE store_id LIKE %s", (f"routing-bench-{run}-%",))
+        conn.commit()
+        conn.close()
+        for path in paths:
+            os.remove(path)
+
+    if args.json:
+        print(json.dumps({'concurrency': args.concurrency, 'batch': args.batch, 'phases': phases}, indent=2))
+    else:
+        print(f"{args.concurrency} concurrent all-stores reports, batches of {args.batch} polls, "
+              f"replicas: {', '.join(replicas)}")
+        for name, phase in phases.items():
+            print(f"{name:>23}: {phase['seconds']:6.1f}s, {phase['writes']:5d} batches written, "
+                  f"write p50 {phase['write_p50_ms']:6.1f} ms p99 {phase['write_p99_ms']:6.1f} ms, "
+                  f"lookup p50 {phase['lookup_p50_ms']:5.2f} ms p99 {phase['lookup_p99_ms']:6.2f} ms, primary read "
+                  f"{phase['primary_rows_read']} rows, {phase['primary_buffers_read']} buffers")
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import io
+import json
+import os
+import random
+import sys
+from datetime import timedelta
+
+import psycopg2
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.db import get_db_params
+from app.api.endpoints import compute_report_rows
+from app.report.rollup import catch_up, check_consistency, rollup_report_rows
+from app.report.windows import parse_window_spec
+from app.retention import run_retention
+from benchmarks.synthetic import generate_dataset, load_dataset
+
+# Retention over time: loads --days of synthetic polls into the configured database (the tables are recreated, so
+# point POSTGRES_DB at a scratch database), then runs --cycles rounds of adding --cycle-days of new polls, catching
+# up the rollups and running the retention job. Each round checks that the default, rollup, custom window and
+# per-store reports are the same before and after retention, that the rollups match a recompute from the
+# remaining polls, and that a dry run counts what the real run moves. It prints the rows and the heap and index
+# sizes of store_status after each round, which should level off once the history is longer than the horizon.
+
+WINDOWS = '1h,1d,1w,30d'
+
+# Polls of every store for the next `days` days after its latest poll, about polls_per_hour an hour
+def append_polls(conn, days: float, polls_per_hour: float, rng: random.Random) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT store_id, MAX(timestamp_utc) FROM store_status GROUP BY store_id")
+        latest = cur.fetchall()
+        buffer = io.StringIO()
+        count = 0
+        interval_s = 3600 / polls_per_hour
+        for store_id, ts in latest:
+            end = ts + timedelta(days=days)
+            ts += timedelta(seconds=rng.uniform(0.5, 1.5) * interval_s)
+            while ts <= end:
+                status = 'active' if rng.random() < 0.8 else 'inactive'
+                buffer.write(f"{store_id}\t{ts.isoformat()}\t{status}\n")
+                count += 1
+                ts += timedelta(seconds=rng.uniform(0.5, 1.5) * interval_s)
+        buffer.seek(0)
+        cur.copy_expert("COPY store_status (store_id, timestamp_utc, status) FROM STDIN", buffer)
+    conn.commit()
+    return count
+
+def report_rows(conn, store_ids, window_spec, sample):
+    rows = {
+        'bulk': compute_report_rows(conn, store_ids, bulk=True),
+        'rollup': rollup_report_rows(conn, store_ids),
+        'windows': compute_report_rows(conn, store_ids, windows=window_spec),
+        'per_store': compute_report_rows(conn, sample),
+    }
+    conn.rollback()
+    return rows
+
+def table_stats(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*), pg_relation_size('store_status'), pg_indexes_size('store_status') FROM store_status")
+        polls, heap_size, index_size = cur.fetchone()
+        cur.execute("SELECT count(*) FROM store_status_archive")
+        archived_hours = cur.fetchone()[0]
+    conn.commit()
+    return polls, heap_size, index_size, archived_hours
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that retention keeps reports and the table size steady")
+    parser.add_argument('--stores', type=int, default=500)
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--days', type=int, default=45, help="days of polls loaded at the start")
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--cycle-days', type=float, default=7.0, help="days of polls added per cycle")
+    parser.add_argument('--retention-days', type=float, default=35.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print the results of each cycle as JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    window_spec = parse_window_spec({'windows': WINDOWS})
+    conn = psycopg2.connect(**get_db_params())
+    print(f"Loading {args.days} days of synthetic polls for {args.stores} stores into {get_db_params()['dbname']}...")
+    load_dataset(conn, generate_dataset(args.stores, polls_per_hour=args.polls_per_hour, days=args.days,
+                                        seed=args.seed))
+    with conn.cursor() as cur:
+        cur.execute("SELECT store_id FROM stores ORDER BY store_id")
+        store_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    sample = rng.sample(store_ids, min(50, len(store_ids)))
+
+    results, failures = [], []
+    for cycle in range(args.cycles + 1):
+        added = append_polls(conn, args.cycle_days, args.polls_per_hour, rng) if cycle else 0
+        catch_up(conn)
+        before = report_rows(conn, store_ids, window_spec, sample)
+        dry_run = run_retention(conn, args.retention_days, dry_run=True)
+        result = run_retention(conn, args.retention_days)
+        after = report_rows(conn, store_ids, window_spec, sample)
+        differences = check_consistency(conn)
+        catch_up(conn)
+
+        changed = [name for name in before if before[name] != after[name]]
+        if changed:
+            failures.append(f"cycle {cycle}: {', '.join(changed)} reports changed")
+        if differences:
+            failures.append(f"cycle {cycle}: {len(differences)} rollup buckets differ from a recompute")
+        if dry_run['polls'] != result['polls']:
+            failures.append(f"cycle {cycle}: the dry run counted {dry_run['polls']} polls, {result['polls']} moved")
+
+        polls, heap_size, index_size, archived_hours = table_stats(conn)
+        results.append({
+            'cycle': cycle,
+            'added': added,
+            'moved': result['polls'],
+            'polls_per_second': result['polls_per_second'],
+            'vacuum_seconds': result['vacuum_seconds'],
+            'polls': polls,
+            'heap_bytes': heap_size,
+            'index_bytes': index_size,
+            'archived_hours': archived_hours,
+            'reports_identical': not changed,
+            'rollup_differences': len(differences),
+        })
+    conn.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'cycle':>5} {'added':>8} {'moved':>8} {'moved/s':>9} {'polls':>9} {'heap MiB':>9} {'index MiB':>9} "
+              f"{'archived h':>10} {'identical':>9}")
+        for row in results:
+            print(f"{row['cycle']:>5} {row['added']:>8} {row['moved']:>8} {row['polls_per_second']:>9,} "
+                  f"{row['polls']:>9} {row['heap_bytes'] / 2**20:>9.1f} {row['index_bytes'] / 2**20:>9.1f} "
+                  f"{row['archived_hours']:>10} "
+                  f"{str(row['reports_identical'] and not row['rollup_differences']):>9}")
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import filecmp
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import psycopg2
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.api.endpoints import generate_report_logic, get_db_params
+from benchmarks.synthetic import generate_dataset, load_dataset
+
+# Runs one all-stores bulk report with the given number of shard processes and returns (seconds, csv path)
+def run_report(store_ids, workers: int, engine: str):
+    conn = psycopg2.connect(**get_db_params())
+    report_id = uuid.uuid4().hex
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO reports (report_id, status, created_at) VALUES (%s, 'Running', %s)",
+            (report_id, datetime.now(pytz.utc))
+        )
+    conn.commit()
+    started = time.perf_counter()
+    generate_report_logic(report_id, conn, store_ids, True, engine, False, workers)
+    elapsed = time.perf_counter() - started
+
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("SELECT status, report_path FROM reports WHERE report_id = %s", (report_id,))
+        status, report_path = cur.fetchone()
+    conn.close()
+    if status != 'Complete':
+        raise RuntimeError(f"Report {report_id} finished with status {status}")
+    return elapsed, report_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the all-stores report with 1, 2, 4 and 8 shard processes")
+    parser.add_argument('--stores', type=int, default=10000)
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--engine', default='python')
+    parser.add_argument('--skip-load', action='store_true', help="reuse the data already in the database")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_db_params())
+    if not args.skip_load:
+        print(f"Loading synthetic data for {args.stores} stores into {get_db_params()['dbname']}...")
+        load_dataset(conn, generate_dataset(args.stores, polls_per_hour=args.polls_per_hour))
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT store_id FROM store_status ORDER BY store_id")
+        store_ids = [row[0] for row in cur.fetchall()]
+    conn.close()
+
+    # Per-store progress output would dominate the measurement
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    results = []
+    try:
+        for workers in args.workers:
+            results.append((workers,) + run_report(store_ids, workers, args.engine))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(f"stores: {len(store_ids)}, cores: {os.cpu_count()}, engine: {args.engine}")
+    baseline_s, baseline_path = results[0][1], results[0][2]
+    identical = True
+    for workers, elapsed, report_path in results:
+        same = filecmp.cmp(baseline_path, report_path, shallow=False)
+        identical = identical and same
+        print(f"{workers} workers: {elapsed:7.2f}s  speedup {baseline_s / elapsed:4.2f}x  "
+              f"same CSV as {results[0][0]} worker(s): {same}")
+    for _, _, report_path in results:
+        os.remove(report_path)
+    if not identical:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import contextlib
+import os
+import sys
+import time
+from datetime import datetime
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.report.calendar import invalidate_business_calendars
+from app.report.engines import ENGINES
+from benchmarks.synthetic import generate_dataset, store_inputs_from_dataset
+
+# (name, latest poll, polls per hour). The March and November scenarios put the week across the US DST changes.
+SCENARIOS = [
+    ('january', datetime(2023, 1, 25, 18, 13, 22), 1.0),
+    ('sparse-polls', datetime(2023, 1, 25, 18, 13, 22), 0.3),
+    ('dense-polls', datetime(2023, 1, 25, 18, 13, 22), 6.0),
+    ('dst-spring-forward', datetime(2023, 3, 14, 9, 30, 0), 1.0),
+    ('dst-fall-back', datetime(2023, 11, 7, 7, 45, 0), 1.0),
+]
+
+# Runs every engine on the same inputs and reports the rows that differ from the python engine
+def run_scenario(name: str, end_utc: datetime, polls_per_hour: float, stores: int, seed: int) -> int:
+    inputs = store_inputs_from_dataset(generate_dataset(stores, polls_per_hour=polls_per_hour, seed=seed, end_utc=end_utc))
+    results, timings = {}, {}
+    for engine_name, engine in ENGINES.items():
+        # Every engine starts with cold business calendars so the timings are comparable
+        invalidate_business_calendars()
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results[engine_name] = engine(inputs)
+        timings[engine_name] = time.perf_counter() - started
+
+    mismatches = 0
+    for engine_name, rows in results.items():
+        for expected, actual in zip(results['python'], rows):
+            if expected != actual:
+                mismatches += 1
+                print(f"  [{name}] {engine_name} differs: expected {expected}, got {actual}")
+    summary = ', '.join(f"{engine_name} {seconds:.2f}s" for engine_name, seconds in timings.items())
+    print(f"{name}: {len(inputs)} stores, {mismatches} mismatches ({summary})")
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that every report engine matches the python engine")
+    parser.add_argument('--stores', type=int, default=1000)
+    parser.add_argument('--seeds', type=int, default=3)
+    args = parser.parse_args()
+
+    mismatches = 0
+    for seed in range(args.seeds):
+        for name, end_utc, polls_per_hour in SCENARIOS:
+            mismatches += run_scenario(f"{name}/seed{seed}", end_utc, polls_per_hour, args.stores, seed)
+    if mismatches:
+        print(f"FAILED: {mismatches} mismatching rows")
+        sys.exit(1)
+    print("All engines agree")
+
+if __name__ == '__main__':
+    main()
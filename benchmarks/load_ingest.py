@@ -0,0 +1,190 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import psycopg2
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.db import get_db_params
+
+# Load generator for POST /polls. The batches are generated before the clock starts, for stores named
+# loadgen-<run>-<n> and timestamps after --start, and sent by --concurrency keep-alive connections; a batch refused
+# with 503 is sent again after its Retry-After. With --duplicates a share of the batches is sent twice, which must
+# not add rows. The run then waits until store_status holds every poll, and reports the rate polls were accepted
+# at, the rate they reached the table at, the request latencies and the refusals. The generated polls are deleted
+# afterwards unless --keep is given.
+
+def generate_batches(store_ids: List[str], polls: int, batch_size: int, start: datetime, fmt: str,
+                     seed: int) -> List[bytes]:
+    rng = random.Random(seed)
+    stores = len(store_ids)
+    per_store = [0] * stores
+    batches = []
+    for batch_start in range(0, polls, batch_size):
+        rows = []
+        for _ in range(min(batch_size, polls - batch_start)):
+            index = rng.randrange(stores)
+            per_store[index] += 1
+            # About one poll an hour per store, so the polls of a store never share a timestamp
+            timestamp = start + timedelta(hours=per_store[index], seconds=rng.uniform(0, 60))
+            status = 'active' if rng.random() < 0.9 else 'inactive'
+            rows.append((store_ids[index], timestamp.isoformat(), status))
+        if fmt == 'csv':
+            body = 'store_id,timestamp_utc,status\n' + ''.join(f"{row[0]},{row[1]},{row[2]}\n" for row in rows)
+        else:
+            body = ''.join(json.dumps({'store_id': row[0], 'timestamp_utc': row[1], 'status': row[2]}) + '\n'
+                           for row in rows)
+        batches.append(body.encode())
+    return batches
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Sender(threading.Thread):
+    def __init__(self, url, content_type: str, queue: List[bytes], lock: threading.Lock):
+        super().__init__(daemon=True)
+        self.url = url
+        self.content_type = content_type
+        self.queue = queue
+        self.lock = lock
+        self.latencies: List[float] = []
+        self.refused = 0
+        self.errors: Dict[int, int] = {}
+        self.accepted = 0
+
+    def run(self) -> None:
+        conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+        while True:
+            with self.lock:
+                if not self.queue:
+                    break
+                body = self.queue.pop()
+            while True:
+                started = time.perf_counter()
+                conn.request('POST', '/polls', body=body, headers={'Content-Type': self.content_type})
+                response = conn.getresponse()
+                payload = response.read()
+                self.latencies.append(time.perf_counter() - started)
+                if response.status == 503:
+                    self.refused += 1
+                    time.sleep(float(response.getheader('Retry-After') or 1))
+                    continue
+                if response.status >= 300:
+                    self.errors[response.status] = self.errors.get(response.status, 0) + 1
+                else:
+                    self.accepted += json.loads(payload)['accepted']
+                break
+        conn.close()
+
+def count_polls(conn, store_ids: List[str]) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM store_status WHERE store_id = ANY(%s)", (store_ids,))
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+def delete_polls(conn, store_ids: List[str]) -> None:
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM store_status WHERE store_id = ANY(%s)", (store_ids,))
+    conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the /polls ingestion endpoint")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Flask (5000) or ASGI server")
+    parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    parser.add_argument('--polls', type=int, default=500000)
+    parser.add_argument('--batch', type=int, default=5000, help="polls per request")
+    parser.add_argument('--concurrency', type=int, default=4, help="connections sending batches")
+    parser.add_argument('--stores', type=int, default=2000)
+    parser.add_argument('--duplicates', type=float, default=0.0, help="share of the batches sent twice")
+    parser.add_argument('--start', default='2030-01-01T00:00:00+00:00', help="timestamp of the first polls")
+    parser.add_argument('--timeout', type=float, default=120.0, help="seconds to wait for the polls to be written")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help="keep the generated polls in store_status")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    start = datetime.fromisoformat(args.start).astimezone(pytz.utc)
+    store_ids = [f"loadgen-{run_id}-{index:05d}" for index in range(args.stores)]
+    batches = generate_batches(store_ids, args.polls, args.batch, start, args.format, args.seed)
+    rng = random.Random(args.seed)
+    queue = batches + [batch for batch in batches if rng.random() < args.duplicates]
+    rng.shuffle(queue)
+    duplicate_batches = len(queue) - len(batches)
+    content_type = 'text/csv' if args.format == 'csv' else 'application/x-ndjson'
+
+    conn = psycopg2.connect(**get_db_params())
+    try:
+        lock = threading.Lock()
+        senders = [Sender(urlsplit(args.url), content_type, queue, lock) for _ in range(args.concurrency)]
+        started = time.perf_counter()
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        sent_seconds = time.perf_counter() - started
+
+        written = count_polls(conn, store_ids)
+        deadline = time.perf_counter() + args.timeout
+        while written < args.polls and time.perf_counter() < deadline:
+            time.sleep(0.05)
+            written = count_polls(conn, store_ids)
+        written_seconds = time.perf_counter() - started
+
+        latencies = [latency for sender in senders for latency in sender.latencies]
+        errors: Dict[int, int] = {}
+        for sender in senders:
+            for status, count in sender.errors.items():
+                errors[status] = errors.get(status, 0) + count
+        accepted = sum(sender.accepted for sender in senders)
+        results = {
+            'url': args.url,
+            'format': args.format,
+            'polls': args.polls,
+            'batch': args.batch,
+            'concurrency': args.concurrency,
+            'requests': len(latencies),
+            'duplicate_batches': duplicate_batches,
+            'accepted': accepted,
+            'written': written,
+            'refused_503': sum(sender.refused for sender in senders),
+            'errors': errors,
+            'accepted_per_second': round(accepted / sent_seconds),
+            'written_per_second': round(written / written_seconds),
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        }
+    finally:
+        if not args.keep:
+            delete_polls(conn, store_ids)
+        conn.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['requests']} requests of {args.batch} polls ({results['duplicate_batches']} duplicate batches), "
+              f"{results['refused_503']} refused with 503, errors {errors or 'none'}")
+        print(f"accepted {accepted} polls at {results['accepted_per_second']:,}/s, "
+              f"latency p50 {results['latency_p50_ms']} ms, p99 {results['latency_p99_ms']} ms")
+        print(f"written {written} of {args.polls} polls at {results['written_per_second']:,}/s end to end")
+    if written != args.polls:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import psycopg2
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.api.endpoints import REPORT_HEADER, REPORTS_DIR
+from app.db import get_db_params
+
+# Load test of clients waiting for reports. Every client waits for one of a few 'Running' reports, which the script
+# marks Complete after a while, and each target is measured separately:
+#   poll      GET /get_report/<id> every --poll-interval seconds, as the frontend does (Flask and ASGI servers)
+#   longpoll  GET /report_status/<id>?wait=, answered when the report finishes (ASGI server)
+#   sse       GET /report_status/<id> with Accept: text/event-stream (ASGI server)
+# It reports the latency of the status requests, how long after the report finished each client learned about it,
+# and the database transactions the run cost.
+
+FINAL_STATUSES = ('Complete', 'Error', 'Expired')
+
+# Minimal HTTP/1.1 client on asyncio streams: keep-alive, Content-Length and chunked bodies. Thousands of them run
+# in one process without a thread each.
+class HttpConnection:
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def _send(self, path: str, headers: Dict[str, str]) -> None:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"GET {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        await self.writer.drain()
+
+    async def _read_head(self) -> Tuple[int, Dict[str, str], bool]:
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        version, status = status_line.split()[:2]
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        keep_alive = version == b'HTTP/1.1' and response_headers.get('connection', '').lower() != 'close'
+        return int(status), response_headers, keep_alive
+
+    async def _chunks(self):
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await self.reader.readline()
+                return
+            yield await self.reader.readexactly(size)
+            await self.reader.readline()
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def get(self, path: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        # A kept-alive connection the server has closed in the meantime fails on the first read; retry once
+        for attempt in range(2):
+            reused = self.writer is not None
+            try:
+                await self._send(path, headers or {})
+                status, response_headers, keep_alive = await self._read_head()
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused or attempt:
+                    raise
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''.join([chunk async for chunk in self._chunks()])
+        elif 'content-length' in response_headers:
+            body = await self.reader.readexactly(int(response_headers['content-length']))
+        elif status in (204, 304):
+            body = b''
+        else:
+            body = await self.reader.read()
+            keep_alive = False
+        if not keep_alive:
+            self.close()
+        return status, response_headers, body
+
+    # Yields the data of every server-sent event of the stream
+    async def events(self, path: str):
+        await self._send(path, {'Accept': 'text/event-stream'})
+        status, response_headers, _ = await self._read_head()
+        if status != 200:
+            raise RuntimeError(f"event stream answered {status}")
+        chunked = response_headers.get('transfer-encoding', '').lower() == 'chunked'
+        buffer = ''
+        chunks = self._chunks() if chunked else None
+        while True:
+            try:
+                data = await chunks.__anext__() if chunked else await self.reader.read(65536)
+            except StopAsyncIteration:
+                return
+            if not data:
+                return
+            buffer += data.decode()
+            while '\n\n' in buffer:
+                event, buffer = buffer.split('\n\n', 1)
+                for line in event.split('\n'):
+                    if line.startswith('data:'):
+                        yield line[5:].strip()
+
+class ClientResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.requests = 0
+        self.errors = 0
+        self.seen_at: Optional[float] = None
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def poll_client(url, report_id: str, poll_interval: float, start_delay: float, stop_at: float) -> ClientResult:
+    result = ClientResult()
+    conn = HttpConnection(url.hostname, url.port)
+    await asyncio.sleep(start_delay)
+    loop = asyncio.get_running_loop()
+    while loop.time() < stop_at:
+        started = loop.time()
+        try:
+            status, headers, body = await conn.get(f"/get_report/{report_id}")
+            result.requests += 1
+            result.latencies.append(loop.time() - started)
+            finished = headers.get('x-report-status') == 'Complete' or (
+                headers.get('content-type', '').startswith('application/json')
+                and json.loads(body).get('status') in FINAL_STATUSES)
+            if finished:
+                result.seen_at = loop.time()
+                break
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            result.errors += 1
+            conn.close()
+        await asyncio.sleep(max(0.0, poll_interval - (loop.time() - started)))
+    conn.close()
+    return result
+
+async def long_poll_client(url, report_id: str, start_delay: float, stop_at: float) -> ClientResult:
+    result = ClientResult()
+    conn = HttpConnection(url.hostname, url.port)
+    await asyncio.sleep(start_delay)
+    loop = asyncio.get_running_loop()
+    while loop.time() < stop_at:
+        try:
+            wait = max(1, int(stop_at - loop.time()))
+            # The latency of a long-poll is the wait, so it is not recorded
+            status, _, body = await conn.get(f"/report_status/{report_id}?wait={wait}")
+            result.requests += 1
+            if status == 200 and json.loads(body).get('status') in FINAL_STATUSES:
+                result.seen_at = loop.time()
+                break
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            result.errors += 1
+            conn.close()
+            await asyncio.sleep(1)
+    conn.close()
+    return result
+
+async def sse_client(url, report_id: str, start_delay: float, stop_at: float) -> ClientResult:
+    result = ClientResult()
+    conn = HttpConnection(url.hostname, url.port)
+    await asyncio.sleep(start_delay)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        async def read_events():
+            async for data in conn.events(f"/report_status/{report_id}"):
+                if not result.requests:
+                    result.requests = 1
+                    # Time to the first event, the status when the stream opened
+                    result.latencies.append(loop.time() - started)
+                if json.loads(data).get('status') in FINAL_STATUSES:
+                    result.seen_at = loop.time()
+                    return
+        await asyncio.wait_for(read_events(), max(0.0, stop_at - loop.time()))
+    except (OSError, ValueError, RuntimeError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        result.errors += 1
+    conn.close()
+    return result
+
+def database_transactions(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_stat_force_next_flush()")
+        cur.execute("SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()")
+        transactions = cur.fetchone()[0]
+    conn.commit()
+    return transactions
+
+# Running reports nobody works on: no params, so report workers neither claim nor requeue them
+def create_reports(conn, count: int) -> Tuple[List[str], str]:
+    report_path = os.path.join(REPORTS_DIR, f"loadtest-{uuid.uuid4().hex}.csv")
+    with open(report_path, 'w') as f:
+        f.write(','.join(REPORT_HEADER) + '\n')
+    report_ids = [f"loadtest-{uuid.uuid4().hex}" for _ in range(count)]
+    with conn.cursor() as cur:
+        for report_id in report_ids:
+            cur.execute("INSERT INTO reports (report_id, status, created_at) VALUES (%s, 'Running', %s)",
+                        (report_id, datetime.now(pytz.utc)))
+    conn.commit()
+    return report_ids, report_path
+
+def complete_reports(conn, report_ids: List[str], report_path: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute("UPDATE reports SET status = 'Complete', completed_at = %s, report_path = %s "
+                    "WHERE report_id = ANY(%s)", (datetime.now(pytz.utc), report_path, report_ids))
+    conn.commit()
+
+def delete_reports(conn, report_ids: List[str], report_path: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM reports WHERE report_id = ANY(%s)", (report_ids,))
+    conn.commit()
+    os.remove(report_path)
+
+async def run_target(name: str, base_url: str, mode: str, args) -> Dict[str, object]:
+    url = urlsplit(base_url)
+    conn = psycopg2.connect(**get_db_params())
+    report_ids, report_path = create_reports(conn, args.reports)
+    try:
+        transactions_before = database_transactions(conn)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        complete_at = started + args.ramp + args.complete_after
+        stop_at = complete_at + args.timeout
+        tasks = []
+        for index in range(args.clients):
+            report_id = report_ids[index % len(report_ids)]
+            start_delay = args.ramp * index / args.clients
+            if mode == 'poll':
+                client = poll_client(url, report_id, args.poll_interval, start_delay, stop_at)
+            elif mode == 'longpoll':
+                client = long_poll_client(url, report_id, start_delay, stop_at)
+            else:
+                client = sse_client(url, report_id, start_delay, stop_at)
+            tasks.append(asyncio.ensure_future(client))
+
+        await asyncio.sleep(max(0.0, complete_at - loop.time()))
+        completed_at = loop.time()
+        await loop.run_in_executor(None, complete_reports, conn, report_ids, report_path)
+        results = await asyncio.gather(*tasks)
+        transactions = database_transactions(conn) - transactions_before
+    finally:
+        delete_reports(conn, report_ids, report_path)
+        conn.close()
+
+    latencies = [latency for result in results for latency in result.latencies]
+    lags = [result.seen_at - completed_at for result in results if result.seen_at is not None]
+    summary = {
+        'target': name,
+        'mode': mode,
+        'clients': args.clients,
+        'requests': sum(result.requests for result in results),
+        'errors': sum(result.errors for result in results),
+        'missed': sum(1 for result in results if result.seen_at is None),
+        'db_transactions': transactions,
+    }
+    for label, values in (('latency', latencies), ('completion_lag', lags)):
+        for suffix, fraction in (('p50', 0.5), ('p99', 0.99), ('max', 1.0)):
+            value = percentile(values, fraction)
+            summary[f"{label}_{suffix}_ms"] = round(value * 1000, 1) if value is not None else None
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare clients waiting for reports on the Flask and ASGI servers")
+    parser.add_argument('--flask-url', default='http://127.0.0.1:5000', help="empty to skip the Flask server")
+    parser.add_argument('--asgi-url', default='http://127.0.0.1:8000', help="empty to skip the ASGI server")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--reports', type=int, default=10, help="reports the clients wait for")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--ramp', type=float, default=2.0, help="seconds over which the clients connect")
+    parser.add_argument('--complete-after', type=float, default=10.0,
+                        help="seconds the reports run after every client is connected")
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help="seconds clients keep waiting after the reports finish")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    targets = []
+    if args.flask_url:
+        targets.append(('flask', args.flask_url, 'poll'))
+    if args.asgi_url:
+        targets += [('asgi', args.asgi_url, mode) for mode in ('poll', 'longpoll', 'sse')]
+
+    summaries = []
+    for name, base_url, mode in targets:
+        summary = asyncio.run(run_target(name, base_url, mode, args))
+        summaries.append(summary)
+        if not args.json:
+            ms = lambda key: '-' if summary[key] is None else f"{summary[key]:g}ms"
+            print(f"{name:<6} {mode:<9} requests {summary['requests']:>6}  errors {summary['errors']:>4}  "
+                  f"missed {summary['missed']:>4}  latency p50 {ms('latency_p50_ms')} p99 {ms('latency_p99_ms')}  "
+                  f"completion lag p50 {ms('completion_lag_p50_ms')} p99 {ms('completion_lag_p99_ms')}  "
+                  f"db transactions {summary['db_transactions']}")
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+import psycopg2
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+from app.db import get_db_params
+
+# Latency of the synchronous uptime endpoint. --concurrency keep-alive connections request the uptime of stores
+# drawn from the registry: with --hot N from N stores, so most requests are answered from the memo, and by default
+# from every store, so most are computed. --stores-per-request above 1 uses /stores/uptime. Reports the latency
+# percentiles and the share of stores answered from the memo, and fails if the p99 is above --target-ms.
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Client(threading.Thread):
+    def __init__(self, url, paths: List[str]):
+        super().__init__(daemon=True)
+        self.url = url
+        self.paths = paths
+        self.latencies: List[float] = []
+        self.stores = 0
+        self.cached = 0
+        self.errors = 0
+
+    def run(self) -> None:
+        conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+        for path in self.paths:
+            started = time.perf_counter()
+            conn.request('GET', path)
+            response = conn.getresponse()
+            payload = response.read()
+            self.latencies.append(time.perf_counter() - started)
+            if response.status != 200:
+                self.errors += 1
+                continue
+            body = json.loads(payload)
+            uptimes = body['stores'] if 'stores' in body else [body]
+            self.stores += len(uptimes)
+            self.cached += sum(1 for uptime in uptimes if uptime['cached'])
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of the /stores/<store_id>/uptime endpoint")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Flask (5000) or ASGI server")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--stores-per-request', type=int, default=1)
+    parser.add_argument('--hot', type=int, default=0, help="draw the stores from this many stores (0: all)")
+    parser.add_argument('--target-ms', type=float, default=50.0, help="p99 latency to stay under")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("SELECT store_id FROM stores ORDER BY store_id")
+        store_ids = [row[0] for row in cur.fetchall()]
+    conn.close()
+    rng = random.Random(args.seed)
+    if args.hot:
+        store_ids = rng.sample(store_ids, min(args.hot, len(store_ids)))
+
+    paths = []
+    for _ in range(args.requests):
+        stores = rng.sample(store_ids, min(args.stores_per_request, len(store_ids)))
+        if len(stores) == 1:
+            paths.append(f"/stores/{stores[0]}/uptime")
+        else:
+            paths.append("/stores/uptime?" + '&'.join(f"store_id={store_id}" for store_id in stores))
+    clients = [Client(urlsplit(args.url), paths[index::args.concurrency]) for index in range(args.concurrency)]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    seconds = time.perf_counter() - started
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    stores = sum(client.stores for client in clients)
+    results = {
+        'url': args.url,
+        'requests': len(latencies),
+        'concurrency': args.concurrency,
+        'stores_per_request': args.stores_per_request,
+        'hot': args.hot,
+        'errors': sum(client.errors for client in clients),
+        'requests_per_second': round(len(latencies) / seconds),
+        'cached_ratio': round(sum(client.cached for client in clients) / stores, 3) if stores else None,
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'latency_max_ms': round(max(latencies) * 1000, 1),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['requests']} requests at {results['requests_per_second']}/s, {results['errors']} errors, "
+              f"{results['cached_ratio']:.0%} of stores from the memo")
+        print(f"latency p50 {results['latency_p50_ms']} ms, p99 {results['latency_p99_ms']} ms, "
+              f"max {results['latency_max_ms']} ms (target p99 {args.target_ms:g} ms)")
+    if results['errors'] or results['latency_p99_ms'] > args.target_ms:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pytz
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+# The app logs to stdout, where the results go, and the DST scenarios warn for every store; set before the app is
+# imported here or in the scenario processes, which inherit the environment
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+from benchmarks.synthetic import DST_END_UTC, generate_dataset, load_dataset, parse_timezone_mix, TIMEZONE_MIX
+
+# Scenarios on in-memory engine inputs, which need no database
+COMPUTE_SCENARIOS = ['compute/python', 'compute/numpy']
+
+# Scenarios running generate_report_logic end to end against the configured database:
+# name -> (bulk, engine, rollup, shard workers)
+REPORT_SCENARIOS = {
+    'report/per-store': (False, 'python', False, 1),
+    'report/bulk-python': (True, 'python', False, 1),
+    'report/bulk-numpy': (True, 'numpy', False, 1),
+    'report/rollup': (True, 'python', True, 1),
+    'report/sharded-2': (True, 'python', False, 2),
+}
+
+SCENARIOS = COMPUTE_SCENARIOS + list(REPORT_SCENARIOS)
+
+def _proc_status_mb(field: str) -> Optional[float]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+# Resets the peak memory of this process to its current memory and returns the latter. Only Linux can reset it; a
+# spawned process also starts with the peak of its parent in ru_maxrss, which VmHWM does not carry over.
+def _reset_peak_rss() -> float:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    return _proc_status_mb('VmRSS') or _peak_rss_mb()
+
+def _peak_rss_mb() -> float:
+    peak = _proc_status_mb('VmHWM')
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def dataset_options(args: argparse.Namespace) -> Dict:
+    return {
+        'num_stores': args.stores,
+        'polls_per_hour': args.polls_per_hour,
+        'days': args.days,
+        'seed': args.seed,
+        'dst': args.dst,
+        'timezone_mix': args.timezones,
+        'overnight_ratio': args.overnight_ratio,
+        'midnight_ratio': args.midnight_ratio,
+        'no_hours_ratio': args.no_hours_ratio,
+        'missing_day_ratio': args.missing_day_ratio,
+    }
+
+def build_dataset(options: Dict) -> Dict:
+    kwargs = dict(options)
+    dst = kwargs.pop('dst')
+    mix = kwargs.pop('timezone_mix')
+    return generate_dataset(end_utc=DST_END_UTC[dst], timezone_mix=parse_timezone_mix(mix) if mix else TIMEZONE_MIX,
+                            **kwargs)
+
+# Times the engine on every store of the dataset, with cold business calendars each time as a fresh report has
+def _run_compute(engine_name: str, options: Dict, repeat: int) -> Dict:
+    from app.report.calendar import invalidate_business_calendars
+    from app.report.engines import get_engine
+    from benchmarks.synthetic import store_inputs_from_dataset
+
+    engine = get_engine(engine_name)
+    dataset = build_dataset(options)
+    # Grouped by store, as a report fetches them: polls spread over the heap in arrival order make the engines
+    # noticeably slower than they are on fetched data
+    dataset['store_status'].sort(key=lambda row: row[0])
+    inputs = store_inputs_from_dataset(dataset)
+    del dataset
+    rss_before = _reset_peak_rss()
+    seconds, rows = [], 0
+    for _ in range(repeat):
+        invalidate_business_calendars()
+        started = time.perf_counter()
+        rows = len(engine(inputs))
+        seconds.append(time.perf_counter() - started)
+    return {'seconds': seconds, 'rows': rows, 'rss_before_mb': rss_before}
+
+# Runs one report through generate_report_logic, as a report worker does, and removes its CSV
+def _run_report(store_ids: List[str], bulk: bool, engine: str, rollup: bool, shard_workers: int) -> float:
+    from app.api.endpoints import generate_report_logic
+    from app.db import get_db_params
+    import psycopg2
+
+    conn = psycopg2.connect(**get_db_params())
+    report_id = uuid.uuid4().hex
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO reports (report_id, status, created_at) VALUES (%s, 'Running', %s)",
+                    (report_id, datetime.now(pytz.utc)))
+    conn.commit()
+    started = time.perf_counter()
+    generate_report_logic(report_id, conn, store_ids, bulk, engine, rollup, shard_workers)
+    elapsed = time.perf_counter() - started
+
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM reports WHERE report_id = %s RETURNING status, report_path", (report_id,))
+        status, report_path = cur.fetchone()
+    conn.commit()
+    conn.close()
+    if report_path and os.path.exists(report_path):
+        os.remove(report_path)
+    if status != 'Complete':
+        raise RuntimeError(f"Report {report_id} finished with status {status}")
+    return elapsed
+
+def _run_report_scenario(name: str, repeat: int, per_store_limit: int) -> Dict:
+    from app.db import get_db_params
+    from app.report.rollup import catch_up
+    import psycopg2
+
+    bulk, engine, rollup, shard_workers = REPORT_SCENARIOS[name]
+    conn = psycopg2.connect(**get_db_params())
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT store_id::text FROM store_status ORDER BY 1")
+        store_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    if not bulk:
+        # One query per store: a slice is enough for its rows per second
+        store_ids = store_ids[:per_store_limit]
+    if rollup:
+        # Building the rollups of freshly loaded data is a one-off; the scenario times reports on up-to-date rollups
+        catch_up(conn)
+    conn.close()
+
+    rss_before = _reset_peak_rss()
+    seconds = [_run_report(store_ids, bulk, engine, rollup, shard_workers) for _ in range(repeat)]
+    return {'seconds': seconds, 'rows': len(store_ids), 'rss_before_mb': rss_before}
+
+# Runs one scenario in the calling process; the suite calls it in a fresh process per scenario, so the peak memory
+# and the phase times are the scenario's own
+def run_scenario(name: str, options: Dict, repeat: int, per_store_limit: int) -> Dict:
+    from app import instrument
+
+    if name in REPORT_SCENARIOS:
+        result = _run_report_scenario(name, repeat, per_store_limit)
+    else:
+        result = _run_compute(name.split('/', 1)[1], options, repeat)
+    phases = instrument.snapshot()['phase_seconds']
+    median = statistics.median(result['seconds'])
+    peak = _peak_rss_mb()
+    return {
+        'scenario': name,
+        'rows': result['rows'],
+        'seconds_median': round(median, 4),
+        'seconds_min': round(min(result['seconds']), 4),
+        'seconds': [round(seconds, 4) for seconds in result['seconds']],
+        'rows_per_second': round(result['rows'] / median, 1) if median else None,
+        'peak_rss_mb': round(peak, 1),
+        'peak_rss_delta_mb': round(max(0.0, peak - result['rss_before_mb']), 1),
+        'phase_seconds': {phase: round(seconds / repeat, 4) for phase, seconds in sorted(phases.items())},
+    }
+
+def _git(*args: str) -> Optional[str]:
+    try:
+        return subprocess.run(['git', *args], cwd=PROJECT_ROOT_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment() -> Dict:
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'timestamp': datetime.now(pytz.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+# Scenarios whose fastest run or memory growth exceed the baseline's by more than the tolerance (and a floor, so
+# that scenarios of a few milliseconds or megabytes do not fail on noise). The fastest run is the least disturbed
+# by other load on the machine; the median is what a user would see.
+def compare(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    baseline_results = {result['scenario']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = baseline_results.get(result['scenario'])
+        if before is None or result['rows'] != before['rows']:
+            continue
+        if result['seconds_min'] > before['seconds_min'] * (1 + tolerance) + 0.01:
+            regressions.append(f"{result['scenario']}: fastest run {before['seconds_min']:.3f}s -> "
+                               f"{result['seconds_min']:.3f}s")
+        if result['peak_rss_delta_mb'] > before['peak_rss_delta_mb'] * (1 + tolerance) + 5:
+            regressions.append(f"{result['scenario']}: memory growth {before['peak_rss_delta_mb']:.1f}MB -> "
+                               f"{result['peak_rss_delta_mb']:.1f}MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark scenarios on a synthetic dataset and write the "
+                                                 "latency, rows per second and peak memory of each as JSON")
+    parser.add_argument('--stores', type=int, default=2000)
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--days', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dst', choices=sorted(DST_END_UTC), default='none',
+                        help="put the report week across a US DST change")
+    parser.add_argument('--timezones', default='',
+                        help="timezone mix as name:weight pairs, e.g. 'America/Chicago:3,Asia/Beirut,none'")
+    parser.add_argument('--overnight-ratio', type=float, default=0.1, help="share of days with overnight hours")
+    parser.add_argument('--midnight-ratio', type=float, default=0.1, help="share of days closing at midnight")
+    parser.add_argument('--no-hours-ratio', type=float, default=0.2, help="share of stores without business hours")
+    parser.add_argument('--missing-day-ratio', type=float, default=0.1,
+                        help="share of days missing from the hours of the other stores")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario; the median is reported")
+    parser.add_argument('--per-store-limit', type=int, default=500,
+                        help="stores of the per-store report scenario")
+    parser.add_argument('--no-db', action='store_true', help="only run the scenarios that need no database")
+    parser.add_argument('--skip-load', action='store_true', help="reuse the data already in the database")
+    parser.add_argument('--json', help="write the results to this file instead of stdout")
+    parser.add_argument('--history', help="append the results as one line to this JSONL file")
+    parser.add_argument('--compare', help="fail if a scenario regressed against these earlier results")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed regression for --compare")
+    args = parser.parse_args()
+
+    options = dataset_options(args)
+    scenarios = [name for name in args.scenarios if not (args.no_db and name in REPORT_SCENARIOS)]
+    if any(name in REPORT_SCENARIOS for name in scenarios) and not args.skip_load:
+        import psycopg2
+        from app.db import get_db_params
+        print(f"Loading synthetic data for {args.stores} stores into {get_db_params()['dbname']}...", file=sys.stderr)
+        conn = psycopg2.connect(**get_db_params())
+        load_dataset(conn, build_dataset(options))
+        conn.close()
+
+    results = []
+    for name in scenarios:
+        # A fresh process per scenario, so peak memory is not carried over from the previous one
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_scenario, name, options, args.repeat, args.per_store_limit).result()
+        print(f"{name}: {result['seconds_median']:.3f}s, {result['rows_per_second']} rows/s, "
+              f"peak {result['peak_rss_mb']:.0f}MB (+{result['peak_rss_delta_mb']:.0f}MB)", file=sys.stderr)
+        results.append(result)
+
+    report = {'environment': environment(), 'dataset': options, 'repeat': args.repeat, 'results': results}
+    output = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.history:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
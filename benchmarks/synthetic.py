@@ -0,0 +1,139 @@
+import io
+import random
+import uuid
+from datetime import datetime, timedelta, time as time_obj
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Timezones assigned to the synthetic stores. None means the store has no row in the timezones table.
+TIMEZONE_MIX = ['America/Chicago', 'America/New_York', 'America/Denver', 'America/Los_Angeles',
+                'America/Boise', 'Asia/Beirut', None]
+
+# Latest poll of the dataset, matching the period covered by the original store-monitoring data
+DEFAULT_END_UTC = datetime(2023, 1, 25, 18, 13, 22)
+
+# Latest poll for each DST setting: the week before it contains no change, or the US spring-forward or fall-back
+DST_END_UTC = {
+    'none': DEFAULT_END_UTC,
+    'spring-forward': datetime(2023, 3, 14, 9, 30, 0),
+    'fall-back': datetime(2023, 11, 7, 7, 45, 0),
+}
+
+# Parses a timezone mix such as "America/Chicago:3,Asia/Beirut,none:1": the timezones with their weights, 'none'
+# for stores without a row in the timezones table
+def parse_timezone_mix(text: str) -> List[Optional[str]]:
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.strip().partition(':')
+        mix.extend([None if name == 'none' else name] * int(weight or 1))
+    return mix
+
+# Schema produced by convert_to_pg.py when loading the store-monitoring CSV files. The rollups and the migration
+# log describe the previous data, so they are dropped as well.
+SCHEMA = """
+    DROP TABLE IF EXISTS store_status, menu_hours, timezones, schema_migrations,
+        store_status_hourly, store_rollup_state, rollup_watermarks, store_status_archive;
+    CREATE TABLE store_status (store_id UUID, status VARCHAR, timestamp_utc VARCHAR);
+    CREATE TABLE menu_hours (store_id UUID, "dayOfWeek" INTEGER, start_time_local TIME, end_time_local TIME);
+    CREATE TABLE timezones (store_id UUID, timezone_str VARCHAR);
+    CREATE TABLE IF NOT EXISTS reports (
+        report_id VARCHAR(50) PRIMARY KEY,
+        status VARCHAR(20),
+        created_at TIMESTAMP WITH TIME ZONE,
+        completed_at TIMESTAMP WITH TIME ZONE,
+        report_path TEXT,
+        store_id TEXT
+    );
+"""
+
+# Business hours of a single day: overnight, closing at midnight or regular
+def random_hours(rng: random.Random, overnight_ratio: float = 0.1, midnight_ratio: float = 0.1) -> Tuple[time_obj, time_obj]:
+    kind = rng.random()
+    if kind < overnight_ratio:
+        return time_obj(rng.randint(17, 21), 0), time_obj(rng.randint(1, 4), 0)
+    if kind < overnight_ratio + midnight_ratio:
+        return time_obj(rng.randint(6, 11), 0), time_obj(0, 0)
+    return time_obj(rng.randint(6, 11), rng.choice([0, 30])), time_obj(rng.randint(17, 23), rng.choice([0, 30]))
+
+# Generates the rows of the store_status, menu_hours and timezones tables for num_stores stores. Of the stores,
+# no_hours_ratio have no business hours (open 24/7); the others miss a day with probability missing_day_ratio, and
+# a day's hours are overnight or close at midnight with the given ratios. The defaults give the datasets the
+# benchmarks have always used.
+def generate_dataset(num_stores: int, polls_per_hour: float = 1.0, days: int = 8, seed: int = 0,
+                     end_utc: datetime = DEFAULT_END_UTC, timezone_mix: Sequence[Optional[str]] = TIMEZONE_MIX,
+                     overnight_ratio: float = 0.1, midnight_ratio: float = 0.1, no_hours_ratio: float = 0.2,
+                     missing_day_ratio: float = 0.1) -> Dict[str, List[Tuple]]:
+    rng = random.Random(seed)
+    store_status, menu_hours, timezones = [], [], []
+    poll_interval_s = 3600 / polls_per_hour
+    for _ in range(num_stores):
+        store_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+        tz_str = rng.choice(timezone_mix)
+        if tz_str:
+            timezones.append((store_id, tz_str))
+
+        if rng.random() >= no_hours_ratio:
+            for day_of_week in range(7):
+                if rng.random() < 1 - missing_day_ratio:
+                    start_local, end_local = random_hours(rng, overnight_ratio, midnight_ratio)
+                    menu_hours.append((store_id, day_of_week, start_local, end_local))
+
+        # Stores stop polling at slightly different times and are mostly active
+        uptime_ratio = rng.uniform(0.5, 1.0)
+        ts = end_utc - timedelta(days=days) + timedelta(seconds=rng.uniform(0, poll_interval_s))
+        store_end = end_utc - timedelta(seconds=rng.uniform(0, 3 * 3600))
+        while ts <= store_end:
+            status = 'active' if rng.random() < uptime_ratio else 'inactive'
+            store_status.append((store_id, status, ts.strftime('%Y-%m-%d %H:%M:%S.%f') + ' UTC'))
+            ts += timedelta(seconds=rng.uniform(0.5, 1.5) * poll_interval_s)
+
+    # Polls are stored in arrival order, so the polls of a store are spread over the whole table
+    store_status.sort(key=lambda row: row[2])
+    return {'store_status': store_status, 'menu_hours': menu_hours, 'timezones': timezones}
+
+# Recreates the tables and loads the dataset with COPY. With migrate the tables are then brought to the schema of
+# create_table.py, as the report paths expect; without it they keep the column types of the CSV import.
+def load_dataset(conn, dataset: Dict[str, List[Tuple]], migrate: bool = True) -> None:
+    from create_table import create_schema
+
+    columns = {
+        'store_status': ('store_id', 'status', 'timestamp_utc'),
+        'menu_hours': ('store_id', '"dayOfWeek"', 'start_time_local', 'end_time_local'),
+        'timezones': ('store_id', 'timezone_str'),
+    }
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA)
+        for table_name, rows in dataset.items():
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write('\t'.join(str(value) for value in row) + '\n')
+            buffer.seek(0)
+            cur.copy_expert(f"COPY {table_name} ({', '.join(columns[table_name])}) FROM STDIN", buffer)
+        cur.execute("ANALYZE store_status; ANALYZE menu_hours; ANALYZE timezones;")
+    conn.commit()
+    if migrate:
+        create_schema(conn)
+
+# Builds the engine inputs of every store directly from a generated dataset, applying the same reference time
+# and 7 day window as the report paths, so the engines can be compared without a database
+def store_inputs_from_dataset(dataset: Dict[str, List[Tuple]]):
+    from app.report.engines import StoreInputs
+    from app.report.metrics import add_business_hours, resolve_timezone
+    from app.timestamps import parse_timestamp
+
+    polls: Dict[str, List] = {}
+    for store_id, status, timestamp_utc in dataset['store_status']:
+        polls.setdefault(store_id, []).append((parse_timestamp(timestamp_utc), status))
+    business_hours: Dict[str, Dict] = {}
+    for store_id, day_of_week, start_local, end_local in dataset['menu_hours']:
+        add_business_hours(business_hours.setdefault(store_id, {}), day_of_week, start_local, end_local)
+    tz_strings = dict(dataset['timezones'])
+
+    stores = []
+    for store_id, store_polls in polls.items():
+        store_polls.sort(key=lambda poll: poll[0])
+        ref_time = store_polls[-1][0]
+        week_polls = [poll for poll in store_polls if poll[0] >= ref_time - timedelta(days=7)]
+        stores.append(StoreInputs(store_id, week_polls, business_hours.get(store_id, {}),
+                                  resolve_timezone(store_id, tz_strings.get(store_id)), ref_time))
+    return stores
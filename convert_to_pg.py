@@ -1,102 +1,36 @@
-import psycopg2
-import csv
-import uuid
-import re
+import argparse
+import os
+import sys
+
+from app.db import get_db_params
+from app.loader import CHUNK_BYTES, LOAD_KEYS, LOAD_MODES, LOAD_WORKERS, load_csv_files
+
+# Loads one CSV file into a table. The table keeps its column types and indexes; see app/loader.py.
+def csv_to_postgres(csv_path, table_name, db_params, mode='replace'):
+    return load_csv_files(db_params, [(table_name, csv_path)], mode)
+
+# Each argument is a CSV file named after its table (store_status.csv, menu_hours.csv, timezones.csv) or table=path
+def parse_file_argument(argument):
+    if '=' in argument:
+        table_name, csv_path = argument.split('=', 1)
+    else:
+        csv_path = argument
+        table_name = os.path.splitext(os.path.basename(argument))[0]
+    if table_name not in LOAD_KEYS:
+        raise argparse.ArgumentTypeError(f"cannot tell the table of {argument}; use one of {', '.join(LOAD_KEYS)} as table=path")
+    return table_name, csv_path
 
-# identify the data type
-def infer_data_type(value):
-    if not value or value.lower() in ('null', 'none', ''):
-        return 'VARCHAR'  # Default for empty/null values
-    try:
-        uuid.UUID(value)
-        return 'UUID'
-    except ValueError:
-        pass
-    if re.match(r'^\d+$', value):
-        return 'INTEGER'
-    if re.match(r'^\d{2}:\d{2}:\d{2}$', value):
-        return 'TIME'
-    if re.match(r'^\d{4}-\d{2}-\d{2}$', value):
-        return 'DATE'
-    if re.match(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$', value):
-        return 'TIMESTAMP'
-    try:
-        float(value)
-        return 'FLOAT'
-    except ValueError:
-        pass
-    return 'VARCHAR'
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load the store-monitoring CSV files into postgres")
+    parser.add_argument('files', nargs='+', type=parse_file_argument, metavar='[table=]path.csv')
+    parser.add_argument('--mode', choices=LOAD_MODES, default='replace',
+                        help="replace the tables (default), upsert the loaded rows, or append new store_status polls")
+    parser.add_argument('--workers', type=int, default=LOAD_WORKERS, help="processes copying chunks in parallel")
+    parser.add_argument('--chunk-mb', type=int, default=CHUNK_BYTES // (1024 * 1024), help="size of the chunks files are split into")
+    args = parser.parse_args()
 
-def csv_to_postgres(csv_path, table_name, db_params, sample_rows=5):
     try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        print("Connected to database:", db_params["dbname"])
-
-        cursor.execute(f"DROP TABLE IF EXISTS public.{table_name};")
-        print(f"Dropped table {table_name} if it existed")
-
-        # Retrieves the headers of the csv file
-        with open(csv_path, 'r') as f:
-            reader = csv.reader(f)
-            headers = next(reader)  # Get column headers
-            print("CSV headers:", headers)
-
-            sample_data = [row for row, _ in zip(reader, range(sample_rows))]
-            if not sample_data:
-                raise ValueError("CSV file is empty or has no data rows")
-
-            # Identify the data type for each column
-            column_types = []
-            for col_idx, header in enumerate(headers):
-                # Get non-empty values from this column
-                values = [row[col_idx] for row in sample_data if col_idx < len(row) and row[col_idx]]
-                if not values:
-                    column_types.append('VARCHAR')  # Default if all values are empty
-                    continue
-                inferred_type = infer_data_type(values[0])
-                column_types.append(inferred_type)
-
-            # Create table
-            columns_def = ', '.join(f'"{header}" {col_type}' for header, col_type in zip(headers, column_types))
-            create_table_query = f'CREATE TABLE public.{table_name} ({columns_def});'
-            cursor.execute(create_table_query)
-            print(f"Created table {table_name} with query: {create_table_query}")
-
-            # Verify table structure
-            cursor.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = '{table_name}' AND table_schema = 'public';")
-            db_columns = [row[0] for row in cursor.fetchall()]
-            print(f"Table columns in database: {db_columns}")
-
-            # Copy CSV data to table
-            with open(csv_path, 'r') as f:
-                next(f) 
-                cursor.copy_from(f, table_name, sep=',', columns=headers)
-            print(f"Copied data to {table_name}")
-
-            conn.commit()
-            print(f"Data successfully loaded into {table_name}")
-
+        load_csv_files(get_db_params(), args.files, args.mode, args.workers, args.chunk_mb * 1024 * 1024)
     except Exception as e:
         print(f"Error: {e}")
-        conn.rollback()
-
-    finally:
-        cursor.close()
-        conn.close()
-        print("Connection closed")
-
-# Example usage
-if __name__ == "__main__":
-    db_params = {
-        "dbname": "loop",
-        "user": "postgres",
-        "password": "password",
-        "host": "localhost",
-        "port": "5432"
-    }
-
-    csv_path = r"C:\Users\hoopa\Downloads\store-monitoring-data\menu_hours.csv"
-    table_name = "menu_hours"
-
-    csv_to_postgres(csv_path, table_name, db_params)
\ No newline at end of file
+        sys.exit(1)
\ No newline at end of file
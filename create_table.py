@@ -1,12 +1,129 @@
 import psycopg2
-from typing import Dict
+from typing import Dict, List
 
-def create_tables(db_params: Dict[str, str]) -> None:
-    conn = None
-    try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
+# Column types of tables loaded from the CSV files with convert_to_pg.py. The store ids are compared with plain
+# text ids and the poll timestamps with timestamptz bounds, so neither needs a cast that would hide the indexes.
+COLUMN_TYPES = [
+    ('store_status', 'store_id', 'character varying', "VARCHAR(50) USING store_id::text"),
+    ('store_status', 'timestamp_utc', 'timestamp with time zone',
+     "TIMESTAMP WITH TIME ZONE USING timestamp_utc::timestamp AT TIME ZONE 'UTC'"),
+    ('menu_hours', 'store_id', 'character varying', "VARCHAR(50) USING store_id::text"),
+    ('timezones', 'store_id', 'character varying', "VARCHAR(50) USING store_id::text"),
+]
+
+# Converts all the columns of a table in a single ALTER TABLE, so a large table is only rewritten once
+def _normalize_column_types(cursor) -> None:
+    alterations: Dict[str, List[str]] = {}
+    for table_name, column_name, data_type, alter_type in COLUMN_TYPES:
+        cursor.execute(
+            "SELECT data_type FROM information_schema.columns WHERE table_schema = 'public' AND table_name = %s AND column_name = %s",
+            (table_name, column_name)
+        )
+        row = cursor.fetchone()
+        if row and row[0] != data_type:
+            print(f"Converting {table_name}.{column_name} from {row[0]} to {data_type}")
+            alterations.setdefault(table_name, []).append(f"ALTER COLUMN {column_name} TYPE {alter_type}")
+    for table_name, clauses in alterations.items():
+        cursor.execute(f"ALTER TABLE {table_name} {', '.join(clauses)}")
 
+# Tables the reports are computed from
+DATA_VERSION_TABLES = ['store_status', 'menu_hours', 'timezones']
+
+# Schema migrations, applied once each in order and recorded in schema_migrations
+MIGRATIONS = [
+    # Superseded by the (store_id, timestamp_utc) index, which serves the same lookups
+    ('0001_drop_store_status_store_id_index', lambda cursor: cursor.execute("DROP INDEX IF EXISTS idx_store_status_store_id")),
+    ('0002_text_store_ids_timestamptz_polls', _normalize_column_types),
+    # Queued reports: their options, the key identical requests share while pending and when a worker started them
+    ('0003_report_queue', lambda cursor: cursor.execute("""
+        ALTER TABLE reports
+            ADD COLUMN IF NOT EXISTS params JSONB,
+            ADD COLUMN IF NOT EXISTS dedup_key TEXT,
+            ADD COLUMN IF NOT EXISTS started_at TIMESTAMP WITH TIME ZONE;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_reports_pending_dedup_key ON reports (dedup_key)
+            WHERE status IN ('Queued', 'Running');
+        CREATE INDEX IF NOT EXISTS idx_reports_queued ON reports (created_at) WHERE status = 'Queued';
+    """)),
+    # Progress of sharded reports
+    ('0004_report_shards', lambda cursor: cursor.execute("""
+        ALTER TABLE reports
+            ADD COLUMN IF NOT EXISTS shards_total INTEGER,
+            ADD COLUMN IF NOT EXISTS shards_done INTEGER;
+    """)),
+    # menu_hours was created with day_of_week, while menu_hours.csv and the report queries use "dayOfWeek"
+    ('0005_menu_hours_day_of_week_column', lambda cursor: cursor.execute("""
+        DO $$ BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_schema = 'public' AND table_name = 'menu_hours' AND column_name = 'day_of_week') THEN
+                ALTER TABLE menu_hours RENAME COLUMN day_of_week TO "dayOfWeek";
+            END IF;
+        END $$;
+    """)),
+    # Report cache: completed reports are looked up by dedup_key and evicted least recently used first
+    ('0006_report_cache', lambda cursor: cursor.execute("""
+        ALTER TABLE reports ADD COLUMN IF NOT EXISTS last_used_at TIMESTAMP WITH TIME ZONE;
+        CREATE INDEX IF NOT EXISTS idx_reports_complete_dedup_key ON reports (dedup_key, completed_at)
+            WHERE status = 'Complete';
+    """)),
+    # Progress of every report (stores done out of the total, and the stores done before a restarted run) and the
+    # checkpoint a restarted run resumes from
+    ('0007_report_progress', lambda cursor: cursor.execute("""
+        ALTER TABLE reports
+            ADD COLUMN IF NOT EXISTS stores_total INTEGER,
+            ADD COLUMN IF NOT EXISTS stores_done INTEGER,
+            ADD COLUMN IF NOT EXISTS stores_resumed INTEGER,
+            ADD COLUMN IF NOT EXISTS progress_updated_at TIMESTAMP WITH TIME ZONE,
+            ADD COLUMN IF NOT EXISTS checkpoint JSONB;
+    """)),
+    # Store registry (app/report/stores.py), filled from the polls once and kept up to date by triggers since
+    ('0008_store_registry', lambda cursor: cursor.execute("""
+        DELETE FROM stores;
+        INSERT INTO stores (store_id, timezone_str)
+        SELECT p.store_id, t.timezone_str
+        FROM (SELECT DISTINCT store_id FROM store_status WHERE store_id IS NOT NULL) p
+        LEFT JOIN timezones t ON t.store_id = p.store_id;
+        ANALYZE stores;
+    """)),
+    # A poll is identified by its store and time (app/ingest.py relies on it to skip polls sent twice): duplicates
+    # are dropped and the (store_id, timestamp_utc) index becomes unique
+    ('0009_unique_polls', lambda cursor: cursor.execute("""
+        DELETE FROM store_status s USING store_status d
+        WHERE d.store_id = s.store_id AND d.timestamp_utc = s.timestamp_utc AND d.ctid < s.ctid;
+        DROP INDEX IF EXISTS idx_store_status_store_id_timestamp;
+        CREATE UNIQUE INDEX idx_store_status_store_id_timestamp ON store_status (store_id, timestamp_utc) INCLUDE (status);
+    """)),
+    # Status of a rolled up store at its origin, which retention (app/retention.py) moves past deleted polls
+    ('0010_rollup_origin_status', lambda cursor: cursor.execute("""
+        ALTER TABLE store_rollup_state ADD COLUMN IF NOT EXISTS origin_status VARCHAR(10) NOT NULL DEFAULT 'inactive';
+    """)),
+    # Stores whose inputs a report recorded in report_inputs (app/report/delta.py), NULL once they are dropped
+    ('0011_report_inputs', lambda cursor: cursor.execute("""
+        ALTER TABLE reports ADD COLUMN IF NOT EXISTS inputs_stores INTEGER;
+    """)),
+]
+
+def migrate(cursor) -> List[str]:
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        )
+    """)
+    cursor.execute("SELECT name FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+    newly_applied = []
+    for name, apply in MIGRATIONS:
+        if name in applied:
+            continue
+        print(f"Applying migration {name}")
+        apply(cursor)
+        cursor.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+        newly_applied.append(name)
+    return newly_applied
+
+# Creates the missing tables, migrates the existing ones and creates the indexes
+def create_schema(conn) -> None:
+    with conn.cursor() as cursor:
         # Create tables
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS store_status (
@@ -18,7 +135,7 @@ def create_tables(db_params: Dict[str, str]) -> None:
             CREATE TABLE IF NOT EXISTS menu_hours (
                 id SERIAL PRIMARY KEY,
                 store_id VARCHAR(50),
-                day_of_week INTEGER,
+                "dayOfWeek" INTEGER,
                 start_time_local TIME,
                 end_time_local TIME
             );
@@ -34,16 +151,172 @@ def create_tables(db_params: Dict[str, str]) -> None:
                 report_path TEXT,
                 store_id TEXT
             );
+            CREATE TABLE IF NOT EXISTS store_status_hourly (
+                store_id TEXT,
+                hour_utc TIMESTAMP WITH TIME ZONE,
+                uptime_us BIGINT NOT NULL DEFAULT 0,
+                business_us BIGINT NOT NULL DEFAULT 0,
+                end_status VARCHAR(10),
+                PRIMARY KEY (store_id, hour_utc)
+            );
+            CREATE TABLE IF NOT EXISTS store_rollup_state (
+                store_id TEXT PRIMARY KEY,
+                origin_utc TIMESTAMP WITH TIME ZONE,
+                last_poll_utc TIMESTAMP WITH TIME ZONE,
+                last_status VARCHAR(10),
+                hours_version TEXT
+            );
+            CREATE TABLE IF NOT EXISTS rollup_watermarks (
+                name TEXT PRIMARY KEY,
+                watermark TIMESTAMP WITH TIME ZONE,
+                updated_at TIMESTAMP WITH TIME ZONE
+            );
+            CREATE TABLE IF NOT EXISTS data_versions (
+                table_name TEXT PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0,
+                changed_at TIMESTAMP WITH TIME ZONE
+            );
+            CREATE TABLE IF NOT EXISTS poll_store_stats (
+                worker TEXT PRIMARY KEY,
+                stats JSONB,
+                updated_at TIMESTAMP WITH TIME ZONE
+            );
+            CREATE TABLE IF NOT EXISTS report_worker_metrics (
+                worker TEXT PRIMARY KEY,
+                metrics JSONB,
+                updated_at TIMESTAMP WITH TIME ZONE
+            );
+            CREATE TABLE IF NOT EXISTS stores (
+                store_id VARCHAR(50) PRIMARY KEY,
+                timezone_str VARCHAR(50)
+            );
+            CREATE TABLE IF NOT EXISTS store_status_archive (
+                store_id VARCHAR(50),
+                hour_utc TIMESTAMP WITH TIME ZONE,
+                polls INTEGER NOT NULL,
+                active_polls INTEGER NOT NULL,
+                first_poll_utc TIMESTAMP WITH TIME ZONE,
+                last_poll_utc TIMESTAMP WITH TIME ZONE,
+                last_status VARCHAR(10),
+                PRIMARY KEY (store_id, hour_utc)
+            );
+            CREATE TABLE IF NOT EXISTS report_inputs (
+                report_id VARCHAR(50),
+                store_id VARCHAR(50),
+                last_poll_utc TIMESTAMP WITH TIME ZONE,
+                polls_digest TEXT,
+                hours_version TEXT,
+                PRIMARY KEY (report_id, store_id)
+            );
         """)
 
-        # Create indexes for performance
+        migrate(cursor)
+
+        # Create indexes for performance. The polls of a store within a time range are read with an index-only
+        # range scan of idx_store_status_store_id_timestamp, already in timestamp order.
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_store_status_store_id ON store_status (store_id);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_store_status_store_id_timestamp ON store_status (store_id, timestamp_utc) INCLUDE (status);
             CREATE INDEX IF NOT EXISTS idx_store_status_timestamp ON store_status (timestamp_utc);
             CREATE INDEX IF NOT EXISTS idx_menu_hours_store_id ON menu_hours (store_id);
+            CREATE INDEX IF NOT EXISTS idx_stores_timezone ON stores ((COALESCE(timezone_str, 'America/Chicago')), store_id);
+        """)
+
+        # Every statement that changes the report inputs bumps the version of its table in data_versions, which is
+        # part of the key cached reports are looked up by. Statements other than INSERT also bump
+        # '<table>:rewrites', telling caches that only follow new rows to reload. The triggers are recreated in case
+        # a table was replaced.
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO data_versions (table_name, version, changed_at) VALUES (TG_TABLE_NAME, 1, now())
+                ON CONFLICT (table_name) DO UPDATE SET version = data_versions.version + 1, changed_at = now();
+                IF TG_OP <> 'INSERT' THEN
+                    INSERT INTO data_versions (table_name, version, changed_at) VALUES (TG_TABLE_NAME || ':rewrites', 1, now())
+                    ON CONFLICT (table_name) DO UPDATE SET version = data_versions.version + 1, changed_at = now();
+                END IF;
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql
         """)
+        for table_name in DATA_VERSION_TABLES:
+            cursor.execute(f"""
+                DROP TRIGGER IF EXISTS {table_name}_data_version ON {table_name};
+                CREATE TRIGGER {table_name}_data_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table_name}
+                    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+            """)
 
-        conn.commit()
+        # The store registry follows the polls: every statement adding polls registers their new stores, and one
+        # that removes polls unregisters the stores left without any. The statement triggers see the rows of a
+        # whole COPY or INSERT at once through their transition table. Changes of timezones are copied to the
+        # registry.
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION register_stores() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO stores (store_id, timezone_str)
+                SELECT p.store_id, t.timezone_str
+                FROM (SELECT DISTINCT store_id FROM new_polls WHERE store_id IS NOT NULL) p
+                LEFT JOIN timezones t ON t.store_id = p.store_id
+                ON CONFLICT (store_id) DO NOTHING;
+                IF TG_OP = 'UPDATE' THEN
+                    DELETE FROM stores s WHERE NOT EXISTS (SELECT 1 FROM store_status p WHERE p.store_id = s.store_id);
+                END IF;
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql;
+            CREATE OR REPLACE FUNCTION unregister_stores() RETURNS trigger AS $$
+            BEGIN
+                DELETE FROM stores s WHERE NOT EXISTS (SELECT 1 FROM store_status p WHERE p.store_id = s.store_id);
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql;
+            CREATE OR REPLACE FUNCTION sync_store_timezones() RETURNS trigger AS $$
+            BEGIN
+                UPDATE stores s SET timezone_str = t.timezone_str FROM timezones t
+                WHERE t.store_id = s.store_id AND s.timezone_str IS DISTINCT FROM t.timezone_str;
+                UPDATE stores s SET timezone_str = NULL
+                WHERE s.timezone_str IS NOT NULL AND NOT EXISTS (SELECT 1 FROM timezones t WHERE t.store_id = s.store_id);
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql;
+            DROP TRIGGER IF EXISTS store_status_register_stores ON store_status;
+            CREATE TRIGGER store_status_register_stores AFTER INSERT ON store_status
+                REFERENCING NEW TABLE AS new_polls FOR EACH STATEMENT EXECUTE FUNCTION register_stores();
+            DROP TRIGGER IF EXISTS store_status_reregister_stores ON store_status;
+            CREATE TRIGGER store_status_reregister_stores AFTER UPDATE ON store_status
+                REFERENCING NEW TABLE AS new_polls FOR EACH STATEMENT EXECUTE FUNCTION register_stores();
+            DROP TRIGGER IF EXISTS store_status_unregister_stores ON store_status;
+            CREATE TRIGGER store_status_unregister_stores AFTER DELETE OR TRUNCATE ON store_status
+                FOR EACH STATEMENT EXECUTE FUNCTION unregister_stores();
+            DROP TRIGGER IF EXISTS timezones_sync_stores ON timezones;
+            CREATE TRIGGER timezones_sync_stores AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON timezones
+                FOR EACH STATEMENT EXECUTE FUNCTION sync_store_timezones();
+        """)
+
+        # Every status change of a report is announced on the report_status channel as '<report_id>:<status>', so
+        # clients waiting on the async server (app/api/asgi.py) learn that a report finished without polling
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION notify_report_status() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('report_status', NEW.report_id || ':' || NEW.status);
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql;
+            DROP TRIGGER IF EXISTS reports_status_notify ON reports;
+            CREATE TRIGGER reports_status_notify AFTER UPDATE OF status ON reports
+                FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status) EXECUTE FUNCTION notify_report_status();
+        """)
+    conn.commit()
+
+    # A rewritten or freshly loaded table has no visibility map yet, without which index-only scans still read the
+    # heap. VACUUM cannot run inside a transaction.
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE store_status")
+    finally:
+        conn.autocommit = autocommit
+
+def create_tables(db_params: Dict[str, str]) -> None:
+    conn = None
+    try:
+        conn = psycopg2.connect(**db_params)
+        create_schema(conn)
         print("Database tables and indexes created successfully.")
     except Exception as e:
         print(f"Error creating tables: {e}")
@@ -51,7 +324,6 @@ def create_tables(db_params: Dict[str, str]) -> None:
             conn.rollback()
     finally:
         if conn:
-            cursor.close()
             conn.close()
 
 if __name__ == '__main__':
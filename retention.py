@@ -0,0 +1,41 @@
+import argparse
+import json
+
+import psycopg2
+
+from app.db import get_db_params
+from app.retention import RETENTION_BATCH_STORES, RETENTION_DAYS, run_retention
+
+# Retention job for store_status (app/retention.py), meant to run daily from cron
+def main():
+    parser = argparse.ArgumentParser(description="Compact polls older than the retention horizon into hourly summaries")
+    parser.add_argument('--days', type=float, default=RETENTION_DAYS,
+                        help="polls older than this many days before their store's latest poll are compacted")
+    parser.add_argument('--batch-stores', type=int, default=RETENTION_BATCH_STORES,
+                        help="stores compacted per transaction")
+    parser.add_argument('--dry-run', action='store_true', help="count the polls that would be compacted")
+    parser.add_argument('--no-vacuum', action='store_true', help="skip the VACUUM of store_status afterwards")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_db_params())
+    try:
+        result = run_retention(conn, args.days, args.batch_stores, dry_run=args.dry_run, reclaim=not args.no_vacuum)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        conn.close()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    verb = "Would compact" if args.dry_run else "Compacted"
+    print(f"{verb} {result['polls']} polls of {result['stores']} stores into {result['hours']} hourly summaries "
+          f"in {result['seconds']}s ({result['polls_per_second']:,} polls/s)")
+    if result['vacuum_seconds'] is not None:
+        print(f"Vacuumed store_status in {result['vacuum_seconds']}s")
+    print(f"store_status size: {result['size_before_bytes'] / 2**20:.1f} MiB before, "
+          f"{result['size_after_bytes'] / 2**20:.1f} MiB after")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import argparse
+import sys
+
+import psycopg2
+
+from app.api.endpoints import get_db_params
+from app.report.rollup import catch_up, check_consistency, rebuild
+
+# Maintenance commands for the hourly uptime rollups (store_status_hourly)
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the hourly uptime rollups")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('catch-up', help="roll up the polls received since the last catch-up")
+    check_parser = subparsers.add_parser('check', help="compare the rollups with a full recompute from store_status")
+    check_parser.add_argument('store_ids', nargs='*', help="stores to check (default: every rolled up store)")
+    rebuild_parser = subparsers.add_parser('rebuild', help="recompute the rollups of stores from store_status")
+    rebuild_parser.add_argument('store_ids', nargs='+')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_db_params())
+    try:
+        if args.command == 'catch-up':
+            result = catch_up(conn)
+            print(f"Rolled up {result['polls']} polls of {result['stores']} stores. Watermark: {result['watermark']}")
+        elif args.command == 'check':
+            differences = check_consistency(conn, args.store_ids or None)
+            for store_id, hour, stored, expected in differences:
+                print(f"{store_id} {hour}: stored {stored}, recomputed {expected}")
+            print(f"{len(differences)} differences found")
+            if differences:
+                sys.exit(1)
+        elif args.command == 'rebuild':
+            print(f"Rebuilt the rollups of {rebuild(conn, args.store_ids)} stores")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
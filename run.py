@@ -30,6 +30,12 @@ if __name__ == '__main__':
 
     print("Starting Flask application...")
     try:
+        # Queued reports are generated by a pool of worker processes. The debug reloader runs this script twice,
+        # so the pool is started in the reloaded process that serves the requests. Set REPORT_WORKERS=0 to run
+        # the workers separately with worker.py.
+        from app.report.jobs import REPORT_WORKERS, ReportWorkerPool
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' and REPORT_WORKERS > 0:
+            ReportWorkerPool(REPORT_WORKERS).start()
         app.run(debug=True, host='0.0.0.0', port=5000)
     except Exception as e:
         print(f"Exception occurred while trying to run Flask app: {e}")
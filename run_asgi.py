@@ -0,0 +1,28 @@
+import sys
+import os
+import traceback
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PROJECT_ROOT_PATH)
+
+# Async serving mode: the same report API on an ASGI server (uvicorn) with asyncpg, plus the /report_status
+# long-poll and server-sent events endpoint. Needs `pip install starlette uvicorn asyncpg`.
+ASGI_HOST = os.environ.get('ASGI_HOST', '0.0.0.0')
+ASGI_PORT = int(os.environ.get('ASGI_PORT', '8000'))
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+        from app.api.asgi import app
+    except ImportError as e:
+        print(f"ImportError: the async server needs starlette, uvicorn and asyncpg: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+    print("Starting ASGI application...")
+    # Queued reports are generated by the same pool of worker processes as with run.py. Set REPORT_WORKERS=0 to run
+    # the workers separately with worker.py, for example next to a Flask server that already starts them.
+    from app.report.jobs import REPORT_WORKERS, ReportWorkerPool
+    if REPORT_WORKERS > 0:
+        ReportWorkerPool(REPORT_WORKERS).start()
+    uvicorn.run(app, host=ASGI_HOST, port=ASGI_PORT, log_level=os.environ.get('ASGI_LOG_LEVEL', 'warning'))
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta, time as time_obj
+
+import pytest
+import pytz
+
+from app.report.calendar import invalidate_business_calendars
+from app.report.engines import StoreInputs, get_engine
+from app.report.metrics import add_business_hours, compute_store_metrics, resolve_timezone
+from benchmarks.differential_engines import SCENARIOS
+from benchmarks.synthetic import generate_dataset, store_inputs_from_dataset
+
+pytest.importorskip('numpy')
+
+REF_TIME = datetime(2023, 1, 25, 18, 13, 22, tzinfo=pytz.utc)
+
+# Rows of the numpy engine, the python engine and compute_store_metrics called directly, each with cold business
+# calendars
+def engine_rows(stores):
+    results = []
+    for run in (get_engine('numpy'), get_engine('python'),
+                lambda inputs: [compute_store_metrics(*store) for store in inputs]):
+        invalidate_business_calendars()
+        results.append(run(stores))
+    return results
+
+def assert_rows_equal(stores):
+    numpy_rows, python_rows, baseline_rows = engine_rows(stores)
+    assert len(baseline_rows) == len(stores)
+    for store, numpy_row, python_row, baseline_row in zip(stores, numpy_rows, python_rows, baseline_rows):
+        assert python_row == baseline_row, store.store_id
+        assert numpy_row == baseline_row, store.store_id
+
+# Business hours of every day of the week
+def daily_hours(start_local: time_obj, end_local: time_obj):
+    business_hours = {}
+    for day_of_week in range(7):
+        add_business_hours(business_hours, day_of_week, start_local, end_local)
+    return business_hours
+
+# Polls every `minutes` over the week before REF_TIME, the status given by `status(index)`
+def week_polls(minutes: int, status):
+    count = 7 * 24 * 60 // minutes
+    return [(REF_TIME - timedelta(minutes=minutes * (count - index)), status(index)) for index in range(count + 1)]
+
+def store(store_id, polls, business_hours, tz_str='America/New_York'):
+    ref_time = polls[-1][0] if polls else REF_TIME
+    return StoreInputs(store_id, polls, business_hours, resolve_timezone(store_id, tz_str), ref_time)
+
+@pytest.mark.parametrize('name, end_utc, polls_per_hour', SCENARIOS, ids=[scenario[0] for scenario in SCENARIOS])
+def test_engines_agree_on_synthetic_scenarios(name, end_utc, polls_per_hour):
+    dataset = generate_dataset(200, polls_per_hour=polls_per_hour, seed=0, end_utc=end_utc)
+    assert_rows_equal(store_inputs_from_dataset(dataset))
+
+def test_engines_agree_on_tied_polls():
+    polls = []
+    for timestamp, status in week_polls(60, lambda index: 'active' if index % 3 else 'inactive'):
+        # A second poll at the same time with the opposite status
+        polls += [(timestamp, status), (timestamp, 'inactive' if status == 'active' else 'active')]
+    assert_rows_equal([store('ties', polls, daily_hours(time_obj(9, 0), time_obj(17, 0))),
+                       store('ties-24h', polls, {})])
+
+# Totals that land exactly on half a minute or half an hour, which round to even
+@pytest.mark.parametrize('active_for, expected', [(timedelta(seconds=30), 0), (timedelta(seconds=90), 2)],
+                         ids=['0.5min', '1.5min'])
+def test_engines_agree_on_last_hour_rounding_ties(active_for, expected):
+    polls = [(REF_TIME - timedelta(days=6), 'inactive'), (REF_TIME - active_for, 'active'), (REF_TIME, 'active')]
+    stores = [store('rounding-tie', polls, {})]
+    assert_rows_equal(stores)
+    assert engine_rows(stores)[0][0][1] == expected
+
+@pytest.mark.parametrize('active_for, expected', [(timedelta(minutes=90), 2), (timedelta(minutes=150), 2)],
+                         ids=['1.5h', '2.5h'])
+def test_engines_agree_on_last_week_rounding_ties(active_for, expected):
+    # Open 9:00-17:00 in New York, 14:00-22:00 UTC in January; active until the close of January 24
+    closes = datetime(2023, 1, 24, 22, 0, tzinfo=pytz.utc)
+    polls = [(REF_TIME - timedelta(days=6), 'inactive'), (closes - active_for, 'active'), (closes, 'inactive'),
+             (REF_TIME, 'inactive')]
+    stores = [store('rounding-tie', polls, daily_hours(time_obj(9, 0), time_obj(17, 0)))]
+    assert_rows_equal(stores)
+    assert engine_rows(stores)[0][0][3] == expected
+
+def test_engines_agree_on_empty_polls():
+    assert engine_rows([]) == [[], [], []]
+    hours = daily_hours(time_obj(9, 0), time_obj(17, 0))
+    assert_rows_equal([store('no-polls', [], hours), store('no-polls-24h', [], {})])
+    assert_rows_equal([store('no-polls', [], hours), store('polls', week_polls(60, lambda index: 'active'), hours)])
+    # A store whose only poll is the reference time has no earlier polls in any window
+    only_poll = [(REF_TIME, 'active')]
+    assert_rows_equal([store('single-poll', only_poll, hours), store('single-poll-24h', only_poll, {})])
+
+def test_engines_agree_on_24h_stores():
+    polls = week_polls(45, lambda index: 'inactive' if index % 7 == 0 else 'active')
+    assert_rows_equal([store('no-hours', polls, {}),
+                       store('all-day', polls, daily_hours(time_obj(0, 0), time_obj(0, 0))),
+                       store('overnight', polls, daily_hours(time_obj(20, 0), time_obj(4, 0)))])
+
+def test_engines_agree_on_missing_timezone():
+    polls = week_polls(30, lambda index: 'active' if index % 5 else 'inactive')
+    hours = daily_hours(time_obj(10, 30), time_obj(22, 0))
+    stores = [store('no-timezone', polls, hours, None), store('unknown-timezone', polls, hours, 'Mars/Olympus'),
+              store('chicago', polls, hours, 'America/Chicago')]
+    assert_rows_equal(stores)
+    rows = engine_rows(stores)[0]
+    # Both fall back to America/Chicago
+    assert rows[0][1:] == rows[1][1:] == rows[2][1:]
+
+@pytest.mark.parametrize('end_utc', [datetime(2023, 3, 14, 9, 30, tzinfo=pytz.utc),
+                                     datetime(2023, 11, 7, 7, 45, tzinfo=pytz.utc)],
+                         ids=['spring-forward', 'fall-back'])
+def test_engines_agree_across_dst_changes(end_utc):
+    count = 7 * 24 * 2
+    polls = [(end_utc - timedelta(minutes=30 * (count - index)), 'active' if index % 4 else 'inactive')
+             for index in range(count + 1)]
+    stores = [StoreInputs(f'dst-{hours}', polls, business_hours, resolve_timezone('dst', 'America/New_York'), end_utc)
+              for hours, business_hours in [('night', daily_hours(time_obj(1, 0), time_obj(4, 0))),
+                                            ('overnight', daily_hours(time_obj(22, 0), time_obj(3, 0))),
+                                            ('day', daily_hours(time_obj(9, 0), time_obj(17, 0))),
+                                            ('24h', {})]]
+    assert_rows_equal(stores)
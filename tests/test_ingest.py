@@ -0,0 +1,13 @@
+import pytest
+
+from app.ingest import INGEST_MAX_WAIT, parse_wait
+
+@pytest.mark.parametrize('value, expected', [(None, 0.0), ('0', 0.0), ('2.5', 2.5),
+                                             (str(INGEST_MAX_WAIT + 1), INGEST_MAX_WAIT)])
+def test_parse_wait(value, expected):
+    assert parse_wait(value) == expected
+
+@pytest.mark.parametrize('value', ['', 'soon', 'nan', 'inf', '-inf', '-1', '-0.5'])
+def test_parse_wait_rejects_bad_values(value):
+    with pytest.raises(ValueError, match='wait'):
+        parse_wait(value)
@@ -0,0 +1,70 @@
+import json
+
+import psycopg2
+import pytest
+
+from app.api.endpoints import STORE_WEEK_POLLS_QUERY
+from app.db import get_db_params
+from app.report import bulk, uptime
+
+# Index the polls of a store are read with, in timestamp order
+STORE_TIMESTAMP_INDEX = 'idx_store_status_store_id_timestamp'
+
+# Stores of the configured database the plans are made for, as many as a per-store or small bulk report asks for
+STORE_COUNT = 20
+
+@pytest.fixture(scope='module')
+def conn():
+    try:
+        conn = psycopg2.connect(**get_db_params())
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"database unavailable: {e}")
+    yield conn
+    conn.rollback()
+    conn.close()
+
+@pytest.fixture(scope='module')
+def stores(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT store_id, MAX(timestamp_utc) FROM store_status "
+                    "WHERE store_id IN (SELECT store_id FROM stores ORDER BY store_id LIMIT %s) GROUP BY store_id",
+                    (STORE_COUNT,))
+        rows = cur.fetchall()
+    conn.rollback()
+    if not rows:
+        pytest.skip("store_status has no polls")
+    return rows
+
+# Every node of an EXPLAIN (FORMAT JSON) plan
+def plan_nodes(conn, query: str, params):
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        plan = cur.fetchone()[0]
+    conn.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes, pending = [], [plan[0]['Plan']]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get('Plans', []))
+    return nodes
+
+def assert_uses_store_timestamp_index(nodes):
+    seq_scans = [node for node in nodes
+                 if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == 'store_status']
+    assert not seq_scans, "store_status is read with a Seq Scan"
+    assert any(node.get('Index Name') == STORE_TIMESTAMP_INDEX for node in nodes), \
+        f"store_status is not read with {STORE_TIMESTAMP_INDEX}"
+
+def test_store_week_polls_query_uses_index(conn, stores):
+    store_id, max_ts = stores[0]
+    assert_uses_store_timestamp_index(plan_nodes(conn, STORE_WEEK_POLLS_QUERY, (store_id, max_ts)))
+
+def test_bulk_week_polls_query_uses_index(conn, stores):
+    store_ids = [store_id for store_id, _ in stores]
+    assert_uses_store_timestamp_index(plan_nodes(conn, bulk.WEEK_POLLS_QUERY, (store_ids,)))
+
+def test_uptime_validators_query_uses_index(conn, stores):
+    store_ids = [store_id for store_id, _ in stores]
+    assert_uses_store_timestamp_index(plan_nodes(conn, uptime.VALIDATORS_QUERY, (uptime.VERSION_TABLES, store_ids)))
@@ -0,0 +1,26 @@
+import argparse
+import signal
+
+from app.report.jobs import REPORT_WORKERS, ReportWorkerPool
+
+# Runs the report workers without the web server, e.g. on a separate machine or with REPORT_WORKERS=0 in run.py
+def main():
+    parser = argparse.ArgumentParser(description="Generate the queued reports with a pool of worker processes")
+    parser.add_argument('--workers', type=int, default=REPORT_WORKERS, help="number of worker processes")
+    args = parser.parse_args()
+
+    # Stopped like an interrupt when the process manager sends SIGTERM
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+    pool = ReportWorkerPool(args.workers)
+    pool.start()
+    try:
+        pool.join()
+    except KeyboardInterrupt:
+        print("Stopping report workers...")
+        pool.stop()
+
+if __name__ == '__main__':
+    main()